@@ -3,186 +3,1301 @@
 # --------------------------------------------------
 #    Imports
 # --------------------------------------------------
+import asyncio
+import base64
+import collections
 import concurrent.futures
-import importlib
-import inspect
+import email.utils
+import gzip
+import hashlib
 import io
+import itertools
+import json
+import logging
 import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import weakref
 import pretty_html_table
-import pandas as pd
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from DataHub import cache, catalog, metrics, projection, reloader
+from DataHub.worker_pool import WorkerPool
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+CONTENT_TYPES = {'csv': 'text/plain', 'json': 'application/json', 'html': 'text/html',
+                 'pickle': 'application/python-pickle', 'arrow': 'application/vnd.apache.arrow.file',
+                 'ndjson': 'application/x-ndjson', 'arrow_stream': 'application/vnd.apache.arrow.stream'}
+# outputs which can be streamed in chunks, and outputs which are always streamed
+STREAMABLE_OUTPUTS = ('csv', 'ndjson', 'arrow_stream')
+STREAM_OUTPUTS = ('ndjson', 'arrow_stream')
+STREAM_CHUNK_ROWS = 50000
+STREAM_READ_BYTES = 1024 * 1024
+
+# outputs compressed with the encoding negotiated with the client, smaller bodies are sent as is
+TEXT_OUTPUTS = ('csv', 'json', 'html')
+COMPRESS_MIN_BYTES = 1024
+
+# worker results of at least this many bytes are handed to the server in a temporary file instead of through the
+# pipe, and sent to the client from the file in chunks, see configure_result_limits
+SPILL_BYTES = 16 * 1024 * 1024
+
+# queries of a batch run in at most this many threads of the server, each waiting for a worker
+MAX_BATCH_SIZE = 100
+BATCH_THREADS = 16
+
+# seconds clients may cache results of queries with lag_params and no ttl, these only change with the source
+HISTORICAL_MAX_AGE = 3600
+
+# content encodings in order of preference, only the ones whose library is installed
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = zstandard.ZstdCompressor(level=3).compress
+if brotli is not None:
+    COMPRESSORS['br'] = lambda data: brotli.compress(data, quality=5)
+COMPRESSORS['gzip'] = lambda data: gzip.compress(data, compresslevel=5)
+
+
+# --------------------------------------------------
+#    Globals
+# --------------------------------------------------
+_WORKER_POOL = None
+_CHECK_PROVIDER_MTIMES = True
+_MODULE_WATCHER = None
+_FAST_CACHE_SPECS = {}
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.RLock()
+_CATALOGS = {}
+_QUERY_LIMITER = None
+_MAX_RESULT_ROWS = 0
+_MAX_RESULT_BYTES = 0
+_SPILL_BYTES = SPILL_BYTES
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class _FileResult:
+    """ result handed back by a worker as a file on disk instead of through the pipe """
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class _SpillResult(_FileResult):
+    """ result written to a temporary file by a worker, the file is removed once the server lets go of the result """
+    def __init__(self, path, owner=False):
+        super().__init__(path)
+        if owner:
+            weakref.finalize(self, _remove_quietly, path)
+
+    def __reduce__(self):
+        # only the copy unpickled by the server owns the file, the worker drops its copy right after sending it
+        return (_SpillResult, (self.path, True))
+
+
+class FileChunks:
+    """ body of a response which is sent from a file in chunks, so the server never holds all of it in memory """
+    def __init__(self, result, size, chunk_bytes=STREAM_READ_BYTES):
+        # the result is referenced until the body is sent, so a spill file is not removed before
+        self.result = result
+        self.size = size
+        self.chunk_bytes = chunk_bytes
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        with open(self.result.path, 'rb') as f:
+            chunk = f.read(self.chunk_bytes)
+            while chunk:
+                yield chunk
+                chunk = f.read(self.chunk_bytes)
+
+
+class ResultTooLargeError(Exception):
+    """ raised when the result of a query exceeds the row or byte limit, see configure_result_limits """
+    pass
+
+
+class ServerBusyError(Exception):
+    """ raised when the query limiter can not queue another query, the client should retry after retry_after seconds """
+    def __init__(self, retry_after):
+        super().__init__(f'too many queries, retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class QueryLimiter:
+    """ async context manager limiting the number of queries running at once
+
+        Queries beyond max_concurrent wait in a first in first out queue of at most max_queued queries, further
+        queries are rejected with ServerBusyError so a few slow queries can not pile up every other request.  All
+        users must run on the same event loop.
+    """
+    def __init__(self, max_concurrent, max_queued=0, retry_after=5):
+        """ init
+
+            Args:
+                max_concurrent - number of queries allowed to run at once
+                max_queued - number of queries allowed to wait for a slot
+                retry_after - seconds rejected clients are asked to wait before retrying
+        """
+        if max_concurrent < 1:
+            raise ValueError('max_concurrent must be at least 1')
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self._running = 0
+        self._waiters = collections.deque()
+        self._rejected = 0
+
+    async def __aenter__(self):
+        if self._running < self.max_concurrent and not self._waiters:
+            self._running += 1
+            return self
+        if len(self._waiters) >= self.max_queued:
+            self._rejected += 1
+            raise ServerBusyError(self.retry_after)
+
+        # wait for a finishing query to hand over its slot
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release()
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # the slot passes directly to the next query
+                waiter.set_result(None)
+                return
+        self._running -= 1
+
+    def stats(self):
+        """ return the number of running, queued, and rejected queries """
+        return {'running': self._running, 'queued': len(self._waiters), 'rejected': self._rejected,
+                'max_concurrent': self.max_concurrent, 'max_queued': self.max_queued}
+
+
+# --------------------------------------------------
+#    Worker Pool
+# --------------------------------------------------
+def _warm_worker(modulepath, memory_cache_mb=0, memory_cache_entry_mb=None, preload=False, check_mtimes=True,
+                 result_limits=(0, 0, SPILL_BYTES)):
+    """ initializer for pool workers, pandas and this module are already imported by unpickling this function """
+    global _CHECK_PROVIDER_MTIMES
+    if modulepath and modulepath != '.' and modulepath not in sys.path:
+        sys.path.append(modulepath)
+    cache.configure_memory_cache(memory_cache_mb, memory_cache_entry_mb)
+    configure_result_limits(*result_limits)
+    _CHECK_PROVIDER_MTIMES = check_mtimes
+    if preload:
+        preload_providers(modulepath)
+
+
+def preload_providers(modulepath):
+    """ import every provider module under a module path, so queries do not pay for the imports
+
+        Returns:
+            dictionary of dotted module name to error message for the modules which could not be imported
+    """
+    errors = {}
+    for path in catalog.module_paths(modulepath):
+        if not os.path.isfile(os.path.join(modulepath, path) + '.py'):
+            continue
+        name = catalog.module_name(path)
+        try:
+            _import_provider(name)
+        except Exception as e:
+            # a broken module only fails its own queries
+            errors[name] = f'{type(e).__name__}: {e}'
+            logging.error(f'could not preload {name}: {errors[name]}')
+    return errors
+
+
+def start_worker_pool(modulepath, max_workers=4, max_tasks_per_worker=0, max_rss_mb=0, task_timeout=None,
+                      memory_cache_mb=0, memory_cache_entry_mb=None, preload=False, check_mtimes=True):
+    """ start the pool of warm worker processes used for queries and docs
+
+        Args:
+            modulepath - system path to the modules
+            max_workers - number of worker processes
+            max_tasks_per_worker - recycle a worker after this many tasks, 0 to never recycle
+            max_rss_mb - recycle a worker when it grows beyond this many MB resident, 0 to disable
+            task_timeout - seconds a query may run before its worker is killed, None for no timeout
+            memory_cache_mb - size of the in memory cache tier of each worker, 0 to disable
+            memory_cache_entry_mb - cache entries larger than this are only kept on disk
+            preload - import every provider module when a worker starts instead of on its first query
+            check_mtimes - check the source of a provider for changes on every query and reload it, False if the
+                           pool is rolled by a module watcher instead
+
+        The workers use the result limits set by configure_result_limits before the pool is started.
+
+        Returns:
+            the WorkerPool
+    """
+    global _WORKER_POOL
+    stop_worker_pool()
+    result_limits = (_MAX_RESULT_ROWS, _MAX_RESULT_BYTES, _SPILL_BYTES)
+    _WORKER_POOL = WorkerPool(max_workers=max_workers, max_tasks_per_worker=max_tasks_per_worker,
+                              max_rss_mb=max_rss_mb, task_timeout=task_timeout, initializer=_warm_worker,
+                              initargs=(modulepath, memory_cache_mb, memory_cache_entry_mb, preload, check_mtimes,
+                                        result_limits))
+    return _WORKER_POOL
+
+
+def roll_worker_pool():
+    """ replace the workers of the pool with fresh processes, running queries finish in the old ones """
+    if _WORKER_POOL is not None:
+        _WORKER_POOL.roll()
+
+
+def start_module_watcher(modulepath, interval=2):
+    """ roll the worker pool whenever the provider modules under a module path change
+
+        Rolling rather than reloading modules in place also picks up helper modules imported by providers and
+        resets state providers keep at module level.
+
+        Returns:
+            the ModuleWatcher
+    """
+    global _MODULE_WATCHER
+    stop_module_watcher()
+    _MODULE_WATCHER = reloader.ModuleWatcher(modulepath, lambda changed: roll_worker_pool(), interval)
+    return _MODULE_WATCHER
+
+
+def stop_module_watcher():
+    """ stop the module watcher if one is running """
+    global _MODULE_WATCHER
+    if _MODULE_WATCHER is not None:
+        _MODULE_WATCHER.stop()
+        _MODULE_WATCHER = None
+
+
+def configure_query_limits(max_concurrent, max_queued=0, retry_after=5):
+    """ limit the number of queries execute_query_async runs at once, 0 for no limit
+
+        Args:
+            max_concurrent - number of queries allowed to run at once, usually the number of workers
+            max_queued - number of queries allowed to wait for a slot before new queries get ServerBusyError
+            retry_after - seconds rejected clients are asked to wait before retrying
+    """
+    global _QUERY_LIMITER
+    _QUERY_LIMITER = QueryLimiter(max_concurrent, max_queued, retry_after) if max_concurrent else None
+    return _QUERY_LIMITER
+
+
+def configure_result_limits(max_rows=0, max_bytes=0, spill_bytes=SPILL_BYTES):
+    """ limit the size of query results, queries beyond a limit fail with ResultTooLargeError, 413 for the client
+
+        Args:
+            max_rows - rows a result may have, 0 for no limit
+            max_bytes - bytes a result may have before compression, 0 for no limit
+            spill_bytes - worker results of at least this many bytes are handed over in a temporary file and sent to
+                          the client in chunks, 0 to always send results through the pipe
+    """
+    global _MAX_RESULT_ROWS, _MAX_RESULT_BYTES, _SPILL_BYTES
+    _MAX_RESULT_ROWS = max_rows
+    _MAX_RESULT_BYTES = max_bytes
+    _SPILL_BYTES = spill_bytes
+
+
+def _check_row_count(row_count):
+    """ raise ResultTooLargeError if a result of row_count rows has more rows than the limit """
+    if _MAX_RESULT_ROWS and row_count > _MAX_RESULT_ROWS:
+        raise ResultTooLargeError(f'the result has {row_count} rows, more than the limit of {_MAX_RESULT_ROWS}, '
+                                  f'narrow the query or use the where, columns, offset, and limit parameters')
+
+
+def _check_rows(df):
+    """ raise ResultTooLargeError if a dataframe has more rows than the limit, returns the dataframe """
+    _check_row_count(len(df))
+    return df
+
+
+def _check_result_rows(result):
+    """ raise ResultTooLargeError if an undecoded query result has more rows than the limit
+
+        The row count of cache entries is taken from the cache index, results are only decoded if it is unknown.
+    """
+    if not _MAX_RESULT_ROWS:
+        return
+    cache_path = getattr(result, 'cache_path', None)
+    row_count = cache.entry_row_count(cache_path) if cache_path is not None else None
+    if row_count is None:
+        row_count = len(cache.decode_cache_to_df(result))
+    _check_row_count(row_count)
+
+
+def _check_bytes(size):
+    """ raise ResultTooLargeError if a result of size bytes is larger than the limit """
+    if _MAX_RESULT_BYTES and size > _MAX_RESULT_BYTES:
+        raise ResultTooLargeError(f'the result has {size} bytes, more than the limit of {_MAX_RESULT_BYTES}, '
+                                  f'narrow the query or use the where, columns, offset, and limit parameters')
+
+
+def _spill(data):
+    """ write the data of a worker result into a temporary file
+
+        Returns:
+            _SpillResult
+    """
+    fd, spill_path = tempfile.mkstemp(prefix='datahub_spill_')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data.encode('utf-8') if isinstance(data, str) else data)
+    return _SpillResult(spill_path)
+
+
+def _read_result(result, stream_large=False):
+    """ read a worker result which is a file, files of at least the spill size are returned as FileChunks if
+        stream_large is True """
+    if stream_large and _SPILL_BYTES:
+        size = os.path.getsize(result.path)
+        if size >= _SPILL_BYTES:
+            return FileChunks(result, size)
+    return result.read()
+
+
+def get_query_limiter():
+    """ return the query limiter, or None if queries are not limited """
+    return _QUERY_LIMITER
+
+
+def stop_worker_pool():
+    """ stop the pool of worker processes if one is running """
+    global _WORKER_POOL
+    if _WORKER_POOL is not None:
+        _WORKER_POOL.shutdown()
+        _WORKER_POOL = None
+
+
+def _submit(func, *args):
+    """ submit a worker function to the worker pool, or to a single use process if no pool is running
+
+        Returns:
+            concurrent.futures.Future
+    """
+    if _WORKER_POOL is not None:
+        return _WORKER_POOL.submit(func, *args)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+    future = executor.submit(func, *args)
+    executor.shutdown(wait=False)
+    return future
+
+
+def _submit_shared(key, func, *args):
+    """ submit a worker function unless an identical call is already in flight, in which case share its future
+
+        Args:
+            key - hashable identity of the call, i.e. (path, qid, params, output)
+            func - worker function
+            args - arguments for the worker function
+
+        Returns:
+            concurrent.futures.Future
+    """
+    with _IN_FLIGHT_LOCK:
+        future = _IN_FLIGHT.get(key)
+        if future is None:
+            future = _submit(func, *args)
+            _IN_FLIGHT[key] = future
+            future.add_done_callback(lambda f: _forget_in_flight(key, f))
+        return future
+
+
+def _forget_in_flight(key, future):
+    """ done callback removing a finished call from the in flight calls """
+    with _IN_FLIGHT_LOCK:
+        if _IN_FLIGHT.get(key) is future:
+            del _IN_FLIGHT[key]
+
+
+def _query_key(path, parsed_qs, output, encoding=None, if_none_match=None):
+    """ identity of a query for coalescing, parameters are compared by name so their order does not matter """
+    return (path, output, encoding, if_none_match, tuple(sorted((k, str(v)) for k, v in parsed_qs.items())))
+
+
+def _run(func, *args, nospawn=False):
+    """ run a worker function inline, in the worker pool, or in a single use process if no pool is running """
+    if nospawn:
+        return func(*args)
+    return _submit(func, *args).result()
+
+
+def _import_provider(name):
+    """ import a provider module, reloading it if its source changed since this process imported it
+
+        Args:
+            name - dotted module name, i.e. example.example
+
+        Returns:
+            module
+    """
+    # workers of a watched module path are rolled instead, so the hot path does not stat the source
+    return reloader.import_module(name, _CHECK_PROVIDER_MTIMES)
 
 
 # --------------------------------------------------
 #    Functions
 # --------------------------------------------------
-def _build_html_docs_worker(host, path, modulepath, authuser, authtoken, callerid):
-    """ worker to build html docs for a path """
-
-    # add style sheet
-    html = '<head><link rel="stylesheet" href="/style.css"></head>'
-    html = html + f'<h1><a href="/">DataHub Information</a></h1><pre class=path>Path: /{path}</pre><hr>'
-
-    # build the authentication tail
-    tail = ''
-    if authuser != '':
-        tail = tail + f'&authuser={authuser}'
-    if authtoken != '':
-        tail = tail + f'&authtoken={authtoken}'
-    if callerid != '':
-        tail = tail + f'&callerid={callerid}'
-
-    # check if we are loading a python file
-    if not os.path.exists(os.path.join(modulepath, path) + '.py'):
-        # does not exist, so build a directory listing
-        dir_list =sorted(os.listdir(os.path.join(modulepath, path)))
-
-        for x in dir_list:
-            if not x.startswith('.') and not x.startswith('_'):
-                try:
-                    if x.endswith('.py'):
-                        x = x[:-3]
-                        m = importlib.import_module(os.path.join(path, x).replace('/', '.'))
-                    else:
-                        m = importlib.import_module(os.path.join(path, x))
-                    html = html + f'<div class=divmodule><h4>/{os.path.join(path, x)}</h4>'
-                    if m.__doc__:
-                        html = html + f'<pre class=doc>{m.__doc__}</pre>'
-                    aref = 'http://' + os.path.join(host, path, x) + (('?' + tail[1:]) if tail else '')
-                    html = html + f'<a class=a href={aref}>{aref}</a>'
-                    html = html + f'<hr></div>'
-                except:
-                    pass
-
-        return html, 'text/html', 200
-
-    # try to load the functions in the module
-    m = importlib.import_module(path.replace('/', '.'))
-    funcs = []
-    for name in dir(m):
-        if not name.startswith('_'):
-            try:
-                if getattr(m, name).__module__ == m.__name__:
-                    if inspect.isfunction(getattr(m, name)):
-                        funcs.append(name)
-            except:
-                # don't include if there are problems
-                pass
-
-    # build the html doc string
-    for name in sorted(funcs):
-        docs = getattr(m, name).__doc__
-        if docs is None:
-            html = f'<div style="color: red; height:200px; background-color: pink; font-size: 40px;">Error!  No documentation found for {name}.<br>This is not OK</div>' + html
-        else:
-            doc_lines = []
-            for x in docs.split('\n'):
-                if 'Example Query: ' in x:
-                    aref = x.partition('Example Query:')[2].strip()
-                    aref = f"http://{host}/{path}?qid={name}{aref}{tail}"
-                    x = f'<a href={aref}>{aref}</a>'
-                doc_lines.append(x)
-            docs = '\n'.join(doc_lines)
+def metrics_text():
+    """ return the metrics of this server in the Prometheus text format, including the worker pool, the query
+        limiter, the memory tier of this process, and the cache hit ratios """
+    gauges = {}
+    if _WORKER_POOL is not None:
+        for k, v in _WORKER_POOL.stats().items():
+            gauges[f'datahub_worker_pool_{k}'] = v
+    if _QUERY_LIMITER is not None:
+        for k, v in _QUERY_LIMITER.stats().items():
+            gauges[f'datahub_query_limiter_{k}'] = v
+    memory = cache.get_memory_cache()
+    if memory is not None:
+        for k, v in memory.stats().items():
+            gauges[f'datahub_memory_cache_{k}'] = v
+    ratios = metrics.cache_hit_ratios()
+    if ratios:
+        gauges['datahub_cache_hit_ratio'] = {(('module', m), ('func', f)): r for (m, f), r in ratios.items()}
+    return metrics.render_prometheus(gauges)
+
+
+def _describe_modules_worker(names):
+    """ worker to import provider modules and describe them for the module catalog """
+    result = {}
+    for name in names:
+        try:
+            result[name] = catalog.describe_module(_import_provider(name))
+        except Exception as e:
+            result[name] = {'error': f'{type(e).__name__}: {e}'}
+    return result
+
 
-            html = html + f'<div class=divmodule><h4>/{path + "?qid=" + name}</h4>'
-            html = html + f'<pre class=doc>{docs}</pre></div><hr>'
-    return html, 'text/html', 200
+def get_catalog(modulepath):
+    """ return the module catalog of a module path, modules are imported and described in the workers """
+    with _IN_FLIGHT_LOCK:
+        c = _CATALOGS.get(modulepath)
+        if c is None:
+            c = catalog.ModuleCatalog(modulepath, lambda names: _run(_describe_modules_worker, names))
+            _CATALOGS[modulepath] = c
+        return c
 
 
-def build_html_docs(host, path, modulepath, authuser, authtoken, callerid):
+def build_html_docs(host, path, modulepath, authuser, authtoken, callerid, if_none_match=None):
     """ build html docs for a path
 
         Args:
             host - host the server is running on, i.e. ccgtdev.commercecasino.local
             path - path to inspect to build documentation for
             modulepath - system path to the modules
+            if_none_match - If-None-Match header of the request, a matching ETag returns 304 without a body
+
+        Returns:
+            html, content_type, return_code, headers
+    """
+    html = get_catalog(modulepath).render(host, path, authuser, authtoken, callerid)
+    etag = catalog.make_etag(html)
+    if catalog.etag_matches(etag, if_none_match):
+        return '', 'text/html', 304, {'ETag': etag}
+    return html, 'text/html', 200, {'ETag': etag}
+
+
+def catalog_json(modulepath, if_none_match=None):
+    """ return the module catalog as json, describing new and changed modules first
+
+        Returns:
+            json, content_type, return_code, headers
+    """
+    c = get_catalog(modulepath)
+    c.refresh()
+    data = c.to_json()
+    etag = catalog.make_etag(data)
+    if catalog.etag_matches(etag, if_none_match):
+        return '', 'application/json', 304, {'ETag': etag}
+    return data, 'application/json', 200, {'ETag': etag}
+
+
+def _render(df, output):
+    """ render a dataframe in an output format, unknown formats get the gzipped pickle """
+    if output == 'csv':
+        return df.to_csv()
+    elif output == 'json':
+        return df.to_json()
+    elif output == 'html':
+        # convert the dataframe to pretty html
+        return pretty_html_table.build_table(df.reset_index(), 'blue_light')
+    elif output == 'arrow':
+        return cache.get_storage('feather').dumps(df)
+    elif output in STREAM_OUTPUTS:
+        return b''.join(_render_chunks(df, output))
+    f = io.BytesIO()
+    df.to_pickle(f, compression={'method': 'gzip', 'compresslevel': 1, 'mtime': 1})
+    return f.getvalue()
+
+
+def _render_chunks(df, output, chunk_rows=STREAM_CHUNK_ROWS):
+    """ render a dataframe in chunks of rows so only one chunk of text is in memory at a time
+
+        Args:
+            df - dataframe to render
+            output - csv, ndjson, or arrow_stream
+            chunk_rows - number of rows per chunk
 
         Returns:
-            html docs
+            generator of bytes
     """
-    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(_build_html_docs_worker, host, path, modulepath, authuser, authtoken, callerid)
-        result = future.result()
-        return result
+    if output == 'arrow_stream':
+        if pyarrow is None:
+            raise ImportError('pyarrow is required for output=arrow_stream')
+        schema = pyarrow.Schema.from_pandas(df)
+        sink = io.BytesIO()
+        writer = pyarrow.ipc.new_stream(sink, schema)
+        for i in range(0, len(df), chunk_rows):
+            writer.write_batch(pyarrow.RecordBatch.from_pandas(df.iloc[i:i + chunk_rows], schema=schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+        writer.close()
+        yield sink.getvalue()
+        return
+
+    for i in range(0, max(len(df), 1), chunk_rows):
+        part = df.iloc[i:i + chunk_rows]
+        if output == 'ndjson':
+            text = part.reset_index().to_json(orient='records', lines=True) if len(part) else ''
+            if text and not text.endswith('\n'):
+                text = text + '\n'
+        else:
+            text = part.to_csv(header=(i == 0))
+        yield text.encode('utf-8')
+
+
+def _read_variant(cache_path, output):
+    """ return a pre-rendered output of a cache entry from the memory tier or as a _FileResult, or None """
+    memory = cache.get_memory_cache()
+    if memory is not None:
+        data = memory.get(cache.variant_path(cache_path, output))
+        if data is not None:
+            return data
+    variant_path = cache.read_variant_path(cache_path, output)
+    if variant_path is None:
+        return None
+    if memory is not None and os.path.getsize(variant_path) <= memory.max_entry_bytes:
+        data = _FileResult(variant_path).read()
+        memory.put(variant_path, data)
+        return data
+    return _FileResult(variant_path)
+
+
+def _view_df(result, view):
+    """ decode the result of a query and apply the reserved parameters, columnar cache files only read the columns
+        the view needs """
+    if not view:
+        return cache.decode_cache_to_df(result)
+    columns = projection.needed_columns(view)
+    df = None
+    if columns is not None and isinstance(result, cache.CacheRef):
+        try:
+            df = cache.decode_cache_to_df(result, columns)
+        except (KeyError, ValueError):
+            # i.e. a column of the view is the index, read everything and let the view sort it out
+            pass
+    if df is None:
+        df = cache.decode_cache_to_df(result)
+    return projection.apply_view(df, view)
+
+
+def _check_fast_cache_params(parsed_qs):
+    """ fast_cache returns the whole cache file, so the reserved parameters can not be applied """
+    reserved = [k for k in projection.RESERVED_PARAMS if k in parsed_qs]
+    if reserved:
+        raise ValueError(f'{", ".join(reserved)} can not be used with output=fast_cache')
+
+
+def _execute_query_worker(path, parsed_qs, output='pickle', encoding=None, spill=False, if_none_match=None):
+    """ worker to execute a data query and render the result in the output format
+
+        Args:
+            encoding - content encoding negotiated with the client for text outputs, i.e. gzip, or None
+            spill - True to write results of at least the spill size into a temporary file, so they are not
+                    pickled through the pipe to the server
+            if_none_match - If-None-Match header of the request, a cached result the client already has is neither
+                            read nor compressed and an empty result with its ETag is returned for the 304
+
+        Returns:
+            (data, content_type, headers, recording), data is a _FileResult if it can be read from disk by the
+            caller and recording holds the timings of the phases and the cache lookups of the query
+    """
+    with metrics.collect() as recorder:
+        with metrics.phase('worker'):
+            data, content_type, headers, variant_of = _execute_query(path, parsed_qs, output, encoding, if_none_match)
+            if output in TEXT_OUTPUTS:
+                headers['Vary'] = 'Accept-Encoding'
+            if data is None:
+                data = ''
+            else:
+                _check_bytes(os.path.getsize(data.path) if isinstance(data, _FileResult) else len(data))
+
+                # results which are not cached are identified by their content
+                if 'ETag' not in headers and not isinstance(data, _FileResult):
+                    headers['ETag'] = catalog.make_etag(data)
 
+                if output in TEXT_OUTPUTS and encoding is not None:
+                    data = _encode(data, headers, output, encoding, variant_of)
 
-def _execute_query_worker(path, parsed_qs):
-    """ worker to execute a data query """
+                if spill and _SPILL_BYTES and not isinstance(data, _FileResult) and len(data) >= _SPILL_BYTES:
+                    with metrics.phase('spill'):
+                        data = _spill(data)
+    return data, content_type, headers, recorder.export()
+
+
+def _encode(data, headers, output, encoding, variant_of=None):
+    """ compress a text output, the compressed representation gets its own etag
+
+        Args:
+            variant_of - path of the cache entry if data is its pre-rendered variant, the compressed variant is then
+                         read from or kept next to it
+
+        Returns:
+            data to send, headers are updated if it is compressed
+    """
+    fmt = f'{output}.{encoding}'
+    if variant_of is not None:
+        compressed = _read_variant(variant_of, fmt)
+        if compressed is not None:
+            headers['Content-Encoding'] = encoding
+            headers['ETag'] = _encoded_etag(headers['ETag'], encoding)
+            return compressed
+
+    raw = data.read() if isinstance(data, _FileResult) else data
+    raw = raw.encode('utf-8') if isinstance(raw, str) else raw
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return data
+    with metrics.phase('compress'):
+        data = _compress(raw, encoding)
+    headers['Content-Encoding'] = encoding
+    headers['ETag'] = _encoded_etag(headers['ETag'], encoding)
+    if variant_of is not None:
+        try:
+            with metrics.phase('variant_write'):
+                cache.write_variant(variant_of, fmt, data)
+        except OSError as e:
+            logging.error(f'unable to write {fmt} variant for {variant_of}: {e}')
+    return data
+
+
+def _encoded_etag(etag, encoding):
+    """ etag of the representation of a result compressed with a content encoding """
+    return etag[:-1] + '-' + encoding + '"'
+
+
+def _matching_etag(etag, encoding, if_none_match):
+    """ return the etag of the representation of a result the client has by If-None-Match, or None """
+    if etag is None or not if_none_match:
+        return None
+    for tag in [etag] + ([_encoded_etag(etag, encoding)] if encoding is not None else []):
+        if catalog.etag_matches(tag, if_none_match):
+            return tag
+    return None
+
+
+def _validators(func, result, output, view):
+    """ return the ETag, Last-Modified, and Cache-Control headers for the result of a query
+
+        Cached results are identified by their cache file, its mtime, and its size, so validating them does not need
+        the data, and hits of the memory tier do not need the disk either.  Results with a ttl may be cached by
+        clients for the rest of it, results outside the lag window of a query with lag_params for
+        HISTORICAL_MAX_AGE seconds, everything else must be revalidated.
+    """
+    cache_path = getattr(result, 'cache_path', None)
+    stat = cache.entry_stat(cache_path) if cache_path is not None else None
+    if stat is None:
+        return {'Cache-Control': 'no-cache'}
+
+    mtime, size = stat
+    tag = hashlib.md5(f'{cache_path}|{mtime!r}|{size}|{output}|{sorted(view.items())}'.encode('utf-8')).hexdigest()
+    spec = getattr(func, 'cache_spec', {})
+    if spec.get('ttl') is not None:
+        cache_control = f'max-age={max(int(spec["ttl"] - (time.time() - mtime)), 0)}'
+    elif spec.get('lag_params'):
+        cache_control = f'max-age={HISTORICAL_MAX_AGE}'
+    else:
+        cache_control = 'no-cache'
+    return {'ETag': f'"{tag}"', 'Last-Modified': email.utils.formatdate(mtime, usegmt=True),
+            'Cache-Control': cache_control}
+
+
+def negotiate_encoding(accept_encoding):
+    """ pick the content encoding for a response from the Accept-Encoding header of a request
+
+        Returns:
+            zstd, br, or gzip, whichever is installed, accepted, and has the highest q value, or None
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        accepted[name.strip().lower()] = q
+    best = None
+    for encoding in COMPRESSORS:
+        q = accepted.get(encoding, accepted.get('*', 0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+    return best[0] if best is not None else None
+
+
+def _compress(data, encoding):
+    """ compress a response body """
+    return COMPRESSORS[encoding](data)
+
+
+def _execute_query(path, parsed_qs, output, encoding=None, if_none_match=None):
+    """ execute a data query and render the result in the output format, see _execute_query_worker
+
+        Returns:
+            (data, content_type, headers, variant_of), data is None if the client has the result by if_none_match and
+            variant_of is the path of the cache entry if data is its pre-rendered variant, else None
+    """
     # load the functions in the module
-    m = importlib.import_module(path.replace('/', '.'))
+    with metrics.phase('import'):
+        m = _import_provider(path.replace('/', '.'))
     qid = parsed_qs.pop('qid')
-    result = getattr(m, qid)(**parsed_qs)
+    view = projection.pop_view(parsed_qs)
+    with metrics.phase('query'):
+        result = getattr(m, qid)(**parsed_qs)
+
+    content_type = CONTENT_TYPES.get(output, 'text/plain')
+    headers = {'Content-Encoding': 'gzip'} if output == 'pickle' else {}
+    headers.update(_validators(getattr(m, qid), result, output, view))
+
+    # cached results are validated by their cache file, so a client which has the result gets it without a read
+    etag = _matching_etag(headers.get('ETag'), encoding, if_none_match)
+    if etag is not None:
+        headers['ETag'] = etag
+        headers.pop('Content-Encoding', None)
+        return None, content_type, headers, None
+
+    # a part of the result, the cache file and its variants hold all of it
+    if view:
+        with metrics.phase('render'):
+            data = _render(_check_rows(_view_df(result, view)), output)
+        return data, content_type, headers, None
+
+    # cached results are already on disk, possibly pre-rendered, so hand back the file instead of the data
+    cache_path = getattr(result, 'cache_path', None)
+    if cache_path is not None:
+        # the file and its variants are sent as they are, so the limit is checked against the row count of the entry
+        if (output, result.storage) in (('pickle', 'pickle'), ('arrow', 'feather')):
+            _check_result_rows(result)
+            # small entries are already in the memory tier, so send them rather than touch the disk again
+            memory = cache.get_memory_cache()
+            if isinstance(result, io.BytesIO) and memory is not None and len(result.getbuffer()) <= memory.max_entry_bytes:
+                return result.getvalue(), content_type, headers, None
+            return _FileResult(cache_path), content_type, headers, None
+        if output in cache.VARIANT_FORMATS:
+            variant = _read_variant(cache_path, output)
+            if variant is not None:
+                _check_result_rows(result)
+                return variant, content_type, headers, cache_path
 
     # check if this is already a pickle
-    if not isinstance(result, io.BytesIO):
-        f = io.BytesIO()
-        result.to_pickle(f, compression={'method': 'gzip', 'compresslevel': 1, 'mtime': 1})
-        f.seek(0)
-        result = f.read()
-        f.close()
-    else:
-        result.seek(0)
-        result = result.read()
-    return result
+    if isinstance(result, io.BytesIO) and (output == 'pickle' or output not in CONTENT_TYPES):
+        _check_result_rows(result)
+        return result.getvalue(), content_type, headers, None
+    with metrics.phase('render'):
+        data = _render(_check_rows(cache.decode_cache_to_df(result)), output)
+
+    # keep the rendered output next to the cache entry so the next hit skips unpickling and rendering
+    if cache_path is not None and output in cache.VARIANT_FORMATS:
+        try:
+            with metrics.phase('variant_write'):
+                cache.write_variant(cache_path, output, data)
+        except OSError as e:
+            logging.error(f'unable to write {output} variant for {cache_path}: {e}')
+            return data, content_type, headers, None
+        return data, content_type, headers, cache_path
+    return data, content_type, headers, None
 
 
 def _execute_fast_cache_worker(path, parsed_qs):
-    """ worker to execute a data query if asking for fast_cache"""
-    return ''
+    """ worker to execute a data query if asking for fast_cache
+
+        Returns:
+            (cache_spec, result) where cache_spec is None if the query is not cacheable and result is the path of
+            the cache file, or the gzipped pickle of the data if the result could not be cached
+    """
+    m = _import_provider(path.replace('/', '.'))
+    params = dict(parsed_qs)
+    spec = getattr(getattr(m, params.pop('qid')), 'cache_spec', None)
+    if spec is not None:
+        spec = dict(spec, mtime=os.path.getmtime(spec['filename']))
+
+    # run the query, which fills the cache on a miss, with updatecache the entry is rewritten and then returned
+    update = bool(params.pop('updatecache', False))
+    cache_path = cache.cache_path_from_spec(spec, params) if spec is not None else None
+    if cache_path is not None and not update and \
+            cache.is_fresh(cache_path, cache.min_entry_mtime(spec['ttl'], spec['not_before'])):
+        cache.record_hit_from_spec(spec, params)
+        return spec, cache_path
+    # the byte limit does not apply to cache files, fast_cache clients read them from disk themselves
+    result = _execute_query(path, dict(parsed_qs), 'pickle')[0]
+    if cache_path is not None and cache.is_fresh(cache_path, cache.min_entry_mtime(spec['ttl'], spec['not_before'])):
+        return spec, cache_path
+    return spec, result.read() if isinstance(result, _FileResult) else result
+
+
+def _execute_stream_worker(path, parsed_qs, output, spool_path, chunk_rows=STREAM_CHUNK_ROWS):
+    """ worker to execute a data query and write the output chunk by chunk into a spool file
 
+        Returns:
+            _FileResult of the spool file, or of a pre-rendered variant in which case the spool file is left empty
+    """
+    # load the functions in the module
+    m = _import_provider(path.replace('/', '.'))
+    qid = parsed_qs.pop('qid')
+    view = projection.pop_view(parsed_qs)
+    result = getattr(m, qid)(**parsed_qs)
 
-def execute_query(path, parsed_qs, nospawn=False):
+    # a pre-rendered csv can be streamed as is
+    cache_path = getattr(result, 'cache_path', None)
+    if cache_path is not None and output in cache.VARIANT_FORMATS and not view:
+        variant_path = cache.read_variant_path(cache_path, output)
+        if variant_path is not None:
+            _check_result_rows(result)
+            return _FileResult(variant_path)
+
+    # flush every chunk so the server can send it while the next one renders, a result over the byte limit is cut
+    # short, the error reaches the client before any data if the first chunk is already too large
+    df = _check_rows(_view_df(result, view))
+    written = 0
+    with open(spool_path, 'wb') as f:
+        for chunk in _render_chunks(df, output, chunk_rows):
+            written += len(chunk)
+            _check_bytes(written)
+            f.write(chunk)
+            f.flush()
+    return _FileResult(spool_path)
+
+
+def _follow_spool(spool_path, future):
+    """ yield the contents of a spool file while a worker is still writing it, then remove it """
+    try:
+        with open(spool_path, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_READ_BYTES)
+                if chunk:
+                    yield chunk
+                elif future.done():
+                    # drain what was written after the last read, or switch to the pre-rendered file
+                    result = future.result()
+                    if result.path != spool_path:
+                        f.close()
+                        with open(result.path, 'rb') as vf:
+                            chunk = vf.read(STREAM_READ_BYTES)
+                            while chunk:
+                                yield chunk
+                                chunk = vf.read(STREAM_READ_BYTES)
+                        return
+                    chunk = f.read(STREAM_READ_BYTES)
+                    if not chunk:
+                        return
+                    yield chunk
+                else:
+                    time.sleep(0.005)
+    finally:
+        try:
+            os.remove(spool_path)
+        except FileNotFoundError:
+            pass
+
+
+def _lookup_fast_cache(path, parsed_qs):
+    """ look for the cache file of a query without spawning a worker or importing the module
+
+        Returns:
+            path of the cache file, or None if the cache file is unknown or missing
+    """
+    spec = _FAST_CACHE_SPECS.get((path, parsed_qs.get('qid')))
+    if spec is None:
+        return None
+    try:
+        # the module changed, so the cache layout may have changed too
+        if os.path.getmtime(spec['filename']) != spec['mtime']:
+            return None
+        params = dict(parsed_qs)
+        params.pop('qid')
+        cache_path = cache.cache_path_from_spec(spec, params)
+    except Exception:
+        return None
+    if cache_path is not None and cache.is_fresh(cache_path, cache.min_entry_mtime(spec['ttl'], spec['not_before'])):
+        cache.record_hit_from_spec(spec, params)
+        return cache_path
+    return None
+
+
+def execute_query(path, parsed_qs, nospawn=False, request_headers=None, stream_large=False):
     """ execute a data query and return the results
 
         Args:
             path - path to module to execute
             parsed_qs - dictionary of query parameters
             nospawn - if set to True, do not spawn a separate process
+            request_headers - headers of the request, If-None-Match and Accept-Encoding are used
+            stream_large - if set to True, results of at least the spill size which are on disk are returned as
+                           FileChunks to be sent in chunks instead of being read into memory
+
+        For output=fast_cache the path of the cache file is returned instead of the data.  Once the cache layout of
+        a query is known, hits are answered from the server process without a worker.
+
+        The reserved parameters columns, where, sort, offset, and limit are not passed to the query function, they
+        select part of the result before it is rendered, see projection.apply_view.
+
+        Responses carry an ETag and Cache-Control, a matching If-None-Match returns 304 without a body, and text
+        outputs are compressed with the best encoding the client accepts.
+
+        Results over the limits of configure_result_limits raise ResultTooLargeError.
 
         Return:
             data
     """
-    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
-        # get the output format
-        output = parsed_qs.pop('output', 'csv')
+    # get the output format
+    output = parsed_qs.pop('output', 'csv')
 
-        # special for fast_cache
-        if output == 'fast_cache':
-            # try to return the path to a cache file directly
-            if not nospawn:
-                future = executor.submit(_execute_fast_cache_worker, path, parsed_qs)
-                fast_cache_path = future.result()
+    # special for fast_cache
+    if output == 'fast_cache':
+        # try to return the path to a cache file directly
+        _check_fast_cache_params(parsed_qs)
+        st = time.perf_counter()
+        fast_cache_path = _lookup_fast_cache(path, parsed_qs)
+        if fast_cache_path is not None:
+            metrics.observe_query(path, parsed_qs.get('qid'), output, time.perf_counter() - st)
+            return fast_cache_path, 'application/fast_cache', 200
+        try:
+            if nospawn:
+                spec, result = _execute_fast_cache_worker(path, parsed_qs)
             else:
-                fast_cache_path = _execute_fast_cache_worker(path, parsed_qs)
+                spec, result = _submit_shared(_query_key(path, parsed_qs, output), _execute_fast_cache_worker,
+                                              path, parsed_qs).result()
+        except Exception:
+            metrics.observe_error(path, parsed_qs.get('qid'))
+            raise
+        metrics.observe_query(path, parsed_qs.get('qid'), output, time.perf_counter() - st)
+        return _fast_cache_response(path, parsed_qs, spec, result)
+
+    # handle all other formats, the worker renders the output and identical queries in flight share one execution
+    request_headers = request_headers or {}
+    encoding = negotiate_encoding(request_headers.get('Accept-Encoding')) if output in TEXT_OUTPUTS else None
+    if_none_match = request_headers.get('If-None-Match')
+    st = time.perf_counter()
+    qid = parsed_qs.get('qid')
+    try:
+        if nospawn:
+            worker_result = _execute_query_worker(path, parsed_qs, output, encoding, False, if_none_match)
+        else:
+            future = _submit_shared(_query_key(path, parsed_qs, output, encoding, if_none_match),
+                                    _execute_query_worker, path, parsed_qs, output, encoding, True, if_none_match)
+            worker_result = future.result()
+        if isinstance(worker_result[0], _FileResult) and not _not_modified(worker_result[2], request_headers):
+            worker_result = (_read_result(worker_result[0], stream_large), ) + worker_result[1:]
+    except Exception:
+        metrics.observe_error(path, qid)
+        raise
+    return _finish_query(path, qid, output, st, request_headers, *worker_result)
+
+
+def _not_modified(headers, request_headers):
+    """ check if the client already has the response, by the If-None-Match header of the request """
+    return 'ETag' in headers and catalog.etag_matches(headers['ETag'], request_headers.get('If-None-Match'))
+
+
+def _finish_query(path, qid, output, st, request_headers, data, content_type, headers, recording):
+    """ record the metrics of a query executed by a worker and build its response """
+    headers = dict(headers)
+    code = 200
+    if _not_modified(headers, request_headers):
+        data, code = '', 304
+        headers.pop('Content-Encoding', None)
+    seconds = time.perf_counter() - st
+    phases = dict(recording['phases'])
+    # the time spent outside the worker is queueing, dispatch, and sending the result back
+    phases['dispatch'] = max(seconds - phases.get('worker', 0), 0)
+    metrics.observe_query(path, qid, output, seconds, len(data), dict(recording, phases=phases))
+    timing = metrics.server_timing(dict(phases, total=seconds))
+    if timing is not None:
+        headers['Server-Timing'] = timing
+    return data, content_type, code, headers
+
+
+def _fast_cache_response(path, parsed_qs, spec, result):
+    """ remember the cache layout of a query and build the response to a fast_cache query from its worker """
+    if spec is not None:
+        _FAST_CACHE_SPECS[(path, parsed_qs['qid'])] = spec
+    if isinstance(result, bytes):
+        # not cacheable, i.e. inside the lag window, so return the data itself
+        return result, 'application/python-pickle', 200, {'Content-Encoding': 'gzip'}
+    return result, 'application/fast_cache', 200
+
+
+async def _await_future(future):
+    """ await a concurrent future without cancelling it if the caller is cancelled, other requests may share it """
+    return await asyncio.shield(asyncio.wrap_future(future))
+
+
+async def _execute_query_async(path, parsed_qs, nospawn, request_headers, stream_large):
+    """ execute_query awaiting the worker instead of blocking on it """
+    loop = asyncio.get_running_loop()
+    if nospawn:
+        return await loop.run_in_executor(None, execute_query, path, parsed_qs, True, request_headers, stream_large)
+
+    output = parsed_qs.pop('output', 'csv')
+    if output == 'fast_cache':
+        st = time.perf_counter()
+        try:
+            spec, result = await _await_future(_submit_shared(_query_key(path, parsed_qs, output),
+                                                              _execute_fast_cache_worker, path, parsed_qs))
+        except Exception:
+            metrics.observe_error(path, parsed_qs.get('qid'))
+            raise
+        metrics.observe_query(path, parsed_qs.get('qid'), output, time.perf_counter() - st)
+        return _fast_cache_response(path, parsed_qs, spec, result)
+
+    request_headers = request_headers or {}
+    encoding = negotiate_encoding(request_headers.get('Accept-Encoding')) if output in TEXT_OUTPUTS else None
+    if_none_match = request_headers.get('If-None-Match')
+    st = time.perf_counter()
+    qid = parsed_qs.get('qid')
+    try:
+        future = _submit_shared(_query_key(path, parsed_qs, output, encoding, if_none_match), _execute_query_worker,
+                                path, parsed_qs, output, encoding, True, if_none_match)
+        worker_result = await _await_future(future)
+        if isinstance(worker_result[0], _FileResult) and not _not_modified(worker_result[2], request_headers):
+            worker_result = (await loop.run_in_executor(None, _read_result, worker_result[0], stream_large), ) + \
+                worker_result[1:]
+    except Exception:
+        metrics.observe_error(path, qid)
+        raise
+    return _finish_query(path, qid, output, st, request_headers, *worker_result)
+
+
+async def execute_query_async(path, parsed_qs, nospawn=False, request_headers=None, stream_large=False):
+    """ execute a data query without blocking the event loop, see execute_query
+
+        Queries wait for a slot of the query limiter if one is configured, and raise ServerBusyError when its queue
+        is full.  Fast cache hits which are answered without a worker do not take a slot.
+
+        Args:
+            path - path to module to execute
+            parsed_qs - dictionary of query parameters
+            nospawn - if set to True, run the query in a thread of this process instead of a worker
+            request_headers - headers of the request, If-None-Match and Accept-Encoding are used
+            stream_large - see execute_query
+
+        Return:
+            same as execute_query
+    """
+    if parsed_qs.get('output') == 'fast_cache':
+        _check_fast_cache_params(parsed_qs)
+        st = time.perf_counter()
+        params = dict(parsed_qs)
+        params.pop('output')
+        fast_cache_path = _lookup_fast_cache(path, params)
+        if fast_cache_path is not None:
+            metrics.observe_query(path, params.get('qid'), 'fast_cache', time.perf_counter() - st)
+            return fast_cache_path, 'application/fast_cache', 200
+
+    if _QUERY_LIMITER is None:
+        return await _execute_query_async(path, parsed_qs, nospawn, request_headers, stream_large)
+    async with _QUERY_LIMITER:
+        return await _execute_query_async(path, parsed_qs, nospawn, request_headers, stream_large)
 
-            content_type = 'application/fast_cache'
-            return fast_cache_path, content_type, 200
 
-        # handle all other formats
-        if not nospawn:
-            future = executor.submit(_execute_query_worker, path, parsed_qs)
-            result = future.result()
+def _parse_batch(specs):
+    """ validate the specs of a batch, see execute_batch
+
+        Returns:
+            list of (path, parsed_qs, output)
+    """
+    if isinstance(specs, (str, bytes)):
+        specs = json.loads(specs)
+    if not isinstance(specs, list):
+        raise ValueError('a batch must be a list of {path, qid, params, output} objects')
+    if len(specs) > MAX_BATCH_SIZE:
+        raise ValueError(f'a batch may contain at most {MAX_BATCH_SIZE} queries, got {len(specs)}')
+    queries = []
+    for spec in specs:
+        if not isinstance(spec, dict) or 'path' not in spec or 'qid' not in spec:
+            raise ValueError(f'invalid batch query {spec!r}, path and qid are required')
+        parsed_qs = {k: str(v) for k, v in (spec.get('params') or {}).items()}
+        parsed_qs['qid'] = spec['qid']
+        queries.append((spec['path'].strip('/'), parsed_qs, spec.get('output', 'csv')))
+    return queries
+
+
+def _batch_item(path, parsed_qs, output, retval=None, error=None):
+    """ build the envelope of one query of a batch from the return value of execute_query or an exception """
+    item = {'path': path, 'qid': parsed_qs['qid'], 'output': output}
+    if error is not None:
+        if isinstance(error, ServerBusyError):
+            # the client should retry the query, like a single query answered with 503 and Retry-After
+            item.update(status=503, retry_after=error.retry_after)
         else:
-            result = _execute_query_worker(path, parsed_qs)
-
-        f = io.BytesIO(result)
-
-        headers = {}
-        content_type = 'text/plain'
-        if output == 'csv':
-            result = pd.read_pickle(f, compression='gzip').to_csv()
-        elif output == 'json':
-            content_type = 'application/json'
-            result = pd.read_pickle(f, compression='gzip').to_json()
-        elif output == 'pickle':
-            content_type = 'application/python-pickle'
-            headers['Content-Encoding'] = 'gzip'
-        elif output == 'html':
-            # convert the dataframe to pretty html
-            result = pd.read_pickle(f, compression='gzip')
-            result = pretty_html_table.build_table(result.reset_index(), 'blue_light')
-            content_type = 'text/html'
-        elif output == 'fast_cache':
-            pass
+            item['status'] = 413 if isinstance(error, ResultTooLargeError) else 500
+        item['error'] = f'{type(error).__name__}: {error}'
+        return item
+    body, content_type, status = retval[:3]
+    headers = retval[3] if len(retval) == 4 else {}
+    item.update(status=status, content_type=content_type)
+    if content_type == 'application/fast_cache' or (output in TEXT_OUTPUTS + ('ndjson', ) and
+                                                     'Content-Encoding' not in headers):
+        item['body'] = body.decode('utf-8') if isinstance(body, bytes) else body
+    else:
+        item.update(body=base64.b64encode(body).decode('ascii'), body_encoding='base64')
+        if 'Content-Encoding' in headers:
+            item['content_encoding'] = headers['Content-Encoding']
+    return item
+
+
+def _batch_response(keys, results):
+    """ build the json envelope of a batch """
+    items = [results[key] for key in keys]
+    failed = sum(1 for x in items if x['status'] >= 400)
+    body = json.dumps({'results': items, 'failed': failed})
+    return body, 'application/json', 200, {'Cache-Control': 'no-cache'}
+
+
+def execute_batch(specs, nospawn=False):
+    """ execute several queries at once, fanned out over the worker pool
+
+        Args:
+            specs - list, or json list, of {"path": "example/example", "qid": "random_data", "params": {"rows": 5},
+                    "output": "csv"} objects.  params and output are optional
+            nospawn - if set to True, do not spawn separate processes
+
+        Identical queries in a batch run once.  A failing query does not fail the batch, its result has status 500
+        and an error message instead of a body, or 503 and retry_after seconds if the server was too busy for it.
+
+        Return:
+            json envelope {"results": [{path, qid, output, status, content_type, body}, ...], "failed": n},
+            content_type, return_code, headers.  Binary bodies are base64 encoded and marked with body_encoding
+    """
+    queries = _parse_batch(specs)
+    keys = [_query_key(path, parsed_qs, output) for path, parsed_qs, output in queries]
+    unique = dict(zip(keys, queries))
+
+    def run(path, parsed_qs, output):
+        try:
+            return _batch_item(path, parsed_qs, output, execute_query(path, dict(parsed_qs, output=output), nospawn))
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            return _batch_item(path, parsed_qs, output, error=e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(unique), BATCH_THREADS) or 1,
+                                               thread_name_prefix='DataHubBatch') as executor:
+        futures = {key: executor.submit(run, *query) for key, query in unique.items()}
+        results = {key: f.result() for key, f in futures.items()}
+    return _batch_response(keys, results)
+
+
+async def execute_batch_async(specs, nospawn=False):
+    """ same as execute_batch without blocking the event loop, every query of the batch takes a slot of the query
+        limiter, see execute_query_async """
+    queries = _parse_batch(specs)
+    keys = [_query_key(path, parsed_qs, output) for path, parsed_qs, output in queries]
+    unique = dict(zip(keys, queries))
+
+    async def run(path, parsed_qs, output):
+        try:
+            return _batch_item(path, parsed_qs, output,
+                               await execute_query_async(path, dict(parsed_qs, output=output), nospawn))
+        except Exception as e:
+            if not isinstance(e, ServerBusyError):
+                logging.error(traceback.format_exc())
+            return _batch_item(path, parsed_qs, output, error=e)
+
+    results = await asyncio.gather(*(run(*query) for query in unique.values()))
+    return _batch_response(keys, dict(zip(unique, results)))
+
+
+def execute_query_stream(path, parsed_qs, nospawn=False, chunk_rows=STREAM_CHUNK_ROWS):
+    """ execute a data query and return the results as an iterator of chunks
+
+        The worker writes the output into a spool file one chunk of rows at a time and the chunks are yielded as
+        soon as they are written, so memory in the server stays bounded by the chunk size if the caller sends each
+        chunk before taking the next one.
+
+        Args:
+            path - path to module to execute
+            parsed_qs - dictionary of query parameters
+            nospawn - if set to True, do not spawn a separate process
+            chunk_rows - number of rows rendered per chunk
+
+        Return:
+            (iterator of bytes, content_type, return_code, headers)
+    """
+    # get the output format
+    output = parsed_qs.pop('output', 'csv')
+    if output not in STREAMABLE_OUTPUTS:
+        raise ValueError(f'output={output} can not be streamed, use one of {", ".join(STREAMABLE_OUTPUTS)}')
+
+    fd, spool_path = tempfile.mkstemp(prefix='datahub_', suffix='.' + output)
+    os.close(fd)
+    args = (_execute_stream_worker, path, parsed_qs, output, spool_path, chunk_rows)
+    if nospawn or _WORKER_POOL is None:
+        # without a pool run the query first, then stream the spool file
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(_run(*args, nospawn=nospawn))
+        except BaseException as e:
+            future.set_exception(e)
+    else:
+        future = _WORKER_POOL.submit(*args)
 
-        f.close()
-        return result, content_type, 200, headers
+    # wait for the first chunk so errors are raised before any data is sent
+    chunks = _follow_spool(spool_path, future)
+    first = next(chunks, b'')
+    return itertools.chain([first], chunks), CONTENT_TYPES[output], 200, {}
@@ -1,22 +1,673 @@
 from functools import wraps
+import collections
+import contextlib
+import datetime
+import fcntl
 import hashlib
 import inspect
 import io
 import logging
 import os
+import threading
 import time
+from urllib.parse import quote
 import pandas as pd
 import traceback
+from DataHub import cache_index, metrics, reloader
+from DataHub.worker_pool import WorkerPool
+try:
+    import pyarrow
+    import pyarrow.feather
+except ImportError:
+    pyarrow = None
 
 
-def decode_cache_to_df(result):
+# formats which may be stored pre-rendered next to a cache entry
+VARIANT_FORMATS = ('csv', 'json')
+
+# content encodings of compressed variants, which are named by format and encoding, i.e. csv.gzip
+VARIANT_ENCODINGS = ('zstd', 'br', 'gzip')
+
+# every kind of file which may be stored next to a cache entry
+VARIANT_FILES = VARIANT_FORMATS + tuple(f'{fmt}.{encoding}' for fmt in VARIANT_FORMATS
+                                        for encoding in VARIANT_ENCODINGS)
+
+# longer cache filenames are replaced by a hash of the cache key
+MAX_FILENAME_LENGTH = 200
+
+# in process memory tier, see configure_memory_cache
+_MEMORY_CACHE = None
+
+# pools of processes fetching segments in parallel, by number of processes, see cacheable segment_workers
+_SEGMENT_POOLS = {}
+_SEGMENT_POOLS_LOCK = threading.Lock()
+
+
+class MemoryCache:
+    """ in process LRU of cache file contents keyed by cache path and bounded by total size
+
+        Entries are revalidated against the mtime of their file at most every revalidate_seconds, so an
+        updatecache in another process is picked up without a filesystem access on every hit.
+    """
+    def __init__(self, max_bytes, max_entry_bytes=None, revalidate_seconds=30):
+        """ init
+
+            Args:
+                max_bytes - total byte budget of the cached data
+                max_entry_bytes - larger entries are not kept in memory, defaults to a quarter of max_bytes
+                revalidate_seconds - how long an entry is trusted before its file mtime is checked again
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 4
+        self.revalidate_seconds = revalidate_seconds
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'rejected': 0}
+
+    def get(self, key, min_mtime=0):
+        """ return the cached bytes for a cache path, or None if missing or the file is older than min_mtime """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < min_mtime:
+                self._remove(key)
+                entry = None
+            if entry is not None and time.time() - entry[2] > self.revalidate_seconds:
+                try:
+                    mtime = os.path.getmtime(key)
+                except OSError:
+                    mtime = None
+                if mtime != entry[1]:
+                    self._remove(key)
+                    entry = None
+                else:
+                    entry[2] = time.time()
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, data):
+        """ store the bytes of a cache file, evicting the least recently used entries to stay in budget """
+        if len(data) > self.max_entry_bytes:
+            with self._lock:
+                self._stats['rejected'] += 1
+                self._remove(key)
+            return
+        try:
+            mtime = os.path.getmtime(key)
+        except OSError:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = [data, mtime, time.time()]
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def stat(self, key):
+        """ return (mtime, size) of a cached file as of its last validation, or None if it is not cached, this is not
+            counted as a hit """
+        with self._lock:
+            entry = self._entries.get(key)
+            return (entry[1], len(entry[0])) if entry is not None else None
+
+    def discard(self, key):
+        """ drop an entry if it is cached """
+        with self._lock:
+            self._remove(key)
+
+    def stats(self):
+        """ return the counters, the number of entries and the bytes in use """
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+
+def configure_memory_cache(max_mb, max_entry_mb=None, revalidate_seconds=30):
+    """ enable the in process memory tier in front of the disk cache for this process
+
+        Args:
+            max_mb - memory budget in MB, 0 to disable the memory tier
+            max_entry_mb - entries larger than this are only kept on disk, defaults to a quarter of max_mb
+            revalidate_seconds - how long an entry is trusted before its file mtime is checked again
+
+        Returns:
+            the MemoryCache or None if disabled
+    """
+    global _MEMORY_CACHE
+    _MEMORY_CACHE = None
+    if max_mb:
+        _MEMORY_CACHE = MemoryCache(int(max_mb * 1024 * 1024),
+                                    int(max_entry_mb * 1024 * 1024) if max_entry_mb is not None else None,
+                                    revalidate_seconds)
+    return _MEMORY_CACHE
+
+
+def get_memory_cache():
+    """ return the memory tier of this process, or None if it is disabled """
+    return _MEMORY_CACHE
+
+
+def _write_atomically(path, write):
+    """ call write with a temporary path and move the file into place, so readers never see a partial file """
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _entry_lock(cache_path):
+    """ hold an exclusive lock on a cache entry while it is filled so concurrent misses only run the query once """
+    lock_path = cache_path + '.lock'
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            # a waiter still blocked on the removed file and a new caller could both run the query, which only
+            # costs a duplicate query since writes are atomic
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(lock_path)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CacheResult(io.BytesIO):
+    """ gzipped pickle read from or written to the cache, remembers the path of the cache file """
+    storage = 'pickle'
+
+    def __init__(self, initial_bytes, cache_path):
+        super().__init__(initial_bytes)
+        self.cache_path = cache_path
+
+
+class CacheRef(os.PathLike):
+    """ reference to a cache entry in a columnar storage format, the data is only read by decode_cache_to_df """
+    def __init__(self, cache_path, storage):
+        self.cache_path = cache_path
+        self.storage = storage
+
+    def __fspath__(self):
+        return self.cache_path
+
+    def __repr__(self):
+        return f'CacheRef({self.cache_path!r}, {self.storage!r})'
+
+
+class PickleStorage:
+    """ gzipped pickle, hits are read fully into memory """
+    name = 'pickle'
+    extension = '.pickle.gz'
+
+    def load(self, cache_path):
+        """ return the value cacheable returns for a hit """
+        with open(cache_path, "rb") as fh:
+            return CacheResult(fh.read(), cache_path)
+
+    def store(self, df, cache_path):
+        """ write a dataframe to the cache and return the value cacheable returns """
+        bio = io.BytesIO()
+        df.to_pickle(bio, compression={'method': 'gzip', 'compresslevel': 1, 'mtime': 1})
+        bio = CacheResult(bio.getvalue(), cache_path)
+
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(bio.getvalue())
+        _write_atomically(cache_path, write)
+        return bio
+
+    def read_df(self, source, columns=None):
+        """ read a dataframe from a cache file or buffer, optionally only some columns """
+        df = pd.read_pickle(source, compression='gzip')
+        return df[columns] if columns is not None else df
+
+
+class FeatherStorage:
+    """ uncompressed Arrow IPC file, memory mapped on read so numeric columns are not copied into the process """
+    name = 'feather'
+    extension = '.arrow'
+
+    def load(self, cache_path):
+        """ return the value cacheable returns for a hit """
+        return CacheRef(cache_path, self.name)
+
+    def store(self, df, cache_path):
+        """ write a dataframe to the cache and return the value cacheable returns """
+        table = pyarrow.Table.from_pandas(df)
+        _write_atomically(cache_path, lambda path: pyarrow.feather.write_feather(table, path, compression='uncompressed'))
+        return CacheRef(cache_path, self.name)
+
+    def dumps(self, df):
+        """ return a dataframe as Arrow IPC file bytes """
+        bio = io.BytesIO()
+        pyarrow.feather.write_feather(pyarrow.Table.from_pandas(df), bio, compression='uncompressed')
+        return bio.getvalue()
+
+    def read_df(self, source, columns=None):
+        """ read a dataframe from a cache file, optionally only some columns """
+        table = pyarrow.feather.read_table(source, memory_map=True)
+        if columns is not None:
+            # keep the columns holding the index so it survives the projection
+            index_columns = [c for c in (table.schema.pandas_metadata or {}).get('index_columns', []) if isinstance(c, str)]
+            table = table.select([str(c) for c in columns] + index_columns)
+        return table.to_pandas(split_blocks=True)
+
+
+class ParquetStorage(FeatherStorage):
+    """ compressed parquet file, smaller on disk than feather but decoded on every read """
+    name = 'parquet'
+    extension = '.parquet'
+
+    def store(self, df, cache_path):
+        """ write a dataframe to the cache and return the value cacheable returns """
+        _write_atomically(cache_path, df.to_parquet)
+        return CacheRef(cache_path, self.name)
+
+    def read_df(self, source, columns=None):
+        """ read a dataframe from a cache file, optionally only some columns """
+        return pd.read_parquet(source, columns=[str(c) for c in columns] if columns is not None else None)
+
+
+STORAGE_BACKENDS = {'pickle': PickleStorage(), 'feather': FeatherStorage(), 'parquet': ParquetStorage()}
+
+
+def get_storage(name):
+    """ return the storage backend for a name, i.e. feather """
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f'unknown cache storage {name}, expected one of {", ".join(STORAGE_BACKENDS)}')
+    if name != 'pickle' and pyarrow is None:
+        raise ImportError(f'pyarrow is required for {name} cache storage')
+    return STORAGE_BACKENDS[name]
+
+
+def variant_path(cache_path, fmt):
+    """ path of a pre-rendered variant of a cache entry, i.e. fmt=csv """
+    for storage in STORAGE_BACKENDS.values():
+        if cache_path.endswith(storage.extension):
+            cache_path = cache_path[:-len(storage.extension)]
+            break
+    return cache_path + '.' + fmt
+
+
+def read_variant_path(cache_path, fmt):
+    """ return the path of a pre-rendered variant of a cache entry, or None if it is missing or older than the entry """
+    path = variant_path(cache_path, fmt)
+    try:
+        if os.path.getmtime(path) >= os.path.getmtime(cache_path):
+            return path
+    except OSError:
+        pass
+    return None
+
+
+def write_variant(cache_path, fmt, data):
+    """ store a pre-rendered variant next to a cache entry
+
+        Args:
+            cache_path - path of the cache entry
+            fmt - format of the variant, i.e. csv
+            data - rendered str or bytes
+    """
+    path = variant_path(cache_path, fmt)
+    data = data.encode('utf-8') if isinstance(data, str) else data
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+    _write_atomically(path, write)
+    if _MEMORY_CACHE is not None:
+        _MEMORY_CACHE.put(path, data)
+
+    # count the variant in the size of its entry
+    index = _get_index(os.path.dirname(os.path.dirname(cache_path)))
+    if index is not None:
+        index.add_size(cache_path, len(data))
+
+
+def entry_stat(cache_path):
+    """ return (mtime, size) of a cache file, from the memory tier if it holds the file so hits do not touch the
+        disk, or None if the file is missing """
+    if _MEMORY_CACHE is not None:
+        stat = _MEMORY_CACHE.stat(cache_path)
+        if stat is not None:
+            return stat
+    try:
+        st = os.stat(cache_path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def entry_row_count(cache_path):
+    """ return the number of rows of a cache entry from the index of its cache dir, or None if it is unknown """
+    index = _get_index(os.path.dirname(os.path.dirname(cache_path)))
+    return index.row_count(cache_path) if index is not None else None
+
+
+def _remove_variants(cache_path, formats):
+    """ remove pre-rendered variants of a cache entry which is about to be rewritten """
+    for fmt in formats:
+        path = variant_path(cache_path, fmt)
+        if _MEMORY_CACHE is not None:
+            _MEMORY_CACHE.discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def decode_cache_to_df(result, columns=None):
+    """ convert the return value of a cacheable query to a dataframe
+
+        Args:
+            result - dataframe, gzipped pickle buffer, or CacheRef
+            columns - optional list of columns to read, columnar storage only reads these from disk
+    """
+    if isinstance(result, CacheRef):
+        return get_storage(result.storage).read_df(result.cache_path, columns)
     # check if this is already a pickle
     if not isinstance(result, pd.DataFrame):
-        return pd.read_pickle(result, compression='gzip')
+        return STORAGE_BACKENDS['pickle'].read_df(result, columns)
+    return result[columns] if columns is not None else result
+
+
+def inside_lag(lag_params, lag_from_utc_now, param_defaults, kwargs):
+    """ check if any of the lag parameters falls inside the lag window
+
+        Args:
+            lag_params - list of parameters to check lag against, i.e. ["end_date"]
+            lag_from_utc_now - timedelta specifying the lag for caching
+            param_defaults - dictionary of parameter name to default value for the query function
+            kwargs - keyword arguments of the call
+
+        Returns:
+            True if the call must not be cached
+    """
+    for param_name in lag_params:
+        param_value = kwargs.get(param_name, param_defaults[param_name])
+
+        # check if we are inside the lag
+        if param_value:
+            if (pd.Timestamp.utcnow().tz_localize(None) - pd.to_datetime(param_value)) <= lag_from_utc_now:
+                return True
+    return False
+
+
+def _format_bound(ts):
+    """ format a segment bound like the dates queries are usually called with """
+    return ts.strftime('%Y-%m-%d') if ts == ts.normalize() else ts.isoformat()
+
+
+def split_range(start, end, freq='D', end_inclusive=True):
+    """ split a date range into segments aligned to periods of freq
+
+        Args:
+            start - start of the range
+            end - end of the range
+            freq - pandas period frequency, i.e. D, W, or M
+            end_inclusive - True if end is the last day included in the range, False if it is exclusive
+
+        Returns:
+            list of (start, end) strings with the same inclusiveness as the range, the first and last segments are
+            cut to the range, empty if the range is empty or can not be parsed
+    """
+    if start is None or end is None:
+        return []
+    try:
+        start = pd.Timestamp(start)
+        end = pd.Timestamp(end)
+    except (ValueError, TypeError):
+        return []
+    last = end if end_inclusive else end - pd.Timedelta(1)
+    if last < start:
+        return []
+
+    segments = []
+    for p in pd.period_range(start, last, freq=freq):
+        seg_start = max(p.start_time, start)
+        if end_inclusive:
+            seg_end = min((p + 1).start_time - pd.Timedelta(days=1), end)
+        else:
+            seg_end = min((p + 1).start_time, end)
+        segments.append((_format_bound(seg_start), _format_bound(seg_end)))
+    return segments
+
+
+def concat_segments(frames):
+    """ concatenate the dataframes of segments in order, default indexes are renumbered so the result has the index
+        the query would have had without segments, other indexes are kept """
+    if all(isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1 and df.index.name is None
+           for df in frames):
+        return pd.concat(frames, ignore_index=True)
+    return pd.concat(frames)
+
+
+def _segment_pool(workers):
+    """ return the pool of processes fetching segments for a number of processes, started on first use and kept
+        for the life of the process so its imports are only paid once """
+    with _SEGMENT_POOLS_LOCK:
+        pool = _SEGMENT_POOLS.get(workers)
+        if pool is None:
+            pool = _SEGMENT_POOLS[workers] = WorkerPool(max_workers=workers)
+        return pool
+
+
+def stop_segment_pools():
+    """ stop the processes fetching segments in parallel """
+    with _SEGMENT_POOLS_LOCK:
+        pools = list(_SEGMENT_POOLS.values())
+        _SEGMENT_POOLS.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+def _fetch_segment_worker(module, qualname, kwargs, updatecache):
+    """ worker to fetch one segment of a cacheable query, the segment is cached like a serial fetch would cache it
+
+        Returns:
+            dataframe
+    """
+    # the segment processes outlive changes of the provider, reload it like the query worker does
+    func = reloader.import_module(module)
+    for name in qualname.split('.'):
+        func = getattr(func, name)
+    return func.fetch_segment(kwargs, updatecache)
+
+
+def module_name(filename):
+    """ name of the module cache dir for the file containing the code for a query, i.e. example """
+    return os.path.splitext(os.path.split(filename)[1])[0]
+
+
+def cache_key(func_name, kwargs):
+    """ canonical key of a call, parameters are sorted by name and percent encoded so different calls never share a key
+
+        Args:
+            func_name - name of the query function
+            kwargs - keyword arguments of the call, excluding nocache and updatecache
+
+        Returns:
+            key, i.e. random_data@cols=1,rows=5
+    """
+    params = ','.join(f'{quote(str(k), safe="")}={quote(str(v), safe="")}' for k, v in sorted(kwargs.items()))
+    return func_name + '@' + params
+
+
+def build_cache_path(cache_dir, filename, func_name, kwargs, extension='.pickle.gz'):
+    """ build the path of the cache file for a call
+
+        Args:
+            cache_dir - root dir for the cache
+            filename - filename of the file containing the code for the query
+            func_name - name of the query function
+            kwargs - keyword arguments of the call, excluding nocache and updatecache
+            extension - file extension of the storage backend
+
+        Returns:
+            path of the cache file
+    """
+    cache_filename = cache_key(func_name, kwargs)
+
+    # filename too long due to parameters, switch to the hash of the key
+    if len(cache_filename) + len(extension) > MAX_FILENAME_LENGTH:
+        cache_filename = func_name + '@' + hashlib.md5(cache_filename.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, module_name(filename), cache_filename + extension)
+
+
+def cache_path_from_spec(spec, kwargs):
+    """ compute the cache path a cacheable query would read for a call without importing its module
+
+        Args:
+            spec - the cache_spec attribute of a function decorated with cacheable
+            kwargs - keyword arguments of the call, all passed by name
+
+        Returns:
+            path of the cache file, or None if the call would not read from the cache
+    """
+    kwargs = dict(kwargs)
+    if kwargs.pop('nocache', False) or kwargs.pop('updatecache', False):
+        return None
+    if spec.get('segment_params') is not None:
+        # segmented queries are assembled from several cache files
+        return None
+    if inside_lag(spec['lag_params'], spec['lag_from_utc_now'], spec['param_defaults'], kwargs):
+        return None
+    return build_cache_path(spec['cache_dir'], spec['filename'], spec['func_name'], kwargs,
+                            STORAGE_BACKENDS[spec.get('storage', 'pickle')].extension)
+
+
+def record_hit_from_spec(spec, kwargs):
+    """ count a hit of the entry of a call which was served without calling the query, i.e. by fast_cache, so the
+        least recently used entries are evicted first
+
+        Args:
+            spec - the cache_spec attribute of a function decorated with cacheable
+            kwargs - keyword arguments of the call, all passed by name
+    """
+    index = _get_index(spec['cache_dir'])
+    if index is not None:
+        index.record_hit(module_name(spec['filename']) + '/' + cache_key(spec['func_name'], kwargs))
+
+
+def _get_index(cache_dir):
+    """ return the index of a cache dir, or None if it can not be opened in which case the files are probed """
+    try:
+        return cache_index.get_index(cache_dir)
+    except Exception as e:
+        logging.error(f'unable to open the cache index of {cache_dir}: {e}')
+        return None
+
+
+def register_source(cache_dir, filename, func_name, ttl=None, invalidate_on_change=False):
+    """ record the ttl and source hash of a query in the index of its cache dir
+
+        Args:
+            cache_dir - root dir for the cache
+            filename - filename of the file containing the code for the query
+            func_name - name of the query function
+            ttl - lifetime of cache entries in seconds, None to keep them forever
+            invalidate_on_change - if True, entries written before the source last changed are stale
+
+        Returns:
+            time the source last changed, entries older than this are stale, 0 if unknown or not invalidating
+    """
+    with open(filename, 'rb') as f:
+        source_hash = hashlib.md5(f.read()).hexdigest()
+    changed_at = cache_index.get_index(cache_dir).register_query(module_name(filename), func_name, source_hash,
+                                                                  ttl, invalidate_on_change)
+    return changed_at if invalidate_on_change else 0
+
+
+def min_entry_mtime(ttl, not_before):
+    """ oldest mtime a cache entry may have to still be used
+
+        Args:
+            ttl - lifetime of cache entries in seconds, None to keep them forever
+            not_before - time the source last changed, 0 if unknown
+    """
+    if ttl is None:
+        return not_before
+    return max(not_before, time.time() - ttl)
+
+
+def is_fresh(cache_path, min_mtime=0):
+    """ check if a cache file exists and is not older than min_mtime """
+    try:
+        return os.path.getmtime(cache_path) >= min_mtime
+    except OSError:
+        return False
+
+
+def _read_cache(storage_backend, index, key, cache_path, min_mtime=0):
+    """ read a cache entry from the memory tier or disk, returns None on a miss or an expired entry """
+    if _MEMORY_CACHE is not None and storage_backend.name == 'pickle':
+        data = _MEMORY_CACHE.get(cache_path, min_mtime)
+        if data is not None:
+            if index is not None:
+                index.record_hit(key)
+            return CacheResult(data, cache_path)
+
+    # the index knows which entries exist, without an index fall back to probing the file
+    with metrics.phase('cache_lookup'):
+        if index is not None:
+            row = index.lookup(key)
+            if row is None or row[1] < min_mtime:
+                return None
+        elif not is_fresh(cache_path, min_mtime):
+            return None
+
+    logging.info(f'READING CACHE {cache_path}')
+    try:
+        with metrics.phase('cache_read'):
+            result = storage_backend.load(cache_path)
+            if not isinstance(result, io.BytesIO) and not os.path.exists(cache_path):
+                raise FileNotFoundError(cache_path)
+    except FileNotFoundError:
+        # removed behind the back of the index
+        if index is not None:
+            index.remove(key)
+        return None
+    if index is not None:
+        index.record_hit(key)
+    if _MEMORY_CACHE is not None and isinstance(result, CacheResult):
+        _MEMORY_CACHE.put(cache_path, result.getvalue())
     return result
 
 
-def cacheable(cache_dir, filename, lag_params=[], lag_from_utc_now=None):
+def _write_cache(storage_backend, index, key, func_name, cache_path, df):
+    """ write a dataframe to the cache, returns what cacheable returns or the dataframe if writing failed """
+    try:
+        logging.info(f'WRITING CACHE {cache_path}')
+        with metrics.phase('cache_write'):
+            _remove_variants(cache_path, VARIANT_FILES)
+            result = storage_backend.store(df, cache_path)
+            if index is not None:
+                index.record_write(key, cache_path, os.path.basename(os.path.dirname(cache_path)), func_name,
+                                   os.path.getsize(cache_path), row_count=len(df))
+        if _MEMORY_CACHE is not None and isinstance(result, CacheResult):
+            _MEMORY_CACHE.put(cache_path, result.getvalue())
+        logging.info(f'FINISHED WRITING CACHE {cache_path}')
+        return result
+    except Exception as e:
+        print(e)
+    return df
+
+
+def cacheable(cache_dir, filename, lag_params=[], lag_from_utc_now=None, storage='pickle', ttl=None,
+              invalidate_on_change=False, segment_params=None, segment_freq='D', segment_end_inclusive=True,
+              segment_workers=1):
     """ decorator to enable caching for data queries
 
         Additional parameters of nocache to bypass the cache and updatecache to force a cache update can
@@ -27,9 +678,107 @@ def cacheable(cache_dir, filename, lag_params=[], lag_from_utc_now=None):
             filename - filename of the file containing the code for the query, usually the __file__ variable is used
             lag_param - list of parameters to check lag aginast, i.e. ["end_date"]
             lag_from_utc_now - a timedelta specifying the lag for caching.  i.e. timedelta(days=2) means nothing within the last two days will be cached
+            storage - cache file format, pickle (gzipped, default), feather (memory mapped Arrow IPC), or parquet.
+                      Hits of columnar formats return a CacheRef, use decode_cache_to_df to read them
+            ttl - lifetime of cache entries as a timedelta or seconds, None to keep them until evicted
+            invalidate_on_change - if True, entries written before the source file last changed are not used
+            segment_params - (start, end) parameter names of a date range, i.e. ("start_date", "end_date").  Ranges
+                             are then cached in segments of segment_freq and assembled from them, so only segments
+                             which are missing or inside the lag are fetched.  The query must return the rows of
+                             exactly the range it was called with.  Segmented calls return a dataframe
+            segment_freq - pandas period frequency of the segments, i.e. D, W, or M
+            segment_end_inclusive - True if the end of the range is the last day included, False if it is exclusive
+            segment_workers - fetch the missing segments of a range in up to this many processes at once, the
+                              function must be importable by its module and name.  1 fetches them one at a time
     """
+    storage_backend = get_storage(storage)
+    if isinstance(ttl, datetime.timedelta):
+        ttl = ttl.total_seconds()
+
     def decorator(func):
         """ decorator function """
+        # the signature is only inspected once
+        sig = inspect.signature(func)
+        param_names = list(sig.parameters)
+        param_defaults = {k: sig.parameters[k].default for k in lag_params}
+        if segment_params is not None:
+            range_defaults = [sig.parameters[k].default if sig.parameters[k].default is not inspect.Parameter.empty
+                              else None for k in segment_params]
+        module = module_name(filename)
+
+        # record the ttl and source hash for the janitor, entries older than not_before are stale
+        not_before = 0
+        if ttl is not None or invalidate_on_change:
+            try:
+                not_before = register_source(cache_dir, filename, func.__name__, ttl, invalidate_on_change)
+            except Exception:
+                logging.error(traceback.format_exc())
+
+        def cached_call(kwargs, updatecache, fill=True):
+            """ return the cache entry of a call, calling func and writing the entry on a miss, or returning None
+                on a miss if fill is False """
+            cache_path = build_cache_path(cache_dir, filename, func.__name__, kwargs, storage_backend.extension)
+            key = module + '/' + cache_key(func.__name__, kwargs)
+            index = _get_index(cache_dir)
+            min_mtime = min_entry_mtime(ttl, not_before)
+            if not updatecache:
+                result = _read_cache(storage_backend, index, key, cache_path, min_mtime)
+                if result is not None:
+                    metrics.count_cache(module, func.__name__, 'hit')
+                    return result
+                if not fill:
+                    return None
+                logging.info(f'CACHE MISS {cache_path}')
+
+            # only one process fills a missing entry, the others wait for it and then read it
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with _entry_lock(cache_path):
+                if not updatecache:
+                    result = _read_cache(storage_backend, index, key, cache_path, min_mtime)
+                    if result is not None:
+                        # filled by another process while waiting for the lock
+                        metrics.count_cache(module, func.__name__, 'hit')
+                        return result
+
+                # call the real data fetch function and write the cache
+                metrics.count_cache(module, func.__name__, 'miss')
+                with metrics.phase('provider'):
+                    df = func(**kwargs)
+                return _write_cache(storage_backend, index, key, func.__name__, cache_path, df)
+
+        def fetch_segment(seg_kwargs, updatecache):
+            """ return the dataframe of one segment, from the cache unless it is inside the lag """
+            if inside_lag(lag_params, lag_from_utc_now, param_defaults, seg_kwargs):
+                metrics.count_cache(module, func.__name__, 'uncacheable')
+                with metrics.phase('provider'):
+                    return func(**seg_kwargs)
+            return decode_cache_to_df(cached_call(seg_kwargs, updatecache))
+
+        def fetch_segments(segment_kwargs, updatecache):
+            """ return the dataframes of segments in order, fetching the missing ones in parallel """
+            frames = [None] * len(segment_kwargs)
+            missing = []
+            for i, seg_kwargs in enumerate(segment_kwargs):
+                if not updatecache and not inside_lag(lag_params, lag_from_utc_now, param_defaults, seg_kwargs):
+                    result = cached_call(seg_kwargs, updatecache, fill=False)
+                    if result is not None:
+                        frames[i] = decode_cache_to_df(result)
+                        continue
+                missing.append(i)
+
+            if segment_workers > 1 and len(missing) > 1:
+                pool = _segment_pool(segment_workers)
+                with metrics.phase('provider'):
+                    futures = {i: pool.submit(_fetch_segment_worker, func.__module__, func.__qualname__,
+                                              segment_kwargs[i], updatecache) for i in missing}
+                    for i, future in futures.items():
+                        frames[i] = future.result()
+                logging.info(f'FETCHED {len(missing)} SEGMENTS IN {segment_workers} PROCESSES {func.__name__}')
+            else:
+                for i in missing:
+                    frames[i] = fetch_segment(segment_kwargs[i], updatecache)
+            return frames
+
         @wraps(func)
         def new_func(*args, **kwargs):
             """
@@ -44,86 +793,33 @@ def cacheable(cache_dir, filename, lag_params=[], lag_from_utc_now=None):
                 updatecache = kwargs.pop('updatecache', False)
 
                 # transfer args to kwargs
-                sig = inspect.signature(func)
-                param_names = list(sig.parameters)
                 for i in range(0, len(args)):
                     kwargs[param_names[i]] = args[i]
                 args = []
 
                 if not nocache or updatecache:
                     # loop through the lag_aarams
-                    cacheable = True
-                    for param_name in lag_params:
-                        param_default = sig.parameters[param_name].default
-                        param_value = kwargs.get(param_name, param_default)
+                    cacheable = not inside_lag(lag_params, lag_from_utc_now, param_defaults, kwargs)
 
-                        # check if we are inside the lag
-                        if param_value:
-                            if (pd.Timestamp.utcnow().tz_localize(None) - pd.to_datetime(param_value)) <= lag_from_utc_now:
-                                cacheable = False
+                # assemble ranges from cached segments, only the missing and lagging segments are fetched
+                if segment_params is not None and (not nocache or updatecache):
+                    segments = split_range(kwargs.get(segment_params[0], range_defaults[0]),
+                                           kwargs.get(segment_params[1], range_defaults[1]),
+                                           segment_freq, segment_end_inclusive)
+                    if segments:
+                        frames = fetch_segments([dict(kwargs, **{segment_params[0]: start, segment_params[1]: end})
+                                                 for start, end in segments], updatecache)
+                        logging.info(f'ASSEMBLED {len(frames)} SEGMENTS {func.__name__} {kwargs}')
+                        return concat_segments(frames)
 
                 # check if we can read from the cache
                 if cacheable:
-                    # build the cache_path
-                    subpath = os.path.splitext(os.path.split(filename)[1])[0]
-
-                    # build params traditional way
-                    params = []
-                    for k in sorted(kwargs.keys()):
-                        v = str(kwargs[k])
-                        for rc in '\\/?%*:|<>,;':
-                            k = k.replace(rc, '__')
-                            v = v.replace(rc, '__')
-                        params.append(f"""{k}={v}""")
-                    s = '&'.join(params)
-                    cache_filename = func.__name__ + '?' + s + ".pickle.gz"
-
-                    # check if filename is too long
-                    if len(cache_filename) > 250:
-                        # filename too long due to parameters, switch to shortened style
-                        ks = []
-                        vs = []
-                        for k in sorted(kwargs.keys()):
-                            ks.append(k)
-                            vs.append(str(kwargs[k]))
-                        param_str = ('_params=' + hashlib.md5((','.join(ks)).encode('ascii')).hexdigest() +
-                                     '_' + hashlib.md5((','.join(vs)).encode('ascii')).hexdigest())
-                        cache_filename = func.__name__ + '?' + param_str + ".pickle.gz"
-
-                    # normalize cachepath
-                    cache_path = os.path.join(cache_dir, subpath, cache_filename).replace(' ', '_').replace('&', '_').replace('?', '_')
-                    if not updatecache:
-                        if os.path.exists(cache_path):
-                            logging.info(f'READING CACHE {cache_path}')
-                            with open(cache_path, "rb") as fh:
-                                buf = io.BytesIO(fh.read())
-                            return buf
-                        else:
-                            logging.info(f'CACHE MISS {cache_path}')
+                    return cached_call(kwargs, updatecache)
 
                 # call the real data fetch function
-                st = time.time()
-                df = func(*args, **kwargs)
-
-                # write cache if needed
-                if cacheable:
-                    try:
-                        logging.info(f'WRITING CACHE {cache_path}')
-                        if not os.path.exists(os.path.dirname(cache_path)):
-                            os.makedirs(os.path.dirname(cache_path))
-                        bio = io.BytesIO()
-                        df.to_pickle(bio, compression={'method': 'gzip', 'compresslevel': 1, 'mtime': 1})
-                        bio.seek(0)
-                        with open(cache_path, 'wb') as f:
-                            f.write(bio.read())
-                        bio.seek(0)
-                        logging.info(f'FINISHED WRITING CACHE {cache_path}')
-                        return bio
-                    except Exception as e:
-                        print(e)
-
-                # success!
-                return df
+                metrics.count_cache(module, func.__name__, 'uncacheable')
+                with metrics.phase('provider'):
+                    return func(*args, **kwargs)
             except Exception as e:
                 # print the traceback
                 logging.error(traceback.format_exc())
@@ -131,5 +827,14 @@ def cacheable(cache_dir, filename, lag_params=[], lag_from_utc_now=None):
                 # call the real data fetch function
                 df = func(*args, **kwargs)
                 return df
+
+        # used by the processes fetching segments in parallel
+        new_func.fetch_segment = fetch_segment
+
+        # describe the cache layout so the server can find cache files without importing the module
+        new_func.cache_spec = {'cache_dir': cache_dir, 'filename': filename, 'func_name': func.__name__,
+                               'lag_params': list(lag_params), 'lag_from_utc_now': lag_from_utc_now, 'storage': storage,
+                               'ttl': ttl, 'not_before': not_before,
+                               'param_defaults': param_defaults, 'segment_params': segment_params}
         return new_func
     return decorator
@@ -0,0 +1,204 @@
+""" sqlite index of the entries in a DataHub cache dir """
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+INDEX_FILENAME = '.datahub_index.sqlite'
+
+# hits are counted in memory and written to the index at most this often
+HIT_FLUSH_SECONDS = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    module TEXT NOT NULL,
+    func TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    row_count INTEGER,
+    created REAL NOT NULL,
+    last_hit REAL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+CREATE INDEX IF NOT EXISTS entries_query ON entries (module, func);
+CREATE TABLE IF NOT EXISTS queries (
+    module TEXT NOT NULL,
+    func TEXT NOT NULL,
+    source_hash TEXT NOT NULL,
+    changed_at REAL NOT NULL,
+    ttl REAL,
+    invalidate_on_change INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (module, func)
+);
+"""
+
+
+# --------------------------------------------------
+#    Globals
+# --------------------------------------------------
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class CacheIndex:
+    """ index of the entries of one cache dir
+
+        Records key, path, size, creation time, last hit, and hit count of every entry, and the ttl and source hash
+        of every query, so lookups, stats, and eviction are queries instead of directory scans.  The database is
+        shared by all processes using the cache dir.
+    """
+    def __init__(self, cache_dir):
+        """ init
+
+            Args:
+                cache_dir - root dir of the cache, the index is stored in it
+        """
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, INDEX_FILENAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending_hits = {}
+        self._last_flush = time.time()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        # indexes created before row counts were recorded, another process may add the column at the same time
+        if 'row_count' not in {r[1] for r in self._conn.execute('PRAGMA table_info(entries)')}:
+            try:
+                self._conn.execute('ALTER TABLE entries ADD COLUMN row_count INTEGER')
+            except sqlite3.OperationalError:
+                pass
+
+    def close(self):
+        """ flush pending hits and close the database """
+        self.flush_hits()
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # ----- entries -----
+    def lookup(self, key):
+        """ return (path, created) of an entry, or None """
+        rows = self._execute('SELECT path, created FROM entries WHERE key = ?', (key, ))
+        return rows[0] if rows else None
+
+    def record_write(self, key, path, module, func, size, created=None, row_count=None):
+        """ add or replace an entry after its file was written """
+        self._execute('INSERT INTO entries (key, path, module, func, size, row_count, created) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                      'ON CONFLICT (key) DO UPDATE SET path = excluded.path, size = excluded.size, '
+                      'row_count = excluded.row_count, created = excluded.created',
+                      (key, path, module, func, size, row_count, time.time() if created is None else created))
+
+    def row_count(self, path):
+        """ return the number of rows of the entry of a path, or None if it is unknown """
+        rows = self._execute('SELECT row_count FROM entries WHERE path = ?', (path, ))
+        return rows[0][0] if rows else None
+
+    def add_size(self, path, size):
+        """ add the size of a file stored next to an entry, i.e. a pre-rendered variant """
+        self._execute('UPDATE entries SET size = size + ? WHERE path = ?', (size, path))
+
+    def record_hit(self, key):
+        """ count a hit, hits are written to the database in batches """
+        now = time.time()
+        with self._lock:
+            self._pending_hits[key] = (self._pending_hits.get(key, (0, 0))[0] + 1, now)
+            if now - self._last_flush < HIT_FLUSH_SECONDS:
+                return
+        self.flush_hits()
+
+    def flush_hits(self):
+        """ write the counted hits to the database """
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, {}
+            self._last_flush = time.time()
+            if pending:
+                self._conn.executemany('UPDATE entries SET hits = hits + ?, last_hit = ? WHERE key = ?',
+                                       [(n, t, k) for k, (n, t) in pending.items()])
+
+    def remove(self, key):
+        """ remove an entry from the index, the file is not touched """
+        self._execute('DELETE FROM entries WHERE key = ?', (key, ))
+
+    def paths(self):
+        """ return the set of paths of all entries """
+        return {r[0] for r in self._execute('SELECT path FROM entries')}
+
+    # ----- queries -----
+    def register_query(self, module, func, source_hash, ttl, invalidate_on_change):
+        """ record the ttl and source hash of a query
+
+            Returns:
+                time the source last changed, 0 if it never changed since it was first registered
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute('SELECT source_hash, changed_at FROM queries WHERE module = ? AND func = ?',
+                                          (module, func)).fetchall()
+                changed_at = rows[0][1] if rows else 0
+                if rows and rows[0][0] != source_hash:
+                    changed_at = time.time()
+                self._conn.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?, ?)',
+                                   (module, func, source_hash, changed_at, ttl, int(bool(invalidate_on_change))))
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return changed_at
+
+    # ----- eviction and stats -----
+    def expired(self, now=None, max_age=None):
+        """ return (key, path, size) of entries past their query's ttl, written before their query's source changed,
+            or older than max_age seconds """
+        now = time.time() if now is None else now
+        return self._execute(
+            'SELECT e.key, e.path, e.size FROM entries e LEFT JOIN queries q ON e.module = q.module AND e.func = q.func '
+            'WHERE (q.ttl IS NOT NULL AND e.created < ? - q.ttl) '
+            'OR (q.invalidate_on_change AND e.created < q.changed_at) '
+            'OR (? IS NOT NULL AND e.created < ? - ?)', (now, max_age, now, max_age))
+
+    def least_recently_used(self):
+        """ return (last_used, key, path, size) of all entries, least recently used first """
+        return self._execute('SELECT COALESCE(last_hit, created), key, path, size FROM entries '
+                             'ORDER BY COALESCE(last_hit, created)')
+
+    def stats(self):
+        """ return entries, bytes, and hits per module and query """
+        self.flush_hits()
+        rows = self._execute('SELECT module, func, COUNT(*), SUM(size), SUM(hits) FROM entries GROUP BY module, func')
+        return [{'module': r[0], 'func': r[1], 'entries': r[2], 'bytes': r[3], 'hits': r[4]} for r in rows]
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def get_index(cache_dir):
+    """ return the index of a cache dir for this process, opening it on first use """
+    key = (os.getpid(), os.path.abspath(cache_dir))
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is None:
+            index = CacheIndex(cache_dir)
+            _INDEXES[key] = index
+            atexit.register(index.flush_hits)
+        return index
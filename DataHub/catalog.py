@@ -0,0 +1,235 @@
+""" catalog of the provider modules under a module path, used to render docs pages without importing modules """
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+# modules which could not be described are tried again after this many seconds even if their source did not change,
+# i.e. after a database which was down at import is back
+ERROR_RETRY_SECONDS = 10
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def describe_module(m):
+    """ describe a provider module
+
+        Args:
+            m - imported module
+
+        Returns:
+            dictionary with the module doc and a list of queries, each with name, signature, doc, and examples
+    """
+    queries = []
+    for name in sorted(dir(m)):
+        if name.startswith('_'):
+            continue
+        try:
+            func = getattr(m, name)
+            if not inspect.isfunction(func) or func.__module__ != m.__name__:
+                continue
+            signature = str(inspect.signature(func))
+        except Exception:
+            # don't include if there are problems
+            continue
+        docs = func.__doc__
+        examples = []
+        for x in (docs or '').split('\n'):
+            if 'Example Query: ' in x:
+                examples.append(x.partition('Example Query:')[2].strip())
+        queries.append({'name': name, 'signature': signature, 'doc': docs, 'examples': examples})
+    return {'doc': m.__doc__, 'queries': queries}
+
+
+def module_name(path):
+    """ dotted module name of a path relative to the module path, i.e. example/example to example.example """
+    return path.strip('/').replace('/', '.')
+
+
+def module_paths(modulepath):
+    """ return the paths of all modules and packages under a module path, i.e. ['example', 'example/example'] """
+    paths = []
+    for root, dirs, files in os.walk(modulepath):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not d.startswith('_'))
+        rel = os.path.relpath(root, modulepath)
+        rel = '' if rel == '.' else rel
+        paths.extend(os.path.join(rel, x) for x in dirs)
+        paths.extend(os.path.join(rel, x[:-3]) for x in sorted(files)
+                     if x.endswith('.py') and not x.startswith('.') and not x.startswith('_'))
+    return paths
+
+
+def make_etag(body):
+    """ strong etag of a response body """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+def etag_matches(etag, if_none_match):
+    """ check if an If-None-Match header, possibly None or a list of etags, matches an etag """
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [x.strip() for x in if_none_match.split(',')]
+
+
+def _auth_tail(authuser, authtoken, callerid):
+    """ query string tail which passes the authentication parameters on to links """
+    tail = ''
+    if authuser != '':
+        tail = tail + f'&authuser={authuser}'
+    if authtoken != '':
+        tail = tail + f'&authtoken={authtoken}'
+    if callerid != '':
+        tail = tail + f'&callerid={callerid}'
+    return tail
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class ModuleCatalog:
+    """ docstrings, queries, signatures, and example queries of the provider modules under a module path
+
+        Modules are described by a describe function, usually running in a worker process, and the descriptions
+        are kept until the source file of a module changes, errors only for ERROR_RETRY_SECONDS.  Checking a page
+        only costs a stat per module.
+    """
+    def __init__(self, modulepath, describe):
+        """ init
+
+            Args:
+                modulepath - system path to the modules
+                describe - function taking a list of dotted module names and returning a dictionary of module name
+                           to describe_module output, or to {'error': message} if the module can not be imported
+        """
+        self.modulepath = modulepath
+        self.describe = describe
+        self._lock = threading.Lock()
+        self._modules = {}
+
+    def _source_mtime(self, path):
+        """ mtime of the source of a module path, None if it is not a module """
+        full = os.path.join(self.modulepath, path)
+        for fn in (full + '.py', os.path.join(full, '__init__.py'), full):
+            try:
+                return os.path.getmtime(fn)
+            except OSError:
+                pass
+        return None
+
+    def get(self, paths):
+        """ return the descriptions of module paths, describing the ones which are new or changed
+
+            Args:
+                paths - list of module paths relative to the module path, i.e. ['example/example']
+
+            Returns:
+                dictionary of path to description, paths which are not modules are left out
+        """
+        result = {}
+        stale = {}
+        now = time.monotonic()
+        with self._lock:
+            for path in paths:
+                mtime = self._source_mtime(path)
+                if mtime is None:
+                    continue
+                entry = self._modules.get(path)
+                if entry is not None and entry[0] == mtime and (entry[2] is None or now < entry[2]):
+                    result[path] = entry[1]
+                else:
+                    stale[path] = mtime
+
+        # describe all changed modules in one go, errors may be transient so they are retried after a while
+        if stale:
+            described = self.describe([module_name(p) for p in stale])
+            retry_at = time.monotonic() + ERROR_RETRY_SECONDS
+            with self._lock:
+                for path, mtime in stale.items():
+                    desc = described.get(module_name(path), {'error': 'not described'})
+                    self._modules[path] = (mtime, desc, retry_at if 'error' in desc else None)
+                    result[path] = desc
+        return result
+
+    def children(self, path):
+        """ return the module paths listed in a directory of the module path """
+        paths = []
+        for x in sorted(os.listdir(os.path.join(self.modulepath, path))):
+            if not x.startswith('.') and not x.startswith('_'):
+                if x.endswith('.py'):
+                    x = x[:-3]
+                elif not os.path.isdir(os.path.join(self.modulepath, path, x)):
+                    continue
+                paths.append(os.path.join(path, x))
+        return paths
+
+    def refresh(self):
+        """ describe every module under the module path, used to build the catalog at startup """
+        return self.get(module_paths(self.modulepath))
+
+    def to_json(self):
+        """ return the catalog of all described modules as json """
+        with self._lock:
+            modules = {'/' + path: desc for path, (_, desc, _) in sorted(self._modules.items())}
+        return json.dumps(modules, indent=1)
+
+    def render(self, host, path, authuser, authtoken, callerid):
+        """ render the html docs page of a module or the listing of a directory
+
+            Returns:
+                html
+        """
+        # add style sheet
+        parts = ['<head><link rel="stylesheet" href="/style.css"></head>',
+                 f'<h1><a href="/">DataHub Information</a></h1><pre class=path>Path: /{path}</pre><hr>']
+        tail = _auth_tail(authuser, authtoken, callerid)
+
+        # check if we are loading a python file
+        if not os.path.exists(os.path.join(self.modulepath, path) + '.py'):
+            # does not exist, so build a directory listing
+            children = self.children(path)
+            modules = self.get(children)
+            for x in children:
+                desc = modules.get(x)
+                if desc is None or 'error' in desc:
+                    continue
+                parts.append(f'<div class=divmodule><h4>/{x}</h4>')
+                if desc['doc']:
+                    parts.append(f'<pre class=doc>{desc["doc"]}</pre>')
+                aref = 'http://' + os.path.join(host, x) + (('?' + tail[1:]) if tail else '')
+                parts.append(f'<a class=a href={aref}>{aref}</a>')
+                parts.append('<hr></div>')
+            return ''.join(parts)
+
+        desc = self.get([path])[path]
+        if 'error' in desc:
+            raise ImportError(desc['error'])
+
+        # build the html doc string, queries without documentation are called out at the top
+        for q in desc['queries']:
+            name = q['name']
+            if q['doc'] is None:
+                parts.insert(0, f'<div style="color: red; height:200px; background-color: pink; font-size: 40px;">Error!  No documentation found for {name}.<br>This is not OK</div>')
+                continue
+            doc_lines = []
+            for x in q['doc'].split('\n'):
+                if 'Example Query: ' in x:
+                    aref = x.partition('Example Query:')[2].strip()
+                    aref = f"http://{host}/{path}?qid={name}{aref}{tail}"
+                    x = f'<a href={aref}>{aref}</a>'
+                doc_lines.append(x)
+            parts.append(f'<div class=divmodule><h4>/{path + "?qid=" + name}</h4>')
+            parts.append(f'<pre class=doc>{chr(10).join(doc_lines)}</pre></div><hr>')
+        return ''.join(parts)
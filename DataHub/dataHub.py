@@ -3,12 +3,18 @@
 #    Imports
 # --------------------------------------------------
 import argparse
+import asyncio
 import logging
 import os
 import sys
+import threading
 import traceback
 from urllib.parse import urlparse, parse_qs
 import DataHub.business_logic as business_logic
+import DataHub.cache as cache
+import DataHub.janitor as janitor
+import DataHub.metrics as metrics
+import DataHub.warm as warm
 from pylinkjs.PyLinkJS import run_pylinkjs_app
 
 
@@ -16,6 +22,125 @@ from pylinkjs.PyLinkJS import run_pylinkjs_app
 #    Constants
 # --------------------------------------------------
 DEFAULT_PORT = 9151
+DEFAULT_WORKERS = 4
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+# --------------------------------------------------
+#    Helpers
+# --------------------------------------------------
+def _request_handler(args):
+    """ return the tornado RequestHandler passed along with the request by pylinkjs, or None """
+    for a in args:
+        if hasattr(a, 'flush') and hasattr(a, 'set_header'):
+            return a
+    return None
+
+
+def _request_headers(args):
+    """ return the headers of the request, empty if the request handler is not available """
+    handler = _request_handler(args)
+    try:
+        return handler.request.headers
+    except AttributeError:
+        return {}
+
+
+def _request_header(args, name):
+    """ return a header of the request, or None if it is missing or the request handler is not available """
+    return _request_headers(args).get(name)
+
+
+def _parse_request(uri):
+    """ split the query string of a request into the query parameters and the parameters DataHub handles itself
+
+        Returns:
+            qid, parsed_qs, authuser, authtoken, callerid, nospawn, stream
+    """
+    # retrieve the qid, auithuser, authtoken, and callerid
+    parsed_url = urlparse(uri)
+    parsed_qs = parse_qs(parsed_url.query)
+    qid = parsed_qs.get('qid', [''])[0]
+
+    # retrieve security tokens
+    authuser = parsed_qs.pop('authuser', [''])[0]
+    authtoken = parsed_qs.pop('authtoken', [''])[0]
+    callerid = parsed_qs.pop('callerid', [''])[0]
+    nospawn = parsed_qs.pop('nospawn', [''])[0] not in ['', '0']
+    stream = parsed_qs.pop('stream', [''])[0] not in ['', '0']
+
+    parsed_qs = {k:v[0] for k, v in parsed_qs.items()}
+    stream = stream or parsed_qs.get('output') in business_logic.STREAM_OUTPUTS
+    return qid, parsed_qs, authuser, authtoken, callerid, nospawn, stream
+
+
+def _batch_specs(parsed_qs, args):
+    """ return the json specs of a batch request, from the specs parameter or else the body of the request """
+    if 'specs' in parsed_qs:
+        return parsed_qs['specs']
+    handler = _request_handler(args)
+    body = getattr(getattr(handler, 'request', None), 'body', b'')
+    if not body:
+        raise ValueError('a batch needs a specs parameter or a json body with the list of queries')
+    return body
+
+
+def _with_headers(retval):
+    """ add the headers to a result of execute_query which has none """
+    if len(retval) == 4:
+        return retval
+    html, content_type, return_code = retval
+    return (html, content_type, return_code, {})
+
+
+def _execute_query(path, parsed_qs, nospawn, args):
+    """ execute a query, the whole result is returned since writes of a blocking handler are only buffered """
+    return _with_headers(business_logic.execute_query(path, parsed_qs, nospawn, _request_headers(args)))
+
+
+async def _execute_query_async(path, parsed_qs, nospawn, args):
+    """ same as _execute_query without blocking the event loop, large results on disk are written to the client in
+        chunks if the request handler is available """
+    handler = _request_handler(args)
+    retval = _with_headers(await business_logic.execute_query_async(path, parsed_qs, nospawn, _request_headers(args),
+                                                                    stream_large=handler is not None))
+    if isinstance(retval[0], business_logic.FileChunks):
+        return await _write_stream_async(handler, iter(retval[0]), *retval[1:])
+    return retval
+
+
+async def _write_stream_async(handler, chunks, content_type, return_code, headers):
+    """ write chunks directly to the client, tornado uses chunked transfer encoding since no length is set
+
+        Chunks are read in a thread and every flush is awaited, so at most one chunk is buffered in the server.
+    """
+    loop = asyncio.get_running_loop()
+    handler.set_status(return_code)
+    handler.set_header('Content-Type', content_type)
+    for k, v in headers.items():
+        handler.set_header(k, v)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            handler.write(chunk)
+            await handler.flush()
+    except Exception:
+        # headers are already sent, all that can be done is to cut the response short
+        logging.error(traceback.format_exc())
+    return ('', content_type, return_code, headers)
+
+
+async def _stream_async(path, parsed_qs, nospawn, args):
+    """ stream the results of a query without blocking the event loop """
+    loop = asyncio.get_running_loop()
+    chunks, content_type, return_code, headers = await loop.run_in_executor(
+        None, business_logic.execute_query_stream, path, parsed_qs, nospawn)
+    handler = _request_handler(args)
+    if handler is None:
+        return (await loop.run_in_executor(None, b''.join, chunks), content_type, return_code, headers)
+    return await _write_stream_async(handler, chunks, content_type, return_code, headers)
 
 
 # --------------------------------------------------
@@ -40,34 +165,80 @@ def handle_404(path, uri, host, extra_settings, *args):
         Returns:
             result, content_type, return_code
     """
-    # retrieve the qid, auithuser, authtoken, and callerid
-    parsed_url = urlparse(uri)
-    parsed_qs = parse_qs(parsed_url.query)
-    qid = parsed_qs.get('qid', '')
+    qid, parsed_qs, authuser, authtoken, callerid, nospawn, stream = _parse_request(uri)
+    try:
+        # the catalog of all modules as json, and the metrics for prometheus
+        if path.strip('/') == '_catalog':
+            return business_logic.catalog_json(extra_settings['modulepath'], _request_header(args, 'If-None-Match'))
+        if path.strip('/') == 'metrics':
+            return (business_logic.metrics_text(), METRICS_CONTENT_TYPE, 200, {})
 
-    # retrieve security tokens
-    authuser = parsed_qs.pop('authuser', [''])[0]
-    authtoken = parsed_qs.pop('authtoken', [''])[0]
-    callerid = parsed_qs.pop('callerid', [''])[0]
-    nospawn = parsed_qs.pop('nospawn', [''])[0]
+        # many queries in one request
+        if path.strip('/') == '_batch':
+            return business_logic.execute_batch(_batch_specs(parsed_qs, args), nospawn)
 
-    try:
         # check if the qid parameter was passed in
         if qid == '':
             # try to display the html docs for the module
-            html, content_type, return_code = business_logic.build_html_docs(host, path, extra_settings['modulepath'],
-                                                                             authuser, authtoken, callerid)
-            return (html, content_type, return_code)
+            return business_logic.build_html_docs(host, path, extra_settings['modulepath'], authuser, authtoken,
+                                                  callerid, _request_header(args, 'If-None-Match'))
         else:
+            # the query results are rendered in chunks, but without awaiting the flushes tornado would buffer all of
+            # them anyway, so they are sent as one body, run with --async to send them as they are rendered
+            if stream:
+                chunks, content_type, return_code, headers = business_logic.execute_query_stream(path, parsed_qs, nospawn)
+                return (b''.join(chunks), content_type, return_code, headers)
+
             # execute the query
-            parsed_qs = {k:v[0] for k, v in parsed_qs.items()}
-            retval = business_logic.execute_query(path, parsed_qs, nospawn not in ['', '0'])
-            if len(retval) == 4:
-                html, content_type, return_code, headers = retval
-            else:
-                html, content_type, return_code = retval
-                headers = {}
-            return (html, content_type, return_code, headers)
+            return _execute_query(path, parsed_qs, nospawn, args)
+    except business_logic.ResultTooLargeError as e:
+        return (str(e), 'text/plain', 413, {})
+    except:
+        html = f'<pre>{traceback.format_exc()}</pre>'
+        return (html, 'text/html', 500)
+
+
+async def handle_404_async(path, uri, host, extra_settings, *args):
+    """ same as handle_404, but awaits the workers so slow queries do not block the event loop
+
+        Queries are subject to the limits set by business_logic.configure_query_limits, a full queue is answered
+        with 503 and a Retry-After header.
+    """
+    qid, parsed_qs, authuser, authtoken, callerid, nospawn, stream = _parse_request(uri)
+    loop = asyncio.get_running_loop()
+    try:
+        # the catalog of all modules as json, and the metrics for prometheus
+        if path.strip('/') == '_catalog':
+            return await loop.run_in_executor(None, business_logic.catalog_json, extra_settings['modulepath'],
+                                              _request_header(args, 'If-None-Match'))
+        if path.strip('/') == 'metrics':
+            return (business_logic.metrics_text(), METRICS_CONTENT_TYPE, 200, {})
+
+        # many queries in one request
+        if path.strip('/') == '_batch':
+            return await business_logic.execute_batch_async(_batch_specs(parsed_qs, args), nospawn)
+
+        # check if the qid parameter was passed in
+        if qid == '':
+            # try to display the html docs for the module
+            return await loop.run_in_executor(None, business_logic.build_html_docs, host, path,
+                                              extra_settings['modulepath'], authuser, authtoken, callerid,
+                                              _request_header(args, 'If-None-Match'))
+
+        # stream the query results in chunks
+        if stream:
+            limiter = business_logic.get_query_limiter()
+            if limiter is None:
+                return await _stream_async(path, parsed_qs, nospawn, args)
+            async with limiter:
+                return await _stream_async(path, parsed_qs, nospawn, args)
+
+        # execute the query
+        return await _execute_query_async(path, parsed_qs, nospawn, args)
+    except business_logic.ServerBusyError as e:
+        return (str(e), 'text/plain', 503, {'Retry-After': str(e.retry_after)})
+    except business_logic.ResultTooLargeError as e:
+        return (str(e), 'text/plain', 413, {})
     except:
         html = f'<pre>{traceback.format_exc()}</pre>'
         return (html, 'text/html', 500)
@@ -82,6 +253,50 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, help="port to run on", default=DEFAULT_PORT, required=False)
     parser.add_argument("--modulepath", help="location of additional modules", default=default_provider_path, required=False)
+    parser.add_argument("--workers", type=int, help="number of warm worker processes for queries, 0 to spawn a process per request",
+                        default=DEFAULT_WORKERS, required=False)
+    parser.add_argument("--worker-max-tasks", type=int, help="recycle a worker after this many queries, 0 to never recycle",
+                        default=0, required=False)
+    parser.add_argument("--worker-max-rss-mb", type=int, help="recycle a worker when it grows beyond this many MB, 0 to disable",
+                        default=0, required=False)
+    parser.add_argument("--preload", action="store_true", help="import every provider module when a worker starts",
+                        default=False, required=False)
+    parser.add_argument("--watch-interval", type=float, help="seconds between checks of the module path for changed "
+                        "modules, which roll the workers, 0 to check the module of every query instead",
+                        default=0, required=False)
+    parser.add_argument("--query-timeout", type=float, help="seconds a query may run before its worker is killed",
+                        default=None, required=False)
+    parser.add_argument("--memory-cache-mb", type=float, help="size of the in memory cache tier per process, 0 to disable",
+                        default=0, required=False)
+    parser.add_argument("--memory-cache-entry-mb", type=float, help="cache entries larger than this stay on disk only",
+                        default=None, required=False)
+    parser.add_argument("--cache-dir", action="append", help="cache dir managed by the janitor, can be repeated",
+                        default=[], required=False)
+    parser.add_argument("--cache-quota-mb", type=float, help="total size allowed for the managed cache dirs, 0 for no quota",
+                        default=0, required=False)
+    parser.add_argument("--cache-max-age-hours", type=float, help="remove cache entries older than this many hours",
+                        default=None, required=False)
+    parser.add_argument("--janitor-interval", type=float, help="seconds between janitor passes over the cache dirs",
+                        default=300, required=False)
+    parser.add_argument("--async", action="store_true", help="await queries on the event loop instead of blocking it, "
+                        "requires a pylinkjs which awaits coroutine results of on_404", default=False, required=False)
+    parser.add_argument("--max-concurrent-queries", type=int, help="queries the async handler runs at once, 0 for no limit",
+                        default=0, required=False)
+    parser.add_argument("--max-queued-queries", type=int, help="queries allowed to wait for a slot before 503 is returned",
+                        default=100, required=False)
+    parser.add_argument("--busy-retry-after", type=int, help="seconds in the Retry-After header of 503 responses",
+                        default=5, required=False)
+    parser.add_argument("--max-result-rows", type=int, help="rows a query result may have, larger results get 413, "
+                        "0 for no limit", default=0, required=False)
+    parser.add_argument("--max-result-mb", type=float, help="size a query result may have, larger results get 413, "
+                        "0 for no limit", default=0, required=False)
+    parser.add_argument("--spill-mb", type=float, help="results of at least this size are handed over by the workers "
+                        "in a temporary file, and sent in chunks with --async, 0 to disable", default=business_logic.SPILL_BYTES / 1024 / 1024,
+                        required=False)
+    parser.add_argument("--server-timing", action="store_true", help="add Server-Timing headers with the phase timings of queries",
+                        default=False, required=False)
+    parser.add_argument("--warm-config", help="config file of queries to prewarm at their scheduled times, see DataHub.warm",
+                        default=None, required=False)
     args = vars(parser.parse_args())
     print(args)
 
@@ -92,7 +307,46 @@ def main():
     # run the application
     logging.basicConfig(level=logging.DEBUG, format='%(relativeCreated)6d %(threadName)s %(message)s')
 
-    run_pylinkjs_app(default_html='this_should_never_exist', on_404=handle_404, port=args['port'],
+    # limit the size of results, before the workers start so they use the limits too
+    business_logic.configure_result_limits(args['max_result_rows'], int(args['max_result_mb'] * 1024 * 1024),
+                                           int(args['spill_mb'] * 1024 * 1024))
+
+    # start the warm worker processes, the memory cache tier is also used by nospawn queries in this process
+    cache.configure_memory_cache(args['memory_cache_mb'], args['memory_cache_entry_mb'])
+    if args['workers'] > 0:
+        business_logic.start_worker_pool(args['modulepath'], max_workers=args['workers'],
+                                         max_tasks_per_worker=args['worker_max_tasks'],
+                                         max_rss_mb=args['worker_max_rss_mb'], task_timeout=args['query_timeout'],
+                                         memory_cache_mb=args['memory_cache_mb'],
+                                         memory_cache_entry_mb=args['memory_cache_entry_mb'],
+                                         preload=args['preload'], check_mtimes=not args['watch_interval'])
+
+        # deploy by copy, changed modules roll the workers so queries never wait on an import or a stat
+        if args['watch_interval']:
+            business_logic.start_module_watcher(args['modulepath'], args['watch_interval'])
+
+    metrics.configure_server_timing(args['server_timing'])
+
+    # limit the queries the async handler runs at once, the rest queue or are turned away with 503
+    business_logic.configure_query_limits(args['max_concurrent_queries'], args['max_queued_queries'],
+                                          args['busy_retry_after'])
+
+    # build the module catalog in the background so the first docs page does not have to
+    threading.Thread(target=business_logic.get_catalog(args['modulepath']).refresh, name='DataHubCatalog',
+                     daemon=True).start()
+
+    # clean the cache dirs in the background
+    if args['cache_dir']:
+        janitor.CacheJanitor(args['cache_dir'], quota_mb=args['cache_quota_mb'],
+                             max_age_hours=args['cache_max_age_hours'], interval=args['janitor_interval'])
+
+    # refresh the cache entries of known expensive queries off peak
+    if args['warm_config']:
+        jobs, settings = warm.load_config(args['warm_config'])
+        warm.WarmScheduler(jobs, int(settings.get('concurrency', warm.DEFAULT_CONCURRENCY)))
+
+    on_404 = handle_404_async if args['async'] else handle_404
+    run_pylinkjs_app(default_html='this_should_never_exist', on_404=on_404, port=args['port'],
                      extra_settings={'modulepath': args['modulepath']})
 
 
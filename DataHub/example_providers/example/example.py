@@ -4,8 +4,8 @@
 import configparser
 import datetime
 import os
-import random
 import time
+import numpy as np
 import pandas as pd
 from DataHub.cache import cacheable
 
@@ -20,6 +20,22 @@ if os.path.isfile(CONFIG_FILE):
     CONFIG.read(CONFIG_FILE)
 
 
+# --------------------------------------------------
+#    Synthetic Columns
+# --------------------------------------------------
+_WORDS = np.array(['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel'], dtype=object)
+_EPOCH = np.datetime64('2024-01-01T00:00:00', 's')
+
+# functions of a random generator and a number of rows returning an array for each synthetic column type
+_SYNTHETIC_COLUMNS = {
+    'int': lambda rng, n: rng.integers(0, 1000, size=n, endpoint=True),
+    'float': lambda rng, n: rng.random(n),
+    'str': lambda rng, n: _WORDS[rng.integers(0, len(_WORDS), size=n)],
+    'bool': lambda rng, n: rng.random(n) < 0.5,
+    'datetime': lambda rng, n: _EPOCH + rng.integers(0, 366 * 86400, size=n).astype('timedelta64[s]'),
+}
+
+
 # --------------------------------------------------
 #    Queries
 # --------------------------------------------------
@@ -58,15 +74,9 @@ Example Output
 
     cols = int(cols)
     rows = int(rows)
-    data = []
-    for _ in range(0, rows):
-        r = []
-        for _ in range(0, cols):
-            r.append(random.randint(0, 1000))
-        data.append(r)
 
-    # convert to dataframe
-    df = pd.DataFrame(data)
+    # build the whole block at once, a python loop per value dominates the time of large queries
+    df = pd.DataFrame(np.random.default_rng().integers(0, 1000, size=(rows, cols), endpoint=True))
 
     # show process id to prove we are running in different processes
     df['pid'] = os.getpid()
@@ -78,6 +88,49 @@ Example Output
     return df
 
 
+def synthetic_data(rows=1000, cols=10, dtypes='int,float,str,bool,datetime', latency=0, seed=None):
+    """
+return a dataframe of synthetic data for load testing, built without python loops so large frames measure
+DataHub instead of the provider
+
+Params:
+    rows - number of rows
+    cols - number of columns
+    dtypes - comma separated types of the columns, repeated if there are more columns than types,
+             any of int, float, str, bool, datetime
+    latency - seconds to sleep before returning, to simulate a slow data source
+    seed - seed of the random generator for repeatable data, random if not given
+
+CSV Output
+Example Query: &output=csv&rows=2&cols=5&seed=1
+
+Only floats, with half a second of latency
+Example Query: &output=html&rows=5&cols=3&dtypes=float&latency=0.5
+
+Example Output
+    ,int_0,float_1,str_2,bool_3,datetime_4
+    0,473,0.9504636963259353,golf,True,2024-04-09 23:31:10
+    1,512,0.14415961271963373,hotel,True,2024-10-29 22:32:22
+    """
+    rows = int(rows)
+    cols = int(cols)
+    dtypes = [x.strip() for x in dtypes.split(',') if x.strip()]
+    unknown = set(dtypes) - set(_SYNTHETIC_COLUMNS)
+    if unknown or not dtypes:
+        raise ValueError(f'unknown dtypes {", ".join(sorted(unknown))}, expected any of {", ".join(_SYNTHETIC_COLUMNS)}')
+    rng = np.random.default_rng(None if seed is None else int(seed))
+
+    data = {}
+    for i in range(cols):
+        dtype = dtypes[i % len(dtypes)]
+        data[f'{dtype}_{i}'] = _SYNTHETIC_COLUMNS[dtype](rng, rows)
+    df = pd.DataFrame(data, index=pd.RangeIndex(rows))
+
+    if float(latency) > 0:
+        time.sleep(float(latency))
+    return df
+
+
 def random_data_date(start_date, end_date):
     """
 random_data_date
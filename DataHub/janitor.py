@@ -0,0 +1,157 @@
+""" background janitor for the DataHub cache, enforces ttls, source invalidation, and the size quota """
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import contextlib
+import logging
+import os
+import threading
+import time
+import traceback
+from DataHub import cache, cache_index
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+# files missing from the index, i.e. temporary files of writers which died, are removed after this many seconds
+STALE_TMP_SECONDS = 3600
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def _remove(path, size, stats, reason):
+    """ remove a cache file and count it """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    logging.info(f'JANITOR REMOVED {reason} {path}')
+    stats['removed'] += 1
+    stats['freed_bytes'] += size
+
+
+def _remove_entry(index, key, path, size, stats, reason):
+    """ remove a cache entry, its pre-rendered variants, and its index record """
+    _remove(path, size, stats, reason)
+    for fmt in cache.VARIANT_FILES:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(cache.variant_path(path, fmt))
+    index.remove(key)
+
+
+def clean_cache(cache_dirs, quota_bytes=0, max_age=None, now=None):
+    """ make one pass over the indexes of cache dirs
+
+        Removes entries past their query's ttl or written before the last source change of their query, and entries
+        older than max_age.  Then, if the remaining entries are larger than quota_bytes, removes the least recently
+        used entries until they fit.
+
+        Args:
+            cache_dirs - list of cache root dirs, i.e. ['/srv/DataHub_Cache']
+            quota_bytes - total size allowed for all cache dirs together, 0 for no quota
+            max_age - maximum age in seconds of any entry, None for no limit
+            now - current time, defaults to time.time()
+
+        Returns:
+            dictionary of stats, removed, freed_bytes, and remaining_bytes
+    """
+    now = time.time() if now is None else now
+    stats = {'removed': 0, 'freed_bytes': 0, 'remaining_bytes': 0}
+    remaining = []
+    for cache_dir in cache_dirs:
+        if not os.path.isdir(cache_dir):
+            continue
+        index = cache_index.get_index(cache_dir)
+        for key, path, size in index.expired(now, max_age):
+            _remove_entry(index, key, path, size, stats, 'EXPIRED')
+        remaining.extend((last_used, key, path, size, index) for last_used, key, path, size in index.least_recently_used())
+
+    # evict the least recently used entries until the quota is met
+    total = sum(x[3] for x in remaining)
+    if quota_bytes and total > quota_bytes:
+        for _, key, path, size, index in sorted(remaining, key=lambda x: x[0]):
+            if total <= quota_bytes:
+                break
+            _remove_entry(index, key, path, size, stats, 'QUOTA')
+            total -= size
+    stats['remaining_bytes'] = total
+    return stats
+
+
+def sweep_orphans(cache_dirs, now=None):
+    """ remove files in cache dirs which are not in the index, i.e. leftover temporary files or entries written before
+        the index existed, once they are older than STALE_TMP_SECONDS
+
+        This is the only janitor task which scans directories, so it runs much less often than clean_cache.
+
+        Returns:
+            dictionary of stats, removed and freed_bytes
+    """
+    now = time.time() if now is None else now
+    stats = {'removed': 0, 'freed_bytes': 0}
+    for cache_dir in cache_dirs:
+        if not os.path.isdir(cache_dir):
+            continue
+        # the index holds the paths as the queries spelled their cache dir, which may differ from this one
+        known = set()
+        for path in cache_index.get_index(cache_dir).paths():
+            known.add(os.path.realpath(path))
+            known.update(os.path.realpath(cache.variant_path(path, fmt)) for fmt in cache.VARIANT_FILES)
+        for module_dir in os.scandir(cache_dir):
+            if not module_dir.is_dir():
+                continue
+            for entry in os.scandir(module_dir.path):
+                if not entry.is_file() or entry.name.endswith('.lock') or os.path.realpath(entry.path) in known:
+                    continue
+                st = entry.stat()
+                if now - st.st_mtime > STALE_TMP_SECONDS:
+                    _remove(entry.path, st.st_size, stats, 'ORPHAN')
+    return stats
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class CacheJanitor:
+    """ background thread which periodically cleans cache dirs without blocking requests """
+    def __init__(self, cache_dirs, quota_mb=0, max_age_hours=None, interval=300, sweep_every=12):
+        """ init
+
+            Args:
+                cache_dirs - list of cache root dirs to manage
+                quota_mb - total size allowed for all cache dirs together in MB, 0 for no quota
+                max_age_hours - maximum age of any entry in hours, None for no limit
+                interval - seconds between passes
+                sweep_every - scan the dirs for files missing from the index every this many passes
+        """
+        self.cache_dirs = list(cache_dirs)
+        self.quota_bytes = int(quota_mb * 1024 * 1024)
+        self.max_age = max_age_hours * 3600 if max_age_hours is not None else None
+        self.interval = interval
+        self.sweep_every = sweep_every
+        self.last_stats = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='DataHubJanitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stop the janitor after the current pass """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        passes = 0
+        while not self._stop.is_set():
+            try:
+                st = time.time()
+                if passes % self.sweep_every == 0:
+                    sweep_orphans(self.cache_dirs)
+                passes += 1
+                self.last_stats = clean_cache(self.cache_dirs, self.quota_bytes, self.max_age)
+                logging.info(f'JANITOR PASS {time.time() - st:.2f}s {self.last_stats}')
+            except Exception:
+                logging.error(traceback.format_exc())
+            self._stop.wait(self.interval)
@@ -0,0 +1,236 @@
+""" per request timings and counters for DataHub, exported in the Prometheus text format """
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import bisect
+import contextlib
+import threading
+import time
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+# histogram buckets in seconds and in bytes
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600, 1073741824)
+
+# label value of modules and queries which are not known to exist
+UNKNOWN_LABEL = 'unknown'
+
+
+# --------------------------------------------------
+#    Globals
+# --------------------------------------------------
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+_HISTOGRAMS = {}
+_COUNTERS = {}
+_SERVER_TIMING = False
+# (module, qid) of the queries which finished, errors of other queries are counted under unknown
+_KNOWN_QUERIES = set()
+_KNOWN_MODULES = set()
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class Recorder:
+    """ collects the phase timings and cache lookups of one request, usually inside a worker """
+    def __init__(self):
+        self.phases = {}
+        self.cache = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def export(self):
+        """ return the recording as plain data so it can be sent back from a worker """
+        return {'phases': dict(self.phases), 'cache': [k + (v, ) for k, v in self.cache.items()]}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# --------------------------------------------------
+#    Recording
+# --------------------------------------------------
+@contextlib.contextmanager
+def collect():
+    """ record the phases and cache lookups of the code inside the with block into a new Recorder """
+    recorder = Recorder()
+    previous = getattr(_LOCAL, 'recorder', None)
+    _LOCAL.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _LOCAL.recorder = previous
+
+
+@contextlib.contextmanager
+def phase(name):
+    """ time the code inside the with block as a phase of the current request, a no-op outside of collect """
+    recorder = getattr(_LOCAL, 'recorder', None)
+    if recorder is None:
+        yield
+        return
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - st)
+
+
+def count_cache(module, func, result):
+    """ count a cache lookup of the current request, result is hit, miss, or uncacheable """
+    recorder = getattr(_LOCAL, 'recorder', None)
+    if recorder is not None:
+        key = (module, func, result)
+        recorder.cache[key] = recorder.cache.get(key, 0) + 1
+
+
+# --------------------------------------------------
+#    Registry
+# --------------------------------------------------
+def _observe(name, labels, value, buckets):
+    key = (name, labels)
+    h = _HISTOGRAMS.get(key)
+    if h is None:
+        h = _HISTOGRAMS[key] = _Histogram(buckets)
+    h.observe(value)
+
+
+def _inc(name, labels, n=1):
+    key = (name, labels)
+    _COUNTERS[key] = _COUNTERS.get(key, 0) + n
+
+
+def observe_query(module, qid, output, seconds, response_bytes=None, recording=None):
+    """ add a finished query to the metrics
+
+        Args:
+            module - module path of the query, i.e. example/example
+            qid - name of the query function
+            output - output format
+            seconds - total time spent by the server on the query
+            response_bytes - size of the response, None if unknown
+            recording - export of the Recorder of the query
+    """
+    with _LOCK:
+        _KNOWN_QUERIES.add((module, qid))
+        _KNOWN_MODULES.add(module)
+        _inc('datahub_queries_total', (('module', module), ('qid', qid), ('output', output)))
+        _observe('datahub_query_seconds', (('module', module), ('qid', qid)), seconds, SECONDS_BUCKETS)
+        if response_bytes is not None:
+            _observe('datahub_response_bytes', (('module', module), ('qid', qid)), response_bytes, BYTES_BUCKETS)
+        if recording is not None:
+            for name, value in recording['phases'].items():
+                _observe('datahub_phase_seconds', (('module', module), ('qid', qid), ('phase', name)), value,
+                         SECONDS_BUCKETS)
+            for cache_module, func, result, n in recording['cache']:
+                _inc('datahub_cache_lookups_total', (('module', cache_module), ('func', func), ('result', result)), n)
+
+
+def observe_error(module, qid):
+    """ count a query which raised, the module and qid come from the client, so modules and queries which never
+        finished are counted as unknown instead of adding a series per bad request """
+    with _LOCK:
+        if (module, qid) not in _KNOWN_QUERIES:
+            qid = UNKNOWN_LABEL
+            if module not in _KNOWN_MODULES:
+                module = UNKNOWN_LABEL
+        _inc('datahub_query_errors_total', (('module', module), ('qid', qid)))
+
+
+def cache_hit_ratios():
+    """ return {(module, func): hit ratio} of all cached queries seen so far """
+    totals = {}
+    with _LOCK:
+        for (name, labels), n in _COUNTERS.items():
+            if name == 'datahub_cache_lookups_total':
+                d = dict(labels)
+                t = totals.setdefault((d['module'], d['func']), [0, 0])
+                t[0] += n if d['result'] == 'hit' else 0
+                t[1] += n if d['result'] in ('hit', 'miss') else 0
+    return {k: hits / lookups for k, (hits, lookups) in totals.items() if lookups}
+
+
+def reset():
+    """ forget all metrics """
+    with _LOCK:
+        _HISTOGRAMS.clear()
+        _COUNTERS.clear()
+        _KNOWN_QUERIES.clear()
+        _KNOWN_MODULES.clear()
+
+
+# --------------------------------------------------
+#    Export
+# --------------------------------------------------
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def render_prometheus(gauges=None):
+    """ render all metrics in the Prometheus text exposition format
+
+        Args:
+            gauges - optional dictionary of gauge name to value, or to a dictionary of label tuples to values
+
+        Returns:
+            text
+    """
+    lines = []
+    with _LOCK:
+        for name in sorted({k[0] for k in _COUNTERS}):
+            lines.append(f'# TYPE {name} counter')
+            for (n, labels), value in sorted(_COUNTERS.items()):
+                if n == name:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        for name in sorted({k[0] for k in _HISTOGRAMS}):
+            lines.append(f'# TYPE {name} histogram')
+            for (n, labels), h in sorted(_HISTOGRAMS.items(), key=lambda x: x[0]):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, count in zip(h.buckets + ('+Inf', ), h.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels, (("le", le), ))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {h.sum}')
+                lines.append(f'{name}_count{_labels(labels)} {h.count}')
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f'# TYPE {name} gauge')
+        if isinstance(value, dict):
+            for labels, v in sorted(value.items()):
+                lines.append(f'{name}{_labels(labels)} {v}')
+        else:
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def configure_server_timing(enabled):
+    """ enable or disable Server-Timing headers on query responses """
+    global _SERVER_TIMING
+    _SERVER_TIMING = enabled
+
+
+def server_timing(phases):
+    """ return a Server-Timing header value for phase timings in seconds, or None if the header is disabled """
+    if not _SERVER_TIMING:
+        return None
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in phases.items())
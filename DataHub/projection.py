@@ -0,0 +1,131 @@
+""" reserved query parameters selecting columns, filtering, sorting, and paging query results in the server """
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import re
+import pandas as pd
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+# parameters taken out of the query string before the provider function is called
+RESERVED_PARAMS = ('columns', 'where', 'sort', 'offset', 'limit')
+
+# a condition of the where parameter, i.e. price>=10
+_CONDITION = re.compile(r'^\s*(.+?)\s*(==|!=|>=|<=|>|<)\s*(.*?)\s*$')
+_OPERATORS = {'==': 'eq', '!=': 'ne', '>=': 'ge', '<=': 'le', '>': 'gt', '<': 'lt'}
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def pop_view(params):
+    """ remove the reserved parameters from query parameters
+
+        Args:
+            params - dictionary of query parameters, modified in place
+
+        Returns:
+            dictionary of the reserved parameters which were present, empty if the full result is wanted
+    """
+    return {k: params.pop(k) for k in RESERVED_PARAMS if k in params}
+
+
+def _split(s):
+    return [x.strip() for x in s.split(',') if x.strip()]
+
+
+def parse_where(where):
+    """ parse the where parameter
+
+        Conditions are separated by ; and all must hold, i.e. region==west;price>=10.  Values separated by | match
+        any of them for == and none of them for !=, i.e. region==west|east.
+
+        Returns:
+            list of (column, operator, value)
+    """
+    conditions = []
+    for part in where.split(';'):
+        if not part.strip():
+            continue
+        m = _CONDITION.match(part)
+        if m is None:
+            raise ValueError(f'invalid where condition {part!r}, expected column, one of {" ".join(_OPERATORS)}, and a value')
+        conditions.append(m.groups())
+    return conditions
+
+
+def needed_columns(view):
+    """ return the names of the columns a view reads, or None if it needs all of them """
+    if 'columns' not in view:
+        return None
+    columns = _split(view['columns'])
+    for column, _, _ in parse_where(view.get('where', '')):
+        if column not in columns:
+            columns.append(column)
+    for x in _split(view.get('sort', '')):
+        if x.lstrip('-') not in columns:
+            columns.append(x.lstrip('-'))
+    return columns
+
+
+def _lookup(df, name, index=True):
+    """ return the column of a dataframe for a name from the query string, also matches non string column names
+        and, if index is True, the name of the index """
+    for c in df.columns:
+        if str(c) == name:
+            return c
+    if index and df.index.name is not None and str(df.index.name) == name:
+        return df.index.name
+    raise ValueError(f'unknown column {name!r}, expected one of {", ".join(str(c) for c in df.columns)}')
+
+
+def _convert(series, value):
+    """ convert a value from the query string to the type of a column """
+    if pd.api.types.is_bool_dtype(series):
+        return value.lower() in ('1', 'true', 'yes')
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.to_numeric(value)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return pd.Timestamp(value)
+    return value
+
+
+def apply_view(df, view):
+    """ apply the reserved parameters to a dataframe, in the order where, sort, offset and limit, then columns
+
+        Args:
+            df - dataframe
+            view - output of pop_view
+
+        Returns:
+            dataframe
+    """
+    if 'where' in view:
+        mask = pd.Series(True, index=df.index)
+        for name, op, value in parse_where(view['where']):
+            column = _lookup(df, name)
+            series = df[column] if column in df.columns else df.index.to_series(index=df.index)
+            values = [_convert(series, v) for v in value.split('|')]
+            if op in ('==', '!=') and len(values) > 1:
+                match = series.isin(values)
+                mask &= match if op == '==' else ~match
+            else:
+                mask &= getattr(series, _OPERATORS[op])(values[0])
+        df = df[mask.values]
+
+    if 'sort' in view:
+        by = _split(view['sort'])
+        df = df.sort_values([_lookup(df, x.lstrip('-')) for x in by], ascending=[not x.startswith('-') for x in by],
+                            kind='stable')
+
+    offset = int(view.get('offset', 0))
+    limit = view.get('limit')
+    if offset or limit is not None:
+        df = df.iloc[offset:offset + int(limit) if limit is not None else None]
+
+    if 'columns' in view:
+        df = df[[_lookup(df, x, index=False) for x in _split(view['columns'])]]
+    return df
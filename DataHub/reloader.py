@@ -0,0 +1,138 @@
+""" watches the provider modules of a module path so changed modules are picked up without a restart """
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import collections
+import importlib
+import logging
+import os
+import threading
+import traceback
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+WATCHED_SUFFIXES = ('.py', )
+
+
+# --------------------------------------------------
+#    Globals
+# --------------------------------------------------
+_MTIMES = {}
+_LOCKS = collections.defaultdict(threading.Lock)
+_LOCKS_LOCK = threading.Lock()
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def import_module(name, check_mtime=True):
+    """ import a module, reloading it if its source changed since this process imported it
+
+        Args:
+            name - dotted module name, i.e. example.example
+            check_mtime - False to skip the check of the source, i.e. when changes roll the process instead
+
+        Returns:
+            module
+    """
+    # import_module waits for an import in progress in another thread, sys.modules already has half imported modules
+    m = importlib.import_module(name)
+    fn = getattr(m, '__file__', None)
+    if fn is not None and check_mtime:
+        with _LOCKS_LOCK:
+            lock = _LOCKS[name]
+        # only one thread reloads a module, the others wait for the reload to finish
+        with lock:
+            mtime = os.path.getmtime(fn)
+            if name in _MTIMES and _MTIMES[name] != mtime:
+                m = importlib.reload(m)
+            _MTIMES[name] = mtime
+    return m
+
+
+def snapshot(modulepath, suffixes=WATCHED_SUFFIXES):
+    """ return {path relative to the module path: (mtime_ns, size)} of the watched files under a module path """
+    files = {}
+    for root, dirs, filenames in os.walk(modulepath):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+        for fn in filenames:
+            if fn.endswith(suffixes) and not fn.startswith('.'):
+                full = os.path.join(root, fn)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    # removed while walking
+                    continue
+                files[os.path.relpath(full, modulepath)] = (st.st_mtime_ns, st.st_size)
+    return files
+
+
+def changed_files(old, new):
+    """ return the sorted paths which were added, removed, or modified between two snapshots """
+    return sorted(k for k in old.keys() | new.keys() if old.get(k) != new.get(k))
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class ModuleWatcher:
+    """ background thread which polls a module path and calls on_change when modules are added, removed, or modified
+
+        A change is only reported once the files stopped changing for one interval, so a deploy copying many files
+        is reported once.
+    """
+    def __init__(self, modulepath, on_change, interval=2, suffixes=WATCHED_SUFFIXES):
+        """ init
+
+            Args:
+                modulepath - system path to the modules
+                on_change - function called with the sorted list of changed paths relative to the module path
+                interval - seconds between polls
+                suffixes - file suffixes to watch
+        """
+        self.modulepath = modulepath
+        self.on_change = on_change
+        self.interval = interval
+        self.suffixes = tuple(suffixes)
+        self._files = snapshot(modulepath, self.suffixes)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='DataHubWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stop watching """
+        self._stop.set()
+        self._thread.join()
+
+    def poll(self, pending=None):
+        """ compare the module path to the last reported state
+
+            Args:
+                pending - snapshot of the previous poll if it saw an unreported change, else None
+
+            Returns:
+                snapshot to pass to the next poll if a change is still settling, else None
+        """
+        files = snapshot(self.modulepath, self.suffixes)
+        if files == self._files:
+            return None
+        if files != pending:
+            # still changing, wait for it to settle
+            return files
+        changed = changed_files(self._files, files)
+        self._files = files
+        logging.info(f'MODULES CHANGED {changed}')
+        self.on_change(changed)
+        return None
+
+    def _run(self):
+        pending = None
+        while not self._stop.wait(self.interval):
+            try:
+                pending = self.poll(pending)
+            except Exception:
+                logging.error(traceback.format_exc())
+                pending = None
@@ -0,0 +1,361 @@
+""" pooled connections for provider modules, kept open across queries within a warm worker
+
+Example
+
+    import sqlite3
+    from DataHub import resources
+
+    # configured from the [Warehouse] section of the config file, its keys are passed to connect
+    WAREHOUSE = resources.connection_pool('warehouse', sqlite3.connect, config_file='/etc/datamodule_example.conf',
+                                          section='Warehouse', max_size=4, idle_timeout=300)
+
+    def sales(start_date, end_date):
+        with WAREHOUSE.connection() as conn:
+            return pd.read_sql('select * from sales where day between ? and ?', conn, params=(start_date, end_date))
+
+Pools are registered by name in the process, so a provider module which is reloaded gets its existing pool back
+instead of leaking the connections of the old one.
+"""
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import atexit
+import collections
+import configparser
+import contextlib
+import logging
+import os
+import threading
+import time
+import traceback
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+# idle connections are closed by a background thread which runs at least this often, or as often as the shortest
+# idle timeout of the pools
+PRUNE_INTERVAL = 30
+MIN_PRUNE_INTERVAL = 0.05
+
+
+# --------------------------------------------------
+#    Globals
+# --------------------------------------------------
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_PRUNER = None
+_PRUNER_WAKE = threading.Event()
+
+
+# --------------------------------------------------
+#    Exceptions
+# --------------------------------------------------
+class PoolTimeoutError(TimeoutError):
+    """ raised when no connection of a pool became available within the timeout """
+    pass
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def config_section(config_file, section):
+    """ return the keys of a section of a config file as a dictionary, i.e. the settings of a database
+
+        Raises:
+            FileNotFoundError if the config file is missing, KeyError if the section is
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(config_file):
+        raise FileNotFoundError(config_file)
+    return dict(config[section])
+
+
+def _close(conn):
+    conn.close()
+
+
+def connection_pool(name, connect, config_file=None, section=None, max_size=4, idle_timeout=300, check=None,
+                    check_interval=30, timeout=30, close=_close):
+    """ declare a named connection pool, or return the existing pool of that name with its settings updated
+
+        Args:
+            name - name of the pool, unique within the server
+            connect - function returning a new connection
+            config_file - optional config file, the keys of its section are passed to connect as keyword arguments
+            section - section of the config file, defaults to name
+            max_size - maximum number of connections open at once, checkouts beyond it wait
+            idle_timeout - seconds an unused connection is kept open, None to keep it until the worker exits
+            check - optional health check taking a connection and raising if it is unusable, i.e. running select 1
+            check_interval - seconds a connection may be idle before it is checked again on checkout
+            timeout - seconds a checkout waits for a connection before PoolTimeoutError
+            close - function closing a connection
+
+        Returns:
+            ConnectionPool
+    """
+    if config_file is not None:
+        factory = connect
+
+        def connect():
+            # read on every connect so changed settings are used by new connections
+            return factory(**config_section(config_file, section or name))
+
+    with _POOLS_LOCK:
+        pool = _POOLS.get(name)
+        if pool is None:
+            pool = _POOLS[name] = ConnectionPool(name, connect, max_size, idle_timeout, check, check_interval, timeout,
+                                                 close)
+        else:
+            pool.configure(connect, max_size, idle_timeout, check, check_interval, timeout, close)
+        _start_pruner()
+        return pool
+
+
+def _start_pruner():
+    """ start the thread pruning the pools of this process if it is not running, called with the pools lock held """
+    global _PRUNER
+    # threads do not survive a fork, so a child process starts its own
+    if _PRUNER is None or not _PRUNER.is_alive():
+        _PRUNER = threading.Thread(target=_prune_periodically, name='DataHubPoolPruner', daemon=True)
+        _PRUNER.start()
+    # a pool may have a shorter idle timeout now
+    _PRUNER_WAKE.set()
+
+
+def _prune_interval():
+    """ seconds until the next pass of the pruner """
+    with _POOLS_LOCK:
+        timeouts = [p.idle_timeout for p in _POOLS.values() if p.idle_timeout is not None]
+    return max(min(timeouts + [PRUNE_INTERVAL]), MIN_PRUNE_INTERVAL)
+
+
+def _prune_periodically():
+    """ close the connections of all pools which were idle too long, so they are closed without a checkout """
+    while True:
+        _PRUNER_WAKE.wait(_prune_interval())
+        _PRUNER_WAKE.clear()
+        with _POOLS_LOCK:
+            pools = list(_POOLS.values())
+        for p in pools:
+            try:
+                p.prune()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
+def get_pool(name):
+    """ return the pool of a name, KeyError if it was never declared """
+    with _POOLS_LOCK:
+        return _POOLS[name]
+
+
+def pool_stats():
+    """ return {name: stats} of all pools of this process """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    return {p.name: p.stats() for p in pools}
+
+
+def close_all():
+    """ close the idle connections of all pools and forget the pools, connections in use are closed when released """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for p in pools:
+        p.close()
+
+
+atexit.register(close_all)
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class ConnectionPool:
+    """ pool of up to max_size connections, use connection() to check one out
+
+        Idle connections are reused newest first, so connections which are not needed any more age out after
+        idle_timeout.  A connection is health checked on checkout if it was idle for more than check_interval, and
+        is discarded instead of returned to the pool if the block using it raised, since it may be left mid
+        transaction.  Connections inherited from a parent process are never reused.
+    """
+    def __init__(self, name, connect, max_size=4, idle_timeout=300, check=None, check_interval=30, timeout=30,
+                 close=_close):
+        """ init, see connection_pool for the arguments """
+        self.name = name
+        self._cond = threading.Condition()
+        self._idle = collections.deque()
+        self._open = 0
+        self._pid = os.getpid()
+        self._closed = False
+        self._stats = {'created': 0, 'closed': 0, 'checkouts': 0, 'waits': 0, 'failed_checks': 0, 'discarded': 0}
+        self.configure(connect, max_size, idle_timeout, check, check_interval, timeout, close)
+
+    def configure(self, connect, max_size=4, idle_timeout=300, check=None, check_interval=30, timeout=30,
+                  close=_close):
+        """ change the settings of the pool, open connections are kept """
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        with self._cond:
+            self.connect = connect
+            self.max_size = max_size
+            self.idle_timeout = idle_timeout
+            self.check = check
+            self.check_interval = check_interval
+            self.timeout = timeout
+            self._close_func = close
+            self._closed = False
+            self._cond.notify_all()
+
+    def _discard(self, conn):
+        """ close a connection outside of the lock, errors are logged since the connection is gone either way """
+        try:
+            self._close_func(conn)
+        except Exception as e:
+            logging.warning(f'closing a connection of pool {self.name} failed: {type(e).__name__}: {e}')
+        with self._cond:
+            self._stats['closed'] += 1
+
+    def _forget(self):
+        """ give up the connections of a parent process, i.e. after a fork, without closing them """
+        self._idle.clear()
+        self._open = 0
+        self._pid = os.getpid()
+
+    def _pop_expired(self):
+        """ remove the connections which were idle too long from the pool, called with the lock held
+
+            Returns:
+                list of connections to close
+        """
+        expired = []
+        now = time.monotonic()
+        # the oldest connections are on the left
+        while self._idle and self.idle_timeout is not None and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+            self._open -= 1
+        return expired
+
+    def _take(self):
+        """ take an idle connection or a slot for a new one, waiting up to the timeout
+
+            Returns:
+                (connection, idle since) or (None, None) if a new connection should be opened
+        """
+        expired = []
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        try:
+            with self._cond:
+                if self._pid != os.getpid():
+                    self._forget()
+                while True:
+                    expired.extend(self._pop_expired())
+                    if self._idle:
+                        self._stats['checkouts'] += 1
+                        return self._idle.pop()
+                    if self._open < self.max_size:
+                        self._open += 1
+                        self._stats['checkouts'] += 1
+                        return None, None
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeoutError(f'no connection of pool {self.name} became available within '
+                                               f'{self.timeout} seconds, {self.max_size} are in use')
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+        finally:
+            for conn in expired:
+                self._discard(conn)
+
+    def _release_slot(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def acquire(self):
+        """ check out a connection, prefer connection() which also releases it
+
+            Returns:
+                connection
+        """
+        conn, idle_since = self._take()
+        try:
+            if conn is not None and self.check is not None and time.monotonic() - idle_since > self.check_interval:
+                try:
+                    self.check(conn)
+                except Exception as e:
+                    logging.warning(f'connection of pool {self.name} failed its health check, reconnecting: '
+                                    f'{type(e).__name__}: {e}')
+                    with self._cond:
+                        self._stats['failed_checks'] += 1
+                    self._discard(conn)
+                    conn = None
+            if conn is None:
+                conn = self.connect()
+                with self._cond:
+                    self._stats['created'] += 1
+        except BaseException:
+            self._release_slot()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        """ return a checked out connection to the pool, or close it if discard is True or the pool was closed """
+        with self._cond:
+            if self._pid != os.getpid():
+                # checked out before a fork, the slot belongs to the parent
+                return
+            keep = not discard and not self._closed
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+            else:
+                self._open -= 1
+                self._stats['discarded'] += 1 if discard else 0
+                self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ check out a connection for the with block, it is returned to the pool afterwards """
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def prune(self):
+        """ close the connections which were idle longer than the idle timeout, pools declared with connection_pool
+            are pruned by a background thread
+
+            Returns:
+                number of connections closed
+        """
+        with self._cond:
+            expired = self._pop_expired()
+            self._cond.notify_all()
+        for conn in expired:
+            self._discard(conn)
+        return len(expired)
+
+    def close(self):
+        """ close the idle connections, connections in use are closed when they are released """
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._open -= len(idle)
+            self._closed = True
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """ return the number of open, idle, and in use connections and the counters of the pool """
+        with self._cond:
+            return dict(self._stats, open=self._open, idle=len(self._idle), in_use=self._open - len(self._idle),
+                        max_size=self.max_size)
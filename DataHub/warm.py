@@ -0,0 +1,236 @@
+""" prewarm the DataHub cache for known expensive queries, as a console script or a thread of the server
+
+Example config file
+
+    [DEFAULT]
+    modulepath = /srv/DataHub_Modules
+    concurrency = 2
+
+    [sales_last_week]
+    path = sales/daily
+    qid = sales_by_day
+    params = start_date={today-7d}&end_date={today-1d}&region=west
+    at = 05:30
+    update = false
+
+Templates in params are {today} or {now}, optionally shifted by days or hours, i.e. {today-7d} or {now-6h}, and
+optionally formatted, i.e. {today-1d:%Y%m%d}.  Dates are in UTC like lag_from_utc_now.  Jobs with at are run
+every day at that UTC time by the scheduler, jobs without at only when the script is run with --once.  With
+update = true the entry is rewritten even if it is cached.
+"""
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import argparse
+import concurrent.futures
+import configparser
+import datetime
+import json
+import logging
+import re
+import sys
+import threading
+import time
+import traceback
+from urllib.parse import parse_qsl
+from DataHub import business_logic
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+DEFAULT_CONCURRENCY = 2
+_TEMPLATE = re.compile(r'\{(today|now)(?:([+-]\d+)([dh]))?(?::([^}]*))?\}')
+
+
+# --------------------------------------------------
+#    Classes
+# --------------------------------------------------
+class WarmJob:
+    """ one query to keep warm """
+    def __init__(self, name, path, qid, params='', at=None, update=False):
+        """ init
+
+            Args:
+                name - name of the job, the section of the config file
+                path - module path of the query, i.e. example/example
+                qid - name of the query function
+                params - query string template of the parameters, i.e. start_date={today-7d}&end_date={today-1d}
+                at - UTC time of day to run the job, i.e. 05:30, None to only run it on demand
+                update - True to rewrite the cache entry even if it is cached
+        """
+        self.name = name
+        self.path = path.strip('/')
+        self.qid = qid
+        self.params = params
+        self.at = datetime.time.fromisoformat(at) if isinstance(at, str) else at
+        self.update = update
+
+    def next_run(self, now):
+        """ return the next time the job is due after now, None if it is not scheduled """
+        if self.at is None:
+            return None
+        run = datetime.datetime.combine(now.date(), self.at)
+        return run if run > now else run + datetime.timedelta(days=1)
+
+
+class WarmScheduler:
+    """ background thread running warm jobs at their time of day """
+    def __init__(self, jobs, concurrency=DEFAULT_CONCURRENCY, nospawn=False):
+        self.jobs = [j for j in jobs if j.at is not None]
+        self.concurrency = concurrency
+        self.nospawn = nospawn
+        self.last_results = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='DataHubWarm', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stop the scheduler, a warm in progress is finished first """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while self.jobs and not self._stop.is_set():
+            now = _utcnow()
+            next_time = min(j.next_run(now) for j in self.jobs)
+            if self._stop.wait((next_time - now).total_seconds()):
+                break
+            due = [j for j in self.jobs if j.next_run(now) == next_time]
+            try:
+                self.last_results = warm(due, self.concurrency, self.nospawn)
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def render_params(template, now=None):
+    """ fill in the date templates of a parameter query string
+
+        Args:
+            template - query string, i.e. start_date={today-7d}&end_date={today-1d}
+            now - naive UTC datetime, defaults to the current time
+
+        Returns:
+            dictionary of parameters
+    """
+    now = _utcnow() if now is None else now
+
+    def replace(m):
+        base, offset, unit, fmt = m.groups()
+        t = datetime.datetime.combine(now.date(), datetime.time()) if base == 'today' else now
+        if offset:
+            t = t + datetime.timedelta(**{'days' if unit == 'd' else 'hours': int(offset)})
+        return t.strftime(fmt or ('%Y-%m-%d' if base == 'today' else '%Y-%m-%dT%H:%M:%S'))
+
+    return dict(parse_qsl(_TEMPLATE.sub(replace, template), keep_blank_values=True))
+
+
+def load_config(filename):
+    """ read the warm jobs of a config file
+
+        Returns:
+            (jobs, settings) where settings holds the DEFAULT section, i.e. modulepath and concurrency
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(filename):
+        raise FileNotFoundError(filename)
+    jobs = []
+    for name in config.sections():
+        section = config[name]
+        jobs.append(WarmJob(name, section['path'], section['qid'], section.get('params', ''), section.get('at'),
+                            section.getboolean('update', False)))
+    return jobs, dict(config.defaults())
+
+
+def warm_one(job, nospawn=False, now=None):
+    """ fill the cache entry of a job
+
+        Returns:
+            dictionary with name, params, status, seconds, and error.  status is warmed, error, or no_cache_file if
+            the query ran but has no single cache file, i.e. it is inside the lag or cached in segments
+    """
+    params = render_params(job.params, now)
+    parsed_qs = dict(params, qid=job.qid, output='fast_cache')
+    if job.update:
+        parsed_qs['updatecache'] = '1'
+    st = time.perf_counter()
+    result = {'name': job.name, 'params': params}
+    try:
+        # fast_cache fills the entry without sending the data back, entries which are already cached are quick
+        retval = business_logic.execute_query(job.path, parsed_qs, nospawn)
+        result['status'] = 'warmed' if retval[1] == 'application/fast_cache' else 'no_cache_file'
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        result.update(status='error', error=f'{type(e).__name__}: {e}')
+    result['seconds'] = round(time.perf_counter() - st, 3)
+    logging.info(f'WARM {job.name} {result["status"]} {result["seconds"]}s {params}')
+    return result
+
+
+def warm(jobs, concurrency=DEFAULT_CONCURRENCY, nospawn=False, now=None):
+    """ fill the cache entries of jobs, at most concurrency at a time
+
+        Returns:
+            list of warm_one results in the order of the jobs
+    """
+    if not jobs:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='DataHubWarm') as executor:
+        return list(executor.map(lambda job: warm_one(job, nospawn, now), jobs))
+
+
+# --------------------------------------------------
+#    Main
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='prewarm the DataHub cache for the queries of a config file')
+    parser.add_argument("config", help="config file with the queries to warm")
+    parser.add_argument("--modulepath", help="location of the modules, overrides the config file", default=None,
+                        required=False)
+    parser.add_argument("--concurrency", type=int, help="queries warmed at once, overrides the config file",
+                        default=None, required=False)
+    parser.add_argument("--once", action="store_true", help="warm every query now and exit instead of scheduling",
+                        default=False, required=False)
+    parser.add_argument("--only", action="append", help="only warm this job, can be repeated", default=[],
+                        required=False)
+    args = vars(parser.parse_args(argv))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(message)s')
+
+    jobs, settings = load_config(args['config'])
+    if args['only']:
+        jobs = [j for j in jobs if j.name in args['only']]
+    modulepath = args['modulepath'] or settings.get('modulepath', '.')
+    concurrency = args['concurrency'] or int(settings.get('concurrency', DEFAULT_CONCURRENCY))
+    if modulepath != '.':
+        sys.path.append(modulepath)
+
+    # the queries run in warm workers like in the server, so their caches are keyed the same way
+    business_logic.start_worker_pool(modulepath, max_workers=concurrency)
+    try:
+        if args['once']:
+            results = warm(jobs, concurrency)
+            print(json.dumps(results, indent=1))
+            return 1 if any(r['status'] == 'error' for r in results) else 0
+
+        scheduler = WarmScheduler(jobs, concurrency)
+        if not scheduler.jobs:
+            logging.error('none of the jobs has an at time, use --once to run them now')
+            return 1
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        business_logic.stop_worker_pool()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
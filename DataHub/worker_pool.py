@@ -0,0 +1,309 @@
+""" persistent pool of pre-warmed worker processes for DataHub """
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import atexit
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import threading
+import traceback
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+# queue item asking a manager thread to replace its worker if it is from an older generation
+_ROLL = 'roll'
+
+
+# --------------------------------------------------
+#    Exceptions
+# --------------------------------------------------
+class WorkerCrashedError(RuntimeError):
+    """ raised when a worker process dies while executing a task """
+    pass
+
+
+class WorkerTimeoutError(TimeoutError):
+    """ raised when a task runs longer than the task timeout, the worker is killed and replaced """
+    pass
+
+
+class _RemoteTraceback(Exception):
+    """ carries the formatted traceback of an exception raised inside a worker """
+    def __init__(self, tb):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+# --------------------------------------------------
+#    Worker Process
+# --------------------------------------------------
+def _rss_mb():
+    """ return the resident set size of the current process in MB """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is the peak rss in KB on linux, good enough as a fallback
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _worker_main(conn, initializer, initargs):
+    """ main loop of a worker process, receives (func, args, kwargs) tasks and sends back the results """
+    if initializer is not None:
+        initializer(*initargs)
+
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task is None:
+            break
+
+        func, args, kwargs = task
+        try:
+            reply = (True, func(*args, **kwargs), None)
+        except BaseException as e:
+            reply = (False, e, traceback.format_exc())
+
+        try:
+            conn.send(reply + (_rss_mb(), ))
+        except Exception as e:
+            # the result or the exception could not be pickled
+            conn.send((False, RuntimeError(repr(e)), traceback.format_exc(), _rss_mb()))
+
+    # the processes fetching segments are not daemons, the worker would wait for them forever when it exits, the
+    # module is only loaded if a task used it
+    cache = sys.modules.get('DataHub.cache')
+    if cache is not None:
+        cache.stop_segment_pools()
+
+
+# --------------------------------------------------
+#    Worker Pool
+# --------------------------------------------------
+class _Worker:
+    """ parent side handle to a single worker process """
+    def __init__(self, ctx, initializer, initargs, generation=0):
+        self.conn, child_conn = ctx.Pipe()
+        # not a daemon so that providers are allowed to start their own child processes
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, initializer, initargs), daemon=False)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+        self.rss_mb = 0
+        self.generation = generation
+
+    def stop(self, timeout=5):
+        """ ask the worker to exit, kill it if it does not """
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+    def kill(self):
+        """ kill the worker immediately """
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """ pool of long lived worker processes
+
+        Every worker is owned by a manager thread in the parent which feeds it tasks one at a time.  Workers are
+        started eagerly so the import cost is paid before the first request, and are replaced when they crash,
+        exceed the task timeout, have run max_tasks_per_worker tasks, grow beyond max_rss_mb, or the pool is rolled.
+    """
+    def __init__(self, max_workers=4, max_tasks_per_worker=0, max_rss_mb=0, task_timeout=None, initializer=None,
+                 initargs=(), mp_context=None):
+        """ init
+
+            Args:
+                max_workers - number of worker processes
+                max_tasks_per_worker - recycle a worker after this many tasks, 0 to never recycle
+                max_rss_mb - recycle a worker after a task leaves it with more than this many MB resident, 0 to disable
+                task_timeout - seconds a task may run before its worker is killed, None for no timeout
+                initializer - function called in every new worker before it accepts tasks
+                initargs - arguments for the initializer
+                mp_context - multiprocessing context, defaults to forkserver so workers are not forked from a
+                             threaded server
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        if mp_context is None:
+            mp_context = multiprocessing.get_context('forkserver')
+            mp_context.set_forkserver_preload(['pandas'])
+        self._ctx = mp_context
+        self._initializer = initializer
+        self._initargs = initargs
+        self.max_workers = max_workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_rss_mb = max_rss_mb
+        self.task_timeout = task_timeout
+        self._tasks = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._stats = {'tasks': 0, 'errors': 0, 'timeouts': 0, 'crashes': 0, 'recycles': 0, 'rolls': 0}
+        self._generation = 0
+        self._threads = []
+        for i in range(0, max_workers):
+            t = threading.Thread(target=self._manage, name=f'DataHubWorker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        atexit.register(self.shutdown)
+
+    def submit(self, func, *args, **kwargs):
+        """ submit a task to the pool
+
+            Args:
+                func - module level function to call in the worker
+                args - positional arguments for func
+                kwargs - keyword arguments for func
+
+            Returns:
+                concurrent.futures.Future for the result
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot submit to a pool after shutdown')
+            self._tasks.put((future, func, args, kwargs))
+        return future
+
+    def stats(self):
+        """ return a copy of the pool counters """
+        with self._lock:
+            return dict(self._stats, workers=self.max_workers)
+
+    def roll(self):
+        """ replace every worker with a fresh process, i.e. after the provider modules changed
+
+            Idle workers are replaced right away and busy ones once their task is done, so tasks which are running
+            finish in the old process and no task runs in an old process after this returns.  The new worker is
+            started before the old one is stopped.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._generation += 1
+            self._stats['rolls'] += 1
+            for _ in self._threads:
+                self._tasks.put(_ROLL)
+
+    def shutdown(self, wait=True):
+        """ stop all workers, tasks still queued are cancelled """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            for _ in self._threads:
+                self._tasks.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _spawn(self):
+        return _Worker(self._ctx, self._initializer, self._initargs, self._generation)
+
+    def _replace_if_old(self, worker):
+        """ return a worker of the current generation, starting it before the old worker is stopped """
+        if worker.generation == self._generation:
+            return worker
+        new_worker = self._spawn()
+        logging.info(f'rolling worker pid {worker.process.pid} to pid {new_worker.process.pid}')
+        worker.stop()
+        return new_worker
+
+    def _manage(self):
+        """ manager thread, owns one worker process and feeds it tasks from the queue """
+        worker = self._spawn()
+        while True:
+            # drop the last task and its result, they should not be kept alive while the worker is idle
+            item = future = func = args = kwargs = value = None
+            item = self._tasks.get()
+            if item is None:
+                break
+            worker = self._replace_if_old(worker)
+            if item is _ROLL:
+                continue
+            future, func, args, kwargs = item
+            if self._shutdown:
+                future.cancel()
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            if not worker.process.is_alive():
+                worker.conn.close()
+                worker = self._spawn()
+
+            # send the task, arguments are pickled before anything is written so a pickling error leaves the pipe usable
+            try:
+                worker.conn.send((func, args, kwargs))
+            except (BrokenPipeError, ConnectionResetError):
+                self._count('crashes')
+                future.set_exception(WorkerCrashedError(f'worker pid {worker.process.pid} is gone'))
+                worker.kill()
+                worker = self._spawn()
+                continue
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            # wait for the result
+            self._count('tasks')
+            if not worker.conn.poll(self.task_timeout):
+                self._count('timeouts')
+                logging.error(f'worker pid {worker.process.pid} exceeded the task timeout of {self.task_timeout}s, killing it')
+                worker.kill()
+                future.set_exception(WorkerTimeoutError(f'task exceeded the timeout of {self.task_timeout} seconds'))
+                worker = self._spawn()
+                continue
+            try:
+                ok, value, tb, worker.rss_mb = worker.conn.recv()
+            except (EOFError, OSError):
+                self._count('crashes')
+                worker.process.join()
+                exitcode = worker.process.exitcode
+                logging.error(f'worker pid {worker.process.pid} died with exit code {exitcode}')
+                future.set_exception(WorkerCrashedError(f'worker died with exit code {exitcode} while running the task'))
+                worker.conn.close()
+                worker = self._spawn()
+                continue
+
+            if ok:
+                future.set_result(value)
+            else:
+                self._count('errors')
+                value.__cause__ = _RemoteTraceback(tb)
+                future.set_exception(value)
+
+            # recycle the worker if needed, the replacement warms up before the next task is taken
+            worker.tasks += 1
+            if ((self.max_tasks_per_worker and worker.tasks >= self.max_tasks_per_worker) or
+                    (self.max_rss_mb and worker.rss_mb > self.max_rss_mb)):
+                self._count('recycles')
+                logging.info(f'recycling worker pid {worker.process.pid} after {worker.tasks} tasks at {worker.rss_mb:.0f}MB')
+                worker.stop()
+                worker = self._spawn()
+        worker.stop()
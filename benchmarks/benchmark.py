@@ -0,0 +1,302 @@
+""" benchmarks of the DataHub query, cache, and render paths, results are written as json to compare runs
+
+Usage
+    python benchmarks/benchmark.py --output before.json
+    python benchmarks/benchmark.py --output after.json --sections query,cache,render
+
+The providers are synthetic, written into a temporary module path, so runs only depend on the machine and the
+code under test.  Every timing is reported as the median, p90, and min of its iterations in milliseconds.
+"""
+
+# --------------------------------------------------
+#    Imports
+# --------------------------------------------------
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import tracemalloc
+import urllib.request
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DataHub.business_logic as business_logic     # noqa: E402
+from DataHub import cache                           # noqa: E402
+
+
+# --------------------------------------------------
+#    Constants
+# --------------------------------------------------
+SECTIONS = ('query', 'cache', 'render', 'http')
+RENDER_OUTPUTS = ('csv', 'json', 'html', 'pickle')
+DEFAULT_SIZES = (1000, 10000, 100000)
+# pretty html takes seconds per thousand rows, larger frames are left out of the html benchmark
+HTML_MAX_ROWS = 1000
+MODULE = 'datahub_bench/provider'
+
+PROVIDER = '''
+from DataHub.cache import cacheable
+from DataHub.example_providers.example.example import synthetic_data
+
+
+def frame(rows, cols='10'):
+    """ synthetic frame, Example Query: &rows=10 """
+    return synthetic_data(rows, cols, seed=0)
+
+
+@cacheable(cache_dir={cache_dir!r}, filename=__file__)
+def cached_frame(rows, key, cols='10'):
+    """ cached synthetic frame, key makes distinct cache entries, Example Query: &rows=10&key=0 """
+    return synthetic_data(rows, cols, seed=0)
+'''
+
+
+# --------------------------------------------------
+#    Functions
+# --------------------------------------------------
+def _summary(seconds):
+    """ median, p90, and min of a list of timings in seconds, in milliseconds """
+    ms = sorted(x * 1000 for x in seconds)
+    return {'n': len(ms), 'median_ms': round(statistics.median(ms), 3),
+            'p90_ms': round(ms[min(len(ms) - 1, int(len(ms) * 0.9))], 3), 'min_ms': round(ms[0], 3)}
+
+
+def _time(func, iterations):
+    """ call func iterations times and return the list of timings in seconds """
+    timings = []
+    for _ in range(0, iterations):
+        st = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - st)
+    return timings
+
+
+def _peak_rss_mb():
+    """ peak resident size of this process in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def write_providers(root):
+    """ write the synthetic provider module into a temporary module path
+
+        Returns:
+            module path
+    """
+    modulepath = os.path.join(root, 'modules')
+    os.makedirs(os.path.join(modulepath, 'datahub_bench'))
+    with open(os.path.join(modulepath, 'datahub_bench', 'provider.py'), 'w') as f:
+        f.write(textwrap.dedent(PROVIDER.format(cache_dir=os.path.join(root, 'cache'))))
+    sys.path.insert(0, modulepath)
+    return modulepath
+
+
+def bench_query(modulepath, sizes, iterations, concurrency):
+    """ latency of execute_query inline, in warm workers, and in a process per request, and the throughput of
+        concurrent queries in the warm workers """
+    results = {}
+    for rows in sizes:
+        parsed_qs = {'qid': 'frame', 'rows': str(rows), 'output': 'pickle'}
+        results[f'nospawn_rows_{rows}'] = _summary(_time(
+            lambda: business_logic.execute_query(MODULE, dict(parsed_qs), True), iterations))
+
+    # a process per request pays for the interpreter and the imports every time, a few iterations are enough
+    parsed_qs = {'qid': 'frame', 'rows': str(sizes[0]), 'output': 'pickle'}
+    results[f'spawn_rows_{sizes[0]}'] = _summary(_time(
+        lambda: business_logic.execute_query(MODULE, dict(parsed_qs)), max(1, min(iterations, 3))))
+
+    business_logic.start_worker_pool(modulepath, max_workers=concurrency)
+    try:
+        for rows in sizes:
+            parsed_qs = {'qid': 'frame', 'rows': str(rows), 'output': 'pickle'}
+            business_logic.execute_query(MODULE, dict(parsed_qs))
+            results[f'workers_rows_{rows}'] = _summary(_time(
+                lambda: business_logic.execute_query(MODULE, dict(parsed_qs)), iterations))
+
+        # distinct parameters so the queries are not coalesced
+        n = iterations * concurrency
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            st = time.perf_counter()
+            list(executor.map(lambda i: business_logic.execute_query(
+                MODULE, {'qid': 'frame', 'rows': str(sizes[0] + i), 'output': 'pickle'}), range(0, n)))
+            elapsed = time.perf_counter() - st
+        results['workers_throughput'] = {'queries': n, 'concurrency': concurrency,
+                                         'queries_per_second': round(n / elapsed, 2)}
+    finally:
+        business_logic.stop_worker_pool()
+    return results
+
+
+def bench_cache(sizes, iterations):
+    """ cost of cache misses, hits, and forced writes of a cacheable query, across frame sizes """
+    import datahub_bench.provider as provider
+    results = {}
+    for rows in sizes:
+        keys = iter(range(0, 1000000))
+        results[f'miss_rows_{rows}'] = _summary(_time(
+            lambda: provider.cached_frame(rows=str(rows), key=str(next(keys))), iterations))
+        provider.cached_frame(rows=str(rows), key='hit')
+        results[f'hit_rows_{rows}'] = _summary(_time(
+            lambda: cache.decode_cache_to_df(provider.cached_frame(rows=str(rows), key='hit')), iterations))
+        results[f'write_rows_{rows}'] = _summary(_time(
+            lambda: provider.cached_frame(rows=str(rows), key='hit', updatecache=True), iterations))
+        results[f'fetch_rows_{rows}'] = _summary(_time(
+            lambda: provider.cached_frame(rows=str(rows), key='hit', nocache=True), iterations))
+    return results
+
+
+def bench_render(sizes, iterations):
+    """ cost, output size, and peak python allocation of rendering a frame in each output format """
+    from DataHub.example_providers.example.example import synthetic_data
+    results = {}
+    for rows in sizes:
+        df = synthetic_data(rows, 10, seed=0)
+        for output in RENDER_OUTPUTS:
+            if output == 'html' and rows > HTML_MAX_ROWS:
+                continue
+            tracemalloc.start()
+            data = business_logic._render(df, output)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result = _summary(_time(lambda: business_logic._render(df, output), iterations))
+            result.update(bytes=len(data), peak_alloc_mb=round(peak / (1024 * 1024), 2))
+            results[f'{output}_rows_{rows}'] = result
+    return results
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def bench_http(modulepath, rows, requests, concurrency, workers, startup_timeout=30):
+    """ end to end load test of the server on localhost
+
+        Returns:
+            latency summary and throughput, or an error if the server did not start
+    """
+    port = _free_port()
+    cmd = [sys.executable, '-m', 'DataHub.dataHub', '--port', str(port), '--modulepath', modulepath,
+           '--workers', str(workers)]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                        os.environ.get('PYTHONPATH', '')]))
+    server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    try:
+        # wait for the server to accept connections
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if server.poll() is not None:
+                return {'error': f'server exited with {server.returncode}: '
+                                 f'{server.stderr.read().decode(errors="replace")[-500:]}'}
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    return {'error': f'server did not listen on port {port} within {startup_timeout}s'}
+                time.sleep(0.2)
+
+        def fetch(i):
+            url = f'http://127.0.0.1:{port}/{MODULE}?qid=frame&rows={rows}&output=csv&n={i}'
+            st = time.perf_counter()
+            with urllib.request.urlopen(url, timeout=60) as response:
+                size = len(response.read())
+            return time.perf_counter() - st, size
+
+        fetch(-1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            st = time.perf_counter()
+            timings = list(executor.map(fetch, range(0, requests)))
+            elapsed = time.perf_counter() - st
+        result = _summary([t for t, _ in timings])
+        result.update(rows=rows, concurrency=concurrency, workers=workers, bytes=timings[0][1],
+                      requests_per_second=round(requests / elapsed, 2))
+        return result
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def run(sections=SECTIONS, sizes=DEFAULT_SIZES, iterations=10, concurrency=4, http_requests=200,
+        http_concurrency=8):
+    """ run benchmark sections
+
+        Returns:
+            dictionary of results, with the environment of the run under meta
+    """
+    results = {'meta': {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                        'python': platform.python_version(), 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'cpus': os.cpu_count(), 'sizes': list(sizes),
+                        'iterations': iterations}}
+    try:
+        results['meta']['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                                   text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+                                                   ).stdout.strip() or None
+    except OSError:
+        results['meta']['commit'] = None
+
+    with tempfile.TemporaryDirectory(prefix='datahub_bench_') as root:
+        modulepath = write_providers(root)
+        if 'query' in sections:
+            results['query'] = bench_query(modulepath, sizes, iterations, concurrency)
+        if 'cache' in sections:
+            results['cache'] = bench_cache(sizes, iterations)
+        if 'render' in sections:
+            results['render'] = bench_render(sizes, iterations)
+        if 'http' in sections:
+            results['http'] = bench_http(modulepath, sizes[0], http_requests, http_concurrency, concurrency)
+    results['meta']['peak_rss_mb'] = _peak_rss_mb()
+    return results
+
+
+# --------------------------------------------------
+#    Main
+# --------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the DataHub query, cache, and render paths')
+    parser.add_argument("--sections", help=f"comma separated sections to run, any of {','.join(SECTIONS)}",
+                        default=','.join(SECTIONS), required=False)
+    parser.add_argument("--sizes", help="comma separated numbers of rows of the synthetic frames",
+                        default=','.join(str(x) for x in DEFAULT_SIZES), required=False)
+    parser.add_argument("--iterations", type=int, help="timed calls per benchmark", default=10, required=False)
+    parser.add_argument("--concurrency", type=int, help="worker processes for the query and http benchmarks",
+                        default=4, required=False)
+    parser.add_argument("--http-requests", type=int, help="requests of the http load test", default=200,
+                        required=False)
+    parser.add_argument("--http-concurrency", type=int, help="concurrent clients of the http load test", default=8,
+                        required=False)
+    parser.add_argument("--output", help="file to write the json results to, stdout if not given", default=None,
+                        required=False)
+    args = vars(parser.parse_args(argv))
+
+    sections = [x.strip() for x in args['sections'].split(',') if x.strip()]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f'unknown sections {", ".join(sorted(unknown))}')
+    results = run(sections, [int(x) for x in args['sizes'].split(',')], args['iterations'], args['concurrency'],
+                  args['http_requests'], args['http_concurrency'])
+
+    text = json.dumps(results, indent=1)
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+""" fixtures shared by the test modules """
+import sys
+import textwrap
+import pytest
+import DataHub.business_logic as business_logic
+
+
+PROVIDER = '''
+import time
+import pandas as pd
+from DataHub.cache import cacheable
+
+CALLS = []
+
+@cacheable(cache_dir={cache_dir!r}, filename=__file__, lag_params=['end_date'], lag_from_utc_now=pd.Timedelta(days=1))
+def dates(start_date, end_date):
+    """ dates """
+    CALLS.append((start_date, end_date))
+    return pd.DataFrame({{'d': pd.date_range(start_date, end_date)}})
+
+
+def plain(rows):
+    """ plain """
+    return pd.DataFrame({{'x': range(0, int(rows))}})
+
+
+def slow(marker):
+    """ slow """
+    with open(marker, 'a') as f:
+        f.write('x')
+    time.sleep(0.5)
+    return pd.DataFrame({{'x': [1]}})
+'''
+
+
+@pytest.fixture
+def provider(tmp_path, monkeypatch):
+    """ write a provider module into a temporary module path """
+    modulepath = tmp_path / 'modules'
+    (modulepath / 'bl_test').mkdir(parents=True)
+    (modulepath / 'bl_test' / 'provider.py').write_text(textwrap.dedent(PROVIDER.format(cache_dir=str(tmp_path / 'cache'))))
+    monkeypatch.syspath_prepend(str(modulepath))
+    monkeypatch.setattr(business_logic, '_FAST_CACHE_SPECS', {})
+    yield modulepath
+    sys.modules.pop('bl_test.provider', None)
+    sys.modules.pop('bl_test', None)
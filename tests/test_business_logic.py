@@ -0,0 +1,536 @@
+import asyncio
+import gc
+import gzip
+import json
+import os
+import sys
+import textwrap
+import threading
+import time
+import pandas as pd
+import pytest
+import DataHub.business_logic as business_logic
+from DataHub import cache, cache_index, catalog, metrics
+
+
+class TestExecuteQuery:
+    def test_csv(self, provider):
+        result, content_type, code, headers = business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '3'}, True)
+        assert code == 200
+        assert content_type == 'text/plain'
+        assert result == pd.DataFrame({'x': range(0, 3)}).to_csv()
+
+
+class TestImportProvider:
+    def test_concurrent_import_waits_for_the_module(self, provider):
+        (provider / 'bl_test' / 'slow_import.py').write_text('import time\ntime.sleep(0.3)\n\ndef plain():\n    pass\n')
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(
+                hasattr(business_logic._import_provider('bl_test.slow_import'), 'plain'))) for _ in range(0, 4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert results == [True] * 4
+        finally:
+            sys.modules.pop('bl_test.slow_import', None)
+
+
+class TestPreload:
+    def test_preload_providers(self, provider):
+        (provider / 'bl_test' / 'broken.py').write_text('raise RuntimeError("no driver")')
+        (provider / 'bl_test' / '_private.py').write_text('raise RuntimeError("not a provider")')
+        try:
+            errors = business_logic.preload_providers(str(provider))
+            assert errors == {'bl_test.broken': 'RuntimeError: no driver'}
+            assert 'bl_test.provider' in sys.modules
+        finally:
+            sys.modules.pop('bl_test.broken', None)
+
+    def test_watched_providers_are_not_checked(self, provider, monkeypatch):
+        m = business_logic._import_provider('bl_test.provider')
+        monkeypatch.setattr(business_logic, '_CHECK_PROVIDER_MTIMES', False)
+        fn = provider / 'bl_test' / 'provider.py'
+        fn.write_text(fn.read_text() + '\nADDED = 1\n')
+        os.utime(fn, (0, 0))
+        assert business_logic._import_provider('bl_test.provider') is m
+        assert not hasattr(m, 'ADDED')
+        monkeypatch.setattr(business_logic, '_CHECK_PROVIDER_MTIMES', True)
+        assert business_logic._import_provider('bl_test.provider').ADDED == 1
+
+
+class TestCoalescing:
+    def test_identical_queries_share_one_execution(self, provider, tmp_path):
+        marker = tmp_path / 'marker'
+        business_logic.start_worker_pool(str(provider), max_workers=4)
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(business_logic.execute_query(
+                'bl_test/provider', {'qid': 'slow', 'marker': str(marker)})[0])) for _ in range(0, 4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            business_logic.stop_worker_pool()
+        assert marker.read_text() == 'x'
+        assert len(results) == 4
+        assert len(set(results)) == 1
+
+
+class TestFastCache:
+    def test_hit_does_not_use_a_worker(self, provider, monkeypatch):
+        qs = {'qid': 'dates', 'start_date': '2024-01-01', 'end_date': '2024-01-03', 'output': 'fast_cache'}
+        path, content_type, code = business_logic.execute_query('bl_test/provider', dict(qs), True)
+        assert content_type == 'application/fast_cache'
+        df = pd.read_pickle(path, compression='gzip')
+        assert len(df) == 3
+
+        # the second request must be answered without running the worker function
+        def fail(*args, **kwargs):
+            raise AssertionError('worker used on a fast_cache hit')
+        monkeypatch.setattr(business_logic, '_execute_fast_cache_worker', fail)
+        assert business_logic.execute_query('bl_test/provider', dict(qs), True)[0] == path
+
+    def test_hits_are_counted_in_the_index(self, provider, tmp_path, monkeypatch):
+        qs = {'qid': 'dates', 'start_date': '2024-01-01', 'end_date': '2024-01-03', 'output': 'fast_cache'}
+        business_logic.execute_query('bl_test/provider', dict(qs), True)
+        # answered by the server, then by the worker once the layout is forgotten
+        business_logic.execute_query('bl_test/provider', dict(qs), True)
+        monkeypatch.setattr(business_logic, '_FAST_CACHE_SPECS', {})
+        business_logic.execute_query('bl_test/provider', dict(qs), True)
+        index = cache_index.get_index(str(tmp_path / 'cache'))
+        index.flush_hits()
+        hits, last_hit = index._execute('SELECT hits, last_hit FROM entries')[0]
+        assert hits == 2
+        assert last_hit is not None
+
+    def test_uncacheable_returns_data(self, provider):
+        qs = {'qid': 'plain', 'rows': '2', 'output': 'fast_cache'}
+        result, content_type, code, headers = business_logic.execute_query('bl_test/provider', qs, True)
+        assert content_type == 'application/python-pickle'
+        assert len(pd.read_pickle(__import__('io').BytesIO(result), compression='gzip')) == 2
+
+
+class TestRenderedVariants:
+    def test_csv_variant_is_reused(self, provider, tmp_path):
+        qs = {'qid': 'dates', 'start_date': '2024-01-01', 'end_date': '2024-01-03', 'output': 'csv'}
+        first = business_logic.execute_query('bl_test/provider', dict(qs), True)[0]
+        variants = list((tmp_path / 'cache' / 'provider').glob('*.csv'))
+        assert len(variants) == 1
+
+        # a hit is served from the pre-rendered file
+        variants[0].write_text('from variant')
+        assert business_logic.execute_query('bl_test/provider', dict(qs), True)[0] == b'from variant'
+        assert first.startswith(',d')
+
+    def test_pickle_hit_returns_cache_file(self, provider):
+        qs = {'qid': 'dates', 'start_date': '2024-01-01', 'end_date': '2024-01-02', 'output': 'pickle'}
+        first = business_logic.execute_query('bl_test/provider', dict(qs), True)
+        second = business_logic.execute_query('bl_test/provider', dict(qs), True)
+        assert first[1] == 'application/python-pickle'
+        assert second[3]['Content-Encoding'] == 'gzip'
+        assert first[0] == second[0]
+
+
+class TestSegments:
+    def test_segmented_output_matches_unsegmented(self, provider, tmp_path):
+        (provider / 'bl_test' / 'segmented.py').write_text(textwrap.dedent(f'''
+            import pandas as pd
+            from DataHub.cache import cacheable
+
+            def days(start_date, end_date):
+                """ days """
+                return pd.DataFrame({{'d': pd.date_range(start_date, end_date)}})
+
+            segmented = cacheable(cache_dir={str(tmp_path / 'cache')!r}, filename=__file__,
+                                  segment_params=('start_date', 'end_date'))(days)
+            '''))
+        try:
+            for output in ('json', 'csv'):
+                qs = {'start_date': '2024-01-01', 'end_date': '2024-01-05', 'output': output}
+                expected = business_logic.execute_query('bl_test/segmented', dict(qs, qid='days'), True)
+                result = business_logic.execute_query('bl_test/segmented', dict(qs, qid='segmented'), True)
+                assert (result[0], result[2]) == (expected[0], 200)
+        finally:
+            sys.modules.pop('bl_test.segmented', None)
+
+
+class TestStream:
+    def test_csv_chunks_match_full_render(self, provider):
+        chunks, content_type, code, headers = business_logic.execute_query_stream(
+            'bl_test/provider', {'qid': 'plain', 'rows': '10', 'output': 'csv'}, True, chunk_rows=3)
+        chunks = list(chunks)
+        assert b''.join(chunks).decode() == pd.DataFrame({'x': range(0, 10)}).to_csv()
+
+    def test_ndjson(self, provider):
+        chunks = business_logic.execute_query_stream('bl_test/provider', {'qid': 'plain', 'rows': '5', 'output': 'ndjson'},
+                                                     True, chunk_rows=2)[0]
+        lines = b''.join(chunks).decode().splitlines()
+        assert lines[0] == '{"index":0,"x":0}'
+        assert len(lines) == 5
+
+    def test_arrow_stream(self, provider):
+        pyarrow = pytest.importorskip('pyarrow')
+        import pyarrow.ipc
+        chunks = business_logic.execute_query_stream('bl_test/provider', {'qid': 'plain', 'rows': '5', 'output': 'arrow_stream'},
+                                                     True, chunk_rows=2)[0]
+        df = pyarrow.ipc.open_stream(b''.join(chunks)).read_pandas()
+        assert df['x'].tolist() == [0, 1, 2, 3, 4]
+
+    def test_errors_raise_before_streaming(self, provider):
+        with pytest.raises(ValueError):
+            business_logic.execute_query_stream('bl_test/provider', {'qid': 'plain', 'rows': 'x', 'output': 'csv'}, True)
+
+
+class TestCatalog:
+    @pytest.fixture
+    def described(self, provider, monkeypatch):
+        """ catalog describing modules inline, records the modules it describes """
+        described = []
+
+        def describe(names):
+            described.extend(names)
+            return business_logic._describe_modules_worker(names)
+        monkeypatch.setattr(business_logic, '_CATALOGS', {str(provider): catalog.ModuleCatalog(str(provider), describe)})
+        yield described
+
+    def test_module_page(self, provider, described):
+        html, content_type, code, headers = business_logic.build_html_docs('h', 'bl_test/provider', str(provider), '', '', '')
+        assert code == 200
+        assert '/bl_test/provider?qid=plain' in html
+        assert described == ['bl_test.provider']
+
+        # unchanged modules are not described again, changed ones are
+        business_logic.build_html_docs('h', 'bl_test/provider', str(provider), '', '', '')
+        assert described == ['bl_test.provider']
+        source = provider / 'bl_test' / 'provider.py'
+        os.utime(source, (source.stat().st_mtime + 10, source.stat().st_mtime + 10))
+        business_logic.build_html_docs('h', 'bl_test/provider', str(provider), '', '', '')
+        assert described == ['bl_test.provider', 'bl_test.provider']
+
+    def test_errors_are_retried(self, provider, monkeypatch):
+        answers = [{'bl_test.provider': {'error': 'OperationalError: database is down'}},
+                   business_logic._describe_modules_worker(['bl_test.provider'])]
+        modules = catalog.ModuleCatalog(str(provider), lambda names: answers.pop(0))
+        monkeypatch.setattr(catalog, 'ERROR_RETRY_SECONDS', 0.2)
+        assert 'error' in modules.get(['bl_test/provider'])['bl_test/provider']
+        # the error is kept for a while, then the module is described again although its source did not change
+        assert 'error' in modules.get(['bl_test/provider'])['bl_test/provider']
+        time.sleep(0.3)
+        assert 'queries' in modules.get(['bl_test/provider'])['bl_test/provider']
+        assert answers == []
+
+    def test_listing_and_etag(self, provider, described):
+        html, _, code, headers = business_logic.build_html_docs('h', 'bl_test', str(provider), 'u', '', '')
+        assert '<h4>/bl_test/provider</h4>' in html
+        assert 'http://h/bl_test/provider?authuser=u' in html
+        body, _, code, _ = business_logic.build_html_docs('h', 'bl_test', str(provider), 'u', '', '', headers['ETag'])
+        assert (body, code) == ('', 304)
+
+    def test_json(self, provider, described):
+        data, content_type, code, headers = business_logic.catalog_json(str(provider))
+        queries = json.loads(data)['/bl_test/provider']['queries']
+        assert [q['name'] for q in queries] == ['dates', 'plain', 'slow']
+        assert queries[1]['signature'] == '(rows)'
+
+
+class TestAsync:
+    def test_execute_query_async(self, provider):
+        expected = business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '3'}, True)
+        result = asyncio.run(business_logic.execute_query_async('bl_test/provider', {'qid': 'plain', 'rows': '3'}, True))
+        assert result == expected
+
+    def test_limiter_queues_then_rejects(self):
+        limiter = business_logic.QueryLimiter(1, max_queued=1, retry_after=7)
+        order = []
+
+        async def query(name, seconds):
+            async with limiter:
+                order.append(name)
+                await asyncio.sleep(seconds)
+
+        async def main():
+            first = asyncio.create_task(query('first', 0.1))
+            await asyncio.sleep(0)
+            second = asyncio.create_task(query('second', 0))
+            await asyncio.sleep(0)
+            assert limiter.stats()['queued'] == 1
+            with pytest.raises(business_logic.ServerBusyError) as e:
+                await query('third', 0)
+            assert e.value.retry_after == 7
+            await asyncio.gather(first, second)
+
+        asyncio.run(main())
+        assert order == ['first', 'second']
+        assert limiter.stats() == {'running': 0, 'queued': 0, 'rejected': 1, 'max_concurrent': 1, 'max_queued': 1}
+
+    def test_cancelled_waiter_gives_up_its_place(self):
+        limiter = business_logic.QueryLimiter(1, max_queued=2)
+
+        async def main():
+            async with limiter:
+                waiter = asyncio.create_task(limiter.__aenter__())
+                await asyncio.sleep(0)
+                waiter.cancel()
+                with pytest.raises(asyncio.CancelledError):
+                    await waiter
+            async with limiter:
+                pass
+
+        asyncio.run(main())
+        assert limiter.stats()['running'] == 0
+
+
+class TestMetrics:
+    def test_query_metrics(self, provider):
+        metrics.reset()
+        metrics.configure_server_timing(True)
+        try:
+            qs = {'qid': 'dates', 'start_date': '2020-01-01', 'end_date': '2020-01-02'}
+            business_logic.execute_query('bl_test/provider', dict(qs), True)
+            _, _, _, headers = business_logic.execute_query('bl_test/provider', dict(qs), True)
+            assert 'cache_read;dur=' in headers['Server-Timing']
+            assert metrics.cache_hit_ratios() == {('provider', 'dates'): 0.5}
+            text = business_logic.metrics_text()
+            assert 'datahub_queries_total{module="bl_test/provider",qid="dates",output="csv"} 2' in text
+            assert 'phase="provider"' in text
+        finally:
+            metrics.configure_server_timing(False)
+            metrics.reset()
+
+    def test_async_fast_cache_is_counted(self, provider):
+        metrics.reset()
+        business_logic.start_worker_pool(str(provider), max_workers=1)
+        try:
+            qs = {'qid': 'dates', 'start_date': '2020-01-01', 'end_date': '2020-01-02', 'output': 'fast_cache'}
+            # filled by the worker, then answered by the server
+            for _ in range(0, 2):
+                asyncio.run(business_logic.execute_query_async('bl_test/provider', dict(qs)))
+            with pytest.raises(AttributeError):
+                asyncio.run(business_logic.execute_query_async('bl_test/provider', dict(qs, qid='missing')))
+            text = business_logic.metrics_text()
+            assert 'datahub_queries_total{module="bl_test/provider",qid="dates",output="fast_cache"} 2' in text
+            assert 'datahub_query_errors_total{module="bl_test/provider",qid="unknown"} 1' in text
+        finally:
+            business_logic.stop_worker_pool()
+            metrics.reset()
+
+
+class TestProjection:
+    def test_reserved_params_are_applied_not_passed(self, provider):
+        qs = {'qid': 'plain', 'rows': '10', 'where': 'x>=3', 'sort': '-x', 'limit': '2', 'columns': 'x'}
+        result, _, _, _ = business_logic.execute_query('bl_test/provider', qs, True)
+        assert result == pd.DataFrame({'x': [9, 8]}, index=[9, 8]).to_csv()
+
+    def test_cached_result_is_not_truncated(self, provider):
+        qs = {'qid': 'dates', 'start_date': '2020-01-01', 'end_date': '2020-01-05'}
+        business_logic.execute_query('bl_test/provider', dict(qs, limit='1'), True)
+        result, _, _, _ = business_logic.execute_query('bl_test/provider', dict(qs), True)
+        assert len(result.strip().split('\n')) == 6
+
+    def test_not_with_fast_cache(self, provider):
+        with pytest.raises(ValueError, match='fast_cache'):
+            business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '1', 'output': 'fast_cache',
+                                                              'limit': '1'}, True)
+
+
+class TestHttpCaching:
+    def test_conditional_get(self, provider):
+        qs = {'qid': 'dates', 'start_date': '2020-01-01', 'end_date': '2020-01-02'}
+        body, _, code, headers = business_logic.execute_query('bl_test/provider', dict(qs), True)
+        assert code == 200
+        assert headers['Cache-Control'] == f'max-age={business_logic.HISTORICAL_MAX_AGE}'
+        assert 'Last-Modified' in headers
+        body, _, code, _ = business_logic.execute_query('bl_test/provider', dict(qs), True,
+                                                        {'If-None-Match': headers['ETag']})
+        assert (body, code) == ('', 304)
+
+        # the entry is rewritten, so the etag changes
+        _, _, _, updated = business_logic.execute_query('bl_test/provider', dict(qs, updatecache='1'), True)
+        assert updated['ETag'] != headers['ETag']
+
+    def test_memory_hits_are_validated_without_the_disk(self, provider, monkeypatch):
+        cache.configure_memory_cache(1)
+        try:
+            qs = {'qid': 'dates', 'start_date': '2020-01-01', 'end_date': '2020-01-02', 'output': 'pickle'}
+            _, _, _, first = business_logic.execute_query('bl_test/provider', dict(qs), True)
+            cache_path = business_logic.execute_query('bl_test/provider', dict(qs, output='fast_cache'), True)[0]
+            stats = []
+            stat = os.stat
+
+            def counting_stat(path, *args, **kwargs):
+                stats.append(os.fspath(path))
+                return stat(path, *args, **kwargs)
+            monkeypatch.setattr(os, 'stat', counting_stat)
+            body, _, code, headers = business_logic.execute_query('bl_test/provider', dict(qs), True,
+                                                                  {'If-None-Match': first['ETag']})
+            assert (body, code, headers['ETag']) == ('', 304, first['ETag'])
+            assert cache_path not in stats
+        finally:
+            cache.configure_memory_cache(0)
+
+    def test_uncached_results_get_a_content_etag(self, provider):
+        qs = {'qid': 'plain', 'rows': '3'}
+        _, _, _, headers = business_logic.execute_query('bl_test/provider', dict(qs), True)
+        assert headers['Cache-Control'] == 'no-cache'
+        assert business_logic.execute_query('bl_test/provider', dict(qs), True, {'If-None-Match': headers['ETag']})[2] == 304
+
+    def test_gzip(self, provider):
+        qs = {'qid': 'plain', 'rows': '1000'}
+        plain, _, _, plain_headers = business_logic.execute_query('bl_test/provider', dict(qs), True)
+        body, _, _, headers = business_logic.execute_query('bl_test/provider', dict(qs), True,
+                                                           {'Accept-Encoding': 'gzip;q=0.5, identity'})
+        assert headers['Content-Encoding'] == 'gzip'
+        assert headers['Vary'] == 'Accept-Encoding'
+        assert headers['ETag'] != plain_headers['ETag']
+        assert gzip.decompress(body).decode() == plain
+
+        # small bodies are not worth compressing
+        _, _, _, headers = business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '1'}, True,
+                                                        {'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in headers
+
+    def test_compressed_variants_and_not_modified_in_the_worker(self, provider, tmp_path, monkeypatch):
+        qs = {'qid': 'dates', 'start_date': '2020-01-01', 'end_date': '2020-03-31'}
+        request_headers = {'Accept-Encoding': 'gzip'}
+        body, _, _, headers = business_logic.execute_query('bl_test/provider', dict(qs), True, request_headers)
+        assert headers['Content-Encoding'] == 'gzip'
+        assert [p.name.split('.', 1)[1] for p in sorted((tmp_path / 'cache' / 'provider').glob('*.csv*'))] == \
+            ['csv', 'csv.gzip']
+
+        # the compressed variant is sent as it is
+        def fail(*args, **kwargs):
+            raise AssertionError('compressed again')
+        monkeypatch.setattr(business_logic, '_compress', fail)
+        again, _, _, again_headers = business_logic.execute_query('bl_test/provider', dict(qs), True, request_headers)
+        assert (again, again_headers['ETag']) == (body, headers['ETag'])
+
+        # a client which has the result gets a 304 without reading a variant
+        def fail_read(*args, **kwargs):
+            raise AssertionError('variant read for a 304')
+        monkeypatch.setattr(business_logic, '_read_variant', fail_read)
+        body, _, code, not_modified = business_logic.execute_query('bl_test/provider', dict(qs), True,
+                                                                   dict(request_headers, **{'If-None-Match': headers['ETag']}))
+        assert (body, code, not_modified['ETag'], not_modified['Vary']) == ('', 304, headers['ETag'], 'Accept-Encoding')
+        assert 'Content-Encoding' not in not_modified
+
+    def test_negotiate_encoding(self):
+        assert business_logic.negotiate_encoding(None) is None
+        assert business_logic.negotiate_encoding('gzip;q=0, identity') is None
+        assert business_logic.negotiate_encoding('deflate, *;q=0.1') == list(business_logic.COMPRESSORS)[0]
+        assert business_logic.negotiate_encoding('gzip') == 'gzip'
+
+
+class TestBatch:
+    def test_fan_out_dedup_and_partial_failure(self, provider, tmp_path):
+        marker = tmp_path / 'marker'
+        specs = [{'path': 'bl_test/provider', 'qid': 'slow', 'params': {'marker': str(marker)}},
+                 {'path': '/bl_test/provider', 'qid': 'plain', 'params': {'rows': 2}, 'output': 'json'},
+                 {'path': 'bl_test/provider', 'qid': 'slow', 'params': {'marker': str(marker)}},
+                 {'path': 'bl_test/provider', 'qid': 'missing'},
+                 {'path': 'bl_test/provider', 'qid': 'plain', 'params': {'rows': 1}, 'output': 'pickle'}]
+        body, content_type, code, _ = business_logic.execute_batch(json.dumps(specs), True)
+        assert (content_type, code) == ('application/json', 200)
+        envelope = json.loads(body)
+        results = envelope['results']
+        assert [r['status'] for r in results] == [200, 200, 200, 500, 200]
+        assert envelope['failed'] == 1
+        assert marker.read_text() == 'x'
+        assert results[0] == results[2]
+        assert json.loads(results[1]['body']) == json.loads(pd.DataFrame({'x': range(0, 2)}).to_json())
+        assert 'AttributeError' in results[3]['error']
+        assert results[4]['body_encoding'] == 'base64'
+
+    def test_invalid_specs(self):
+        with pytest.raises(ValueError, match='path and qid'):
+            business_logic.execute_batch([{'qid': 'plain'}], True)
+        with pytest.raises(ValueError, match='at most'):
+            business_logic.execute_batch([{'path': 'a', 'qid': 'b'}] * (business_logic.MAX_BATCH_SIZE + 1), True)
+
+    def test_async(self, provider):
+        specs = [{'path': 'bl_test/provider', 'qid': 'plain', 'params': {'rows': n}} for n in range(1, 4)]
+        body, _, _, _ = asyncio.run(business_logic.execute_batch_async(specs, True))
+        assert [r['body'] for r in json.loads(body)['results']] == [pd.DataFrame({'x': range(0, n)}).to_csv()
+                                                                    for n in range(1, 4)]
+
+    def test_busy_server_items_ask_for_a_retry(self, provider):
+        business_logic.configure_query_limits(1, max_queued=0, retry_after=7)
+        try:
+            specs = [{'path': 'bl_test/provider', 'qid': 'plain', 'params': {'rows': n}} for n in range(1, 3)]
+            envelope = json.loads(asyncio.run(business_logic.execute_batch_async(specs, True))[0])
+        finally:
+            business_logic.configure_query_limits(0)
+        busy = envelope['results'][1]
+        assert [r['status'] for r in envelope['results']] == [200, 503]
+        assert (busy['retry_after'], envelope['failed']) == (7, 1)
+        assert 'ServerBusyError' in busy['error']
+
+
+class TestResultLimits:
+    @pytest.fixture
+    def limits(self):
+        yield business_logic.configure_result_limits
+        business_logic.configure_result_limits()
+
+    def test_row_and_byte_limits(self, provider, limits):
+        limits(max_rows=10)
+        assert business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '10'}, True)[2] == 200
+        with pytest.raises(business_logic.ResultTooLargeError, match='11 rows'):
+            business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '11'}, True)
+
+        # the limit applies to what is sent, so a view of a large result passes
+        assert business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '100', 'limit': '5'}, True)[2] == 200
+
+        limits(max_bytes=100)
+        with pytest.raises(business_logic.ResultTooLargeError, match='more than the limit of 100'):
+            business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '50'}, True)
+        specs = [{'path': 'bl_test/provider', 'qid': 'plain', 'params': {'rows': 50}}]
+        assert json.loads(business_logic.execute_batch(specs, True)[0])['results'][0]['status'] == 413
+
+    def test_row_limit_covers_cached_results(self, provider, limits):
+        qs = {'qid': 'dates', 'start_date': '2024-01-01', 'end_date': '2024-04-09'}
+        # write the entry and its csv variant without a limit
+        assert business_logic.execute_query('bl_test/provider', dict(qs), True)[2] == 200
+        cache_path = business_logic.execute_query('bl_test/provider', dict(qs, output='fast_cache'), True)[0]
+        assert cache.entry_row_count(cache_path) == 100
+
+        # the pickle file and the variants are sent as they are, the limit uses the row count of the index
+        limits(max_rows=2)
+        for output in ('pickle', 'csv'):
+            with pytest.raises(business_logic.ResultTooLargeError, match='100 rows'):
+                business_logic.execute_query('bl_test/provider', dict(qs, output=output), True)
+        with pytest.raises(business_logic.ResultTooLargeError, match='100 rows'):
+            business_logic.execute_query_stream('bl_test/provider', dict(qs, output='csv'), True)
+
+        # a miss is checked as well
+        with pytest.raises(business_logic.ResultTooLargeError, match='10 rows'):
+            business_logic.execute_query('bl_test/provider', {'qid': 'dates', 'start_date': '2024-05-01',
+                                                              'end_date': '2024-05-10', 'output': 'pickle'}, True)
+
+    def test_large_results_are_spilled_and_streamed(self, provider, limits):
+        limits(spill_bytes=1000)
+        business_logic.start_worker_pool(str(provider), max_workers=1)
+        try:
+            expected = pd.DataFrame({'x': range(0, 500)}).to_csv().encode('utf-8')
+            data = business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '500'})[0]
+            assert data == expected
+
+            body, _, code, headers = business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '500'},
+                                                                  stream_large=True)
+            assert isinstance(body, business_logic.FileChunks)
+            assert (len(body), code, headers['Vary']) == (len(expected), 200, 'Accept-Encoding')
+            assert b''.join(body) == expected
+
+            # the spill file goes away with the result
+            spill_path = body.result.path
+            del body
+            gc.collect()
+            assert not os.path.exists(spill_path)
+
+            # small results still go through the pipe
+            assert business_logic.execute_query('bl_test/provider', {'qid': 'plain', 'rows': '2'},
+                                                stream_large=True)[0] == pd.DataFrame({'x': range(0, 2)}).to_csv()
+        finally:
+            business_logic.stop_worker_pool()
@@ -0,0 +1,236 @@
+import io
+import os
+import sys
+import textwrap
+import threading
+import time
+import pandas as pd
+import pytest
+from DataHub import cache
+
+
+def _frame():
+    return pd.DataFrame({'a': [1, 2, 3], 'b': [1.5, 2.5, 3.5], 'c': ['x', 'y', 'z']}, index=[10, 11, 12])
+
+
+def _make_query(tmp_path, calls, **kwargs):
+    @cache.cacheable(cache_dir=str(tmp_path), filename='/x/provider.py', **kwargs)
+    def query(n):
+        calls.append(n)
+        return _frame()
+    return query
+
+
+class TestCacheable:
+    def test_pickle_hit(self, tmp_path):
+        calls = []
+        query = _make_query(tmp_path, calls)
+        first = query(n='1')
+        second = query(n='1')
+        assert isinstance(second, io.BytesIO)
+        assert second.cache_path == first.cache_path
+        assert calls == ['1']
+        pd.testing.assert_frame_equal(cache.decode_cache_to_df(second), _frame())
+
+    def test_nocache(self, tmp_path):
+        calls = []
+        query = _make_query(tmp_path, calls)
+        query(n='1')
+        assert isinstance(query(n='1', nocache=True), pd.DataFrame)
+        assert calls == ['1', '1']
+
+    def test_keys_do_not_collide(self, tmp_path):
+        calls = []
+        query = _make_query(tmp_path, calls)
+        paths = {query(n=n).cache_path for n in ['a/b', 'a__b', 'a_b', 'a,b=c']}
+        assert len(paths) == 4
+        assert calls == ['a/b', 'a__b', 'a_b', 'a,b=c']
+
+    def test_long_keys_are_hashed(self, tmp_path):
+        calls = []
+        query = _make_query(tmp_path, calls)
+        path = query(n='x' * 500).cache_path
+        assert len(os.path.basename(path)) < cache.MAX_FILENAME_LENGTH
+        query(n='x' * 500)
+        assert calls == ['x' * 500]
+
+
+@pytest.mark.parametrize('storage', ['feather', 'parquet'])
+class TestColumnarStorage:
+    def test_roundtrip_and_projection(self, tmp_path, storage):
+        pytest.importorskip('pyarrow')
+        calls = []
+        query = _make_query(tmp_path, calls, storage=storage)
+        query(n='1')
+        ref = query(n='1')
+        assert isinstance(ref, cache.CacheRef)
+        assert ref.cache_path.endswith(cache.get_storage(storage).extension)
+        assert calls == ['1']
+        pd.testing.assert_frame_equal(cache.decode_cache_to_df(ref), _frame())
+        pd.testing.assert_frame_equal(cache.decode_cache_to_df(ref, columns=['b']), _frame()[['b']])
+
+
+@pytest.fixture
+def memory_cache():
+    yield cache.configure_memory_cache(1)
+    cache.configure_memory_cache(0)
+
+
+class TestMemoryCache:
+    def test_lru_eviction(self, tmp_path):
+        m = cache.MemoryCache(max_bytes=10, max_entry_bytes=6)
+        for name in ['a', 'b', 'c']:
+            (tmp_path / name).write_bytes(b'x')
+        m.put(str(tmp_path / 'a'), b'1234')
+        m.put(str(tmp_path / 'b'), b'1234')
+        assert m.get(str(tmp_path / 'a')) == b'1234'
+        m.put(str(tmp_path / 'c'), b'1234')
+        assert m.get(str(tmp_path / 'b')) is None
+        m.put(str(tmp_path / 'c'), b'1234567')
+        assert m.stats()['evictions'] == 1
+        assert m.stats()['rejected'] == 1
+        assert m.stats()['bytes'] == 4
+
+    def test_hit_does_not_touch_disk(self, tmp_path, memory_cache):
+        calls = []
+        query = _make_query(tmp_path, calls)
+        path = query(n='1').cache_path
+        os.remove(path)
+        pd.testing.assert_frame_equal(cache.decode_cache_to_df(query(n='1')), _frame())
+        assert calls == ['1']
+        assert memory_cache.stats()['hits'] == 1
+
+    def test_revalidates_against_disk(self, tmp_path, memory_cache):
+        memory_cache.revalidate_seconds = 0
+        calls = []
+        query = _make_query(tmp_path, calls)
+        os.remove(query(n='1').cache_path)
+        query(n='1')
+        assert calls == ['1', '1']
+
+    def test_updatecache_replaces_entry(self, tmp_path, memory_cache):
+        calls = []
+        query = _make_query(tmp_path, calls)
+        first = query(n='1').getvalue()
+        query(n='1', updatecache=True)
+        assert calls == ['1', '1']
+        assert query(n='1').getvalue() == first
+        assert memory_cache.stats()['entries'] == 1
+
+
+class TestConcurrentFill:
+    def test_concurrent_misses_run_the_query_once(self, tmp_path):
+        calls = []
+
+        @cache.cacheable(cache_dir=str(tmp_path), filename='/x/provider.py')
+        def slow(n):
+            calls.append(n)
+            time.sleep(0.3)
+            return _frame()
+
+        threads = [threading.Thread(target=slow, kwargs={'n': '1'}) for _ in range(0, 3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert calls == ['1']
+        assert [p.name for p in (tmp_path / 'provider').iterdir()] == ['slow@n=1.pickle.gz']
+
+
+class TestSegments:
+    def _make_range_query(self, tmp_path, calls, **kwargs):
+        @cache.cacheable(cache_dir=str(tmp_path), filename='/x/provider.py', segment_params=('start_date', 'end_date'),
+                         **kwargs)
+        def query(start_date, end_date, scale='1'):
+            calls.append((start_date, end_date))
+            days = pd.date_range(start_date, end_date, freq='D')
+            return pd.DataFrame({'day': days, 'v': [d.day * int(scale) for d in days]})
+        return query
+
+    def test_split_range(self):
+        assert cache.split_range('2024-08-30', '2024-09-02') == [
+            ('2024-08-30', '2024-08-30'), ('2024-08-31', '2024-08-31'), ('2024-09-01', '2024-09-01'),
+            ('2024-09-02', '2024-09-02')]
+        assert cache.split_range('2024-08-30', '2024-10-02', 'M') == [
+            ('2024-08-30', '2024-08-31'), ('2024-09-01', '2024-09-30'), ('2024-10-01', '2024-10-02')]
+        assert cache.split_range('2024-08-30', '2024-09-01', end_inclusive=False) == [
+            ('2024-08-30', '2024-08-31'), ('2024-08-31', '2024-09-01')]
+        assert cache.split_range('2024-08-02', '2024-08-01') == []
+
+    def test_sliding_window_fetches_new_days_only(self, tmp_path):
+        calls = []
+        query = self._make_range_query(tmp_path, calls)
+        df = query(start_date='2024-08-01', end_date='2024-08-03')
+        assert list(df['v']) == [1, 2, 3]
+        assert len(calls) == 3
+
+        calls.clear()
+        df = query(start_date='2024-08-02', end_date='2024-08-04')
+        assert list(df['v']) == [2, 3, 4]
+        assert calls == [('2024-08-04', '2024-08-04')]
+
+        # other parameters are part of the segment keys
+        calls.clear()
+        assert list(query(start_date='2024-08-02', end_date='2024-08-02', scale='2')['v']) == [4]
+        assert len(calls) == 1
+
+    def test_lagging_segments_are_not_cached(self, tmp_path):
+        calls = []
+        query = self._make_range_query(tmp_path, calls, lag_params=['end_date'],
+                                       lag_from_utc_now=pd.Timedelta(days=2))
+        today = pd.Timestamp.now('UTC').tz_localize(None).normalize()
+        start = (today - pd.Timedelta(days=4)).strftime('%Y-%m-%d')
+        end = today.strftime('%Y-%m-%d')
+        query(start_date=start, end_date=end)
+        calls.clear()
+        assert len(query(start_date=start, end_date=end)) == 5
+        assert [c[0] for c in calls] == [(today - pd.Timedelta(days=1)).strftime('%Y-%m-%d'), end]
+
+    def test_concat_segments(self):
+        frames = [pd.DataFrame({'v': [1, 2]}), pd.DataFrame({'v': [3]})]
+        assert list(cache.concat_segments(frames).index) == [0, 1, 2]
+        frames = [df.set_index(pd.Index(['a', 'b'][:len(df)], name='k')) for df in frames]
+        assert list(cache.concat_segments(frames).index) == ['a', 'b', 'a']
+
+    def test_fast_cache_spec_is_not_a_single_file(self, tmp_path):
+        query = self._make_range_query(tmp_path, [])
+        assert cache.cache_path_from_spec(query.cache_spec, {'start_date': '2024-08-01', 'end_date': '2024-08-01'}) is None
+
+    def test_parallel_segments(self, tmp_path, monkeypatch):
+        (tmp_path / 'parallel_provider.py').write_text(textwrap.dedent(f'''
+            import os
+            import pandas as pd
+            from DataHub.cache import cacheable
+
+            @cacheable(cache_dir={str(tmp_path / 'cache')!r}, filename=__file__, segment_params=('start_date', 'end_date'),
+                       segment_workers=2)
+            def query(start_date, end_date):
+                with open({str(tmp_path / 'calls')!r}, 'a') as f:
+                    f.write(f'{{start_date}} {{os.getpid()}}\\n')
+                days = pd.date_range(start_date, end_date, freq='D')
+                return pd.DataFrame({{'day': days, 'v': [d.day for d in days]}})
+            '''))
+        monkeypatch.syspath_prepend(str(tmp_path))
+        import parallel_provider
+        try:
+            parallel_provider.query(start_date='2024-08-02', end_date='2024-08-02')
+            df = parallel_provider.query(start_date='2024-08-01', end_date='2024-08-05')
+            assert list(df['v']) == [1, 2, 3, 4, 5]
+            calls = [x.split() for x in (tmp_path / 'calls').read_text().splitlines()]
+            assert sorted(c[0] for c in calls) == ['2024-08-01', '2024-08-02', '2024-08-03', '2024-08-04', '2024-08-05']
+            # the single segment is fetched in this process, the missing ones of the range in the segment processes
+            assert [c[1] for c in calls if c[0] == '2024-08-02'] == [str(os.getpid())]
+            assert str(os.getpid()) not in [c[1] for c in calls if c[0] != '2024-08-02']
+
+            # the segments fetched in parallel were cached
+            assert list(parallel_provider.query(start_date='2024-08-03', end_date='2024-08-04')['v']) == [3, 4]
+            assert len((tmp_path / 'calls').read_text().splitlines()) == 5
+
+            # the segment processes pick up a changed provider
+            source = tmp_path / 'parallel_provider.py'
+            source.write_text(source.read_text().replace("'v': [d.day for d in days]", "'v': [d.day * 10 for d in days]"))
+            os.utime(source, (time.time() + 5, time.time() + 5))
+            assert list(parallel_provider.query(start_date='2024-08-06', end_date='2024-08-07')['v']) == [60, 70]
+        finally:
+            cache.stop_segment_pools()
+            sys.modules.pop('parallel_provider', None)
@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+from DataHub.example_providers.example import example
+
+
+class TestExample:
+    def test_random_data(self):
+        df = example.random_data('4', '3')
+        assert df.shape == (4, 5)
+        assert df[[0, 1, 2]].isin(range(1001)).all().all()
+        assert df['time'].nunique() == 1
+
+    def test_synthetic_data(self):
+        df = example.synthetic_data('6', '7', dtypes='int, float,str,bool,datetime', seed='3')
+        assert list(df.columns) == ['int_0', 'float_1', 'str_2', 'bool_3', 'datetime_4', 'int_5', 'float_6']
+        assert len(df) == 6
+        assert pd.api.types.is_integer_dtype(df['int_0'])
+        assert pd.api.types.is_float_dtype(df['float_1'])
+        assert pd.api.types.is_bool_dtype(df['bool_3'])
+        assert pd.api.types.is_datetime64_any_dtype(df['datetime_4'])
+        pd.testing.assert_frame_equal(df, example.synthetic_data(6, 7, dtypes='int,float,str,bool,datetime', seed=3))
+
+    def test_synthetic_data_dtypes(self):
+        assert list(example.synthetic_data(0, 2, dtypes='float').columns) == ['float_0', 'float_1']
+        with pytest.raises(ValueError, match='unknown dtypes complex'):
+            example.synthetic_data(2, 2, dtypes='int,complex')
@@ -0,0 +1,101 @@
+import os
+import time
+import pandas as pd
+from DataHub import cache, cache_index, janitor
+
+
+def _decorate(tmp_path, source, calls, **kwargs):
+    @cache.cacheable(cache_dir=str(tmp_path / 'cache'), filename=str(source), **kwargs)
+    def query(n):
+        calls.append(n)
+        return pd.DataFrame({'n': [n]})
+    return query
+
+
+class TestExpiry:
+    def test_ttl(self, tmp_path):
+        source = tmp_path / 'provider.py'
+        source.write_text('a = 1')
+        calls = []
+        query = _decorate(tmp_path, source, calls, ttl=0.3)
+        query(n='1')
+        query(n='1')
+        time.sleep(0.4)
+        query(n='1')
+        assert calls == ['1', '1']
+
+    def test_invalidate_on_source_change(self, tmp_path):
+        source = tmp_path / 'provider.py'
+        source.write_text('a = 1')
+        calls = []
+        _decorate(tmp_path, source, calls, invalidate_on_change=True)(n='1')
+
+        # unchanged source keeps the entry, a new source invalidates it
+        _decorate(tmp_path, source, calls, invalidate_on_change=True)(n='1')
+        assert calls == ['1']
+        time.sleep(0.01)
+        source.write_text('a = 2')
+        _decorate(tmp_path, source, calls, invalidate_on_change=True)(n='1')
+        assert calls == ['1', '1']
+
+
+class TestCleanCache:
+    def test_removes_expired(self, tmp_path):
+        source = tmp_path / 'provider.py'
+        source.write_text('a = 1')
+        calls = []
+        query = _decorate(tmp_path, source, calls, ttl=60)
+        expired = query(n='1').cache_path
+        kept = query(n='2').cache_path
+        cache_index.get_index(str(tmp_path / 'cache'))._execute('UPDATE entries SET created = created - 120 WHERE path = ?',
+                                                                 (expired, ))
+        stats = janitor.clean_cache([str(tmp_path / 'cache')])
+        assert stats['removed'] == 1
+        assert not os.path.exists(expired)
+        assert os.path.exists(kept)
+
+        # the removed entry is a miss again
+        query(n='1')
+        assert calls == ['1', '2', '1']
+
+    def test_quota_evicts_least_recently_used(self, tmp_path):
+        source = tmp_path / 'provider.py'
+        source.write_text('a = 1')
+        calls = []
+        query = _decorate(tmp_path, source, calls)
+        paths = [query(n=str(i)).cache_path for i in range(0, 3)]
+        time.sleep(0.01)
+        query(n='0')
+        cache_index.get_index(str(tmp_path / 'cache')).flush_hits()
+        quota = os.path.getsize(paths[0]) + os.path.getsize(paths[2])
+        stats = janitor.clean_cache([str(tmp_path / 'cache')], quota_bytes=quota)
+        assert [os.path.exists(p) for p in paths] == [True, False, True]
+        assert stats['remaining_bytes'] == quota
+
+    def test_sweep_orphans(self, tmp_path):
+        module_dir = tmp_path / 'cache' / 'provider'
+        module_dir.mkdir(parents=True)
+        (module_dir / 'legacy_n=1.pickle.gz').write_bytes(b'x')
+        (module_dir / 'fresh.tmp').write_bytes(b'x')
+        t = time.time() - 2 * janitor.STALE_TMP_SECONDS
+        os.utime(module_dir / 'legacy_n=1.pickle.gz', (t, t))
+        assert janitor.sweep_orphans([str(tmp_path / 'cache')])['removed'] == 1
+        assert [p.name for p in module_dir.iterdir()] == ['fresh.tmp']
+
+    def test_sweep_orphans_keeps_entries_of_other_spellings(self, tmp_path):
+        source = tmp_path / 'provider.py'
+        source.write_text('a = 1')
+        path = _decorate(tmp_path, source, [])(n='1').cache_path
+        t = time.time() - 2 * janitor.STALE_TMP_SECONDS
+        os.utime(path, (t, t))
+        assert janitor.sweep_orphans([str(tmp_path) + '/./cache'])['removed'] == 0
+        assert os.path.exists(path)
+
+    def test_janitor_thread(self, tmp_path):
+        source = tmp_path / 'provider.py'
+        source.write_text('a = 1')
+        path = _decorate(tmp_path, source, [], ttl=0.1)(n='1').cache_path
+        j = janitor.CacheJanitor([str(tmp_path / 'cache')], interval=0.05)
+        time.sleep(0.4)
+        j.stop()
+        assert not os.path.exists(path)
@@ -0,0 +1,51 @@
+import time
+import pytest
+from DataHub import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+    metrics.configure_server_timing(False)
+
+
+class TestMetrics:
+    def test_phases_are_only_recorded_inside_collect(self):
+        with metrics.phase('outside'):
+            metrics.count_cache('m', 'f', 'hit')
+        with metrics.collect() as recorder:
+            with metrics.phase('read'):
+                time.sleep(0.01)
+            metrics.count_cache('m', 'f', 'hit')
+            metrics.count_cache('m', 'f', 'hit')
+        exported = recorder.export()
+        assert list(exported['phases']) == ['read']
+        assert exported['phases']['read'] >= 0.01
+        assert exported['cache'] == [('m', 'f', 'hit', 2)]
+
+    def test_prometheus_text(self):
+        recording = {'phases': {'provider': 0.2}, 'cache': [('m', 'f', 'hit', 3), ('m', 'f', 'miss', 1)]}
+        metrics.observe_query('a/b', 'q', 'csv', 0.3, 2000, recording)
+        text = metrics.render_prometheus({'datahub_worker_pool_workers': 4})
+        assert 'datahub_queries_total{module="a/b",qid="q",output="csv"} 1' in text
+        assert 'datahub_phase_seconds_bucket{module="a/b",qid="q",phase="provider",le="0.25"} 1' in text
+        assert 'datahub_phase_seconds_bucket{module="a/b",qid="q",phase="provider",le="0.1"} 0' in text
+        assert 'datahub_response_bytes_sum{module="a/b",qid="q"} 2000' in text
+        assert 'datahub_worker_pool_workers 4' in text
+        assert metrics.cache_hit_ratios() == {('m', 'f'): 0.75}
+
+    def test_errors_of_unknown_queries_share_a_series(self):
+        metrics.observe_query('a/b', 'q', 'csv', 0.1)
+        for module, qid in [('a/b', 'q'), ('a/b', 'typo'), ('x/y', 'z'), ('../etc', 'w')]:
+            metrics.observe_error(module, qid)
+        text = metrics.render_prometheus()
+        assert 'datahub_query_errors_total{module="a/b",qid="q"} 1' in text
+        assert 'datahub_query_errors_total{module="a/b",qid="unknown"} 1' in text
+        assert 'datahub_query_errors_total{module="unknown",qid="unknown"} 2' in text
+
+    def test_server_timing(self):
+        assert metrics.server_timing({'provider': 0.5}) is None
+        metrics.configure_server_timing(True)
+        assert metrics.server_timing({'provider': 0.5, 'render': 0.0012}) == 'provider;dur=500.0, render;dur=1.2'
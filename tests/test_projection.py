@@ -0,0 +1,39 @@
+import pandas as pd
+import pytest
+from DataHub import projection
+
+
+def _frame():
+    return pd.DataFrame({'region': ['west', 'east', 'west', 'north'], 'price': [10, 20, 30, 40],
+                         'day': pd.to_datetime(['2024-08-01', '2024-08-02', '2024-08-03', '2024-08-04']),
+                         0: [1, 2, 3, 4]})
+
+
+class TestProjection:
+    def test_pop_view(self):
+        params = {'rows': '5', 'columns': 'a', 'limit': '2'}
+        assert projection.pop_view(params) == {'columns': 'a', 'limit': '2'}
+        assert params == {'rows': '5'}
+
+    def test_where(self):
+        df = projection.apply_view(_frame(), {'where': 'region==west|north;price>15'})
+        assert list(df['price']) == [30, 40]
+        df = projection.apply_view(_frame(), {'where': 'day>=2024-08-03'})
+        assert list(df['price']) == [30, 40]
+        df = projection.apply_view(_frame(), {'where': 'region!=west'})
+        assert list(df['region']) == ['east', 'north']
+
+    def test_sort_page_and_columns(self):
+        df = projection.apply_view(_frame(), {'sort': 'region,-price', 'offset': '1', 'limit': '2', 'columns': 'price,0'})
+        assert list(df.columns) == ['price', 0]
+        assert list(df['price']) == [40, 30]
+
+    def test_errors(self):
+        with pytest.raises(ValueError, match='unknown column'):
+            projection.apply_view(_frame(), {'columns': 'nope'})
+        with pytest.raises(ValueError, match='invalid where'):
+            projection.apply_view(_frame(), {'where': 'price'})
+
+    def test_needed_columns(self):
+        assert projection.needed_columns({'limit': '5'}) is None
+        assert projection.needed_columns({'columns': 'a,b', 'where': 'c>1', 'sort': '-a,d'}) == ['a', 'b', 'c', 'd']
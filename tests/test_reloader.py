@@ -0,0 +1,29 @@
+import os
+from DataHub import reloader
+
+
+class TestModuleWatcher:
+    def test_change_is_reported_once_settled(self, tmp_path):
+        (tmp_path / 'a').mkdir()
+        (tmp_path / 'a' / 'provider.py').write_text('x = 1')
+        (tmp_path / 'a' / 'notes.txt').write_text('ignored')
+        changes = []
+        watcher = reloader.ModuleWatcher(str(tmp_path), changes.append, interval=3600)
+        try:
+            assert watcher.poll() is None
+            (tmp_path / 'a' / 'provider.py').write_text('x = 22')
+            (tmp_path / 'b.py').write_text('y = 1')
+            (tmp_path / 'a' / 'notes.txt').write_text('still ignored')
+
+            # the first poll sees the change, the second one reports it if nothing changed in between
+            pending = watcher.poll()
+            assert pending is not None and changes == []
+            assert watcher.poll(pending) is None
+            assert changes == [[os.path.join('a', 'provider.py'), 'b.py']]
+            assert watcher.poll() is None
+        finally:
+            watcher.stop()
+
+    def test_changed_files(self):
+        assert reloader.changed_files({'a.py': (1, 1), 'b.py': (1, 1)}, {'b.py': (2, 1), 'c.py': (1, 1)}) == \
+            ['a.py', 'b.py', 'c.py']
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import time
+import pytest
+from DataHub import resources
+
+
+@pytest.fixture(autouse=True)
+def pools():
+    yield
+    resources.close_all()
+
+
+class _Connections:
+    """ sqlite connect function recording the connections it opened """
+    def __init__(self, database):
+        self.database = database
+        self.opened = []
+
+    def __call__(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        self.opened.append(conn)
+        return conn
+
+
+class TestConnectionPool:
+    def test_connection_is_reused(self, tmp_path):
+        connect = _Connections(str(tmp_path / 'db.sqlite'))
+        pool = resources.connection_pool('db', connect)
+        with pool.connection() as conn:
+            conn.execute('create table t (x integer)')
+            conn.commit()
+        with pool.connection() as conn:
+            assert conn.execute('select count(*) from t').fetchone() == (0, )
+        assert len(connect.opened) == 1
+        assert pool.stats()['idle'] == 1
+
+    def test_declared_again_returns_the_pool(self, tmp_path):
+        pool = resources.connection_pool('db', _Connections(':memory:'), max_size=1)
+        again = resources.connection_pool('db', _Connections(':memory:'), max_size=2)
+        assert again is pool and pool.max_size == 2
+        assert resources.get_pool('db') is pool
+
+    def test_max_size_and_timeout(self):
+        pool = resources.connection_pool('db', _Connections(':memory:'), max_size=1, timeout=0.2)
+        with pool.connection():
+            with pytest.raises(resources.PoolTimeoutError):
+                pool.acquire()
+
+            # a waiting checkout gets the connection once it is released
+            got = []
+            pool.timeout = 5
+            t = threading.Thread(target=lambda: got.append(pool.acquire()))
+            t.start()
+            time.sleep(0.1)
+        t.join()
+        assert len(got) == 1
+        assert pool.stats()['waits'] >= 1
+
+    def test_idle_timeout(self):
+        connect = _Connections(':memory:')
+        pool = resources.connection_pool('db', connect, idle_timeout=0.1)
+        with pool.connection():
+            pass
+        time.sleep(0.2)
+        pool.prune()
+        assert pool.stats()['closed'] == 1
+        with pool.connection():
+            pass
+        time.sleep(0.2)
+        with pool.connection():
+            pass
+        assert len(connect.opened) == 3
+        assert pool.stats()['open'] == 1
+
+    def test_idle_connections_are_pruned_without_a_checkout(self):
+        connect = _Connections(':memory:')
+        pool = resources.connection_pool('db', connect, idle_timeout=0.1)
+        with pool.connection():
+            pass
+        deadline = time.monotonic() + 2
+        while pool.stats()['open'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert (pool.stats()['open'], pool.stats()['closed']) == (0, 1)
+
+    def test_health_check_reconnects(self):
+        connect = _Connections(':memory:')
+        pool = resources.connection_pool('db', connect, check=lambda conn: conn.execute('select 1'), check_interval=0)
+        with pool.connection() as conn:
+            pass
+        conn.close()
+        with pool.connection() as conn:
+            assert conn.execute('select 1').fetchone() == (1, )
+        assert len(connect.opened) == 2
+        assert pool.stats()['failed_checks'] == 1
+
+    def test_error_discards_connection(self):
+        connect = _Connections(':memory:')
+        pool = resources.connection_pool('db', connect)
+        with pytest.raises(ValueError):
+            with pool.connection():
+                raise ValueError('bad parameter')
+        assert pool.stats()['open'] == 0
+        with pool.connection():
+            pass
+        assert len(connect.opened) == 2
+
+    def test_config_file(self, tmp_path):
+        config = tmp_path / 'datamodule_test.conf'
+        config.write_text(f'[Warehouse]\ndatabase = {tmp_path / "warehouse.sqlite"}\n')
+        pool = resources.connection_pool('warehouse', sqlite3.connect, config_file=str(config), section='Warehouse')
+        with pool.connection() as conn:
+            conn.execute('create table t (x integer)')
+        assert (tmp_path / 'warehouse.sqlite').exists()
+        with pytest.raises(FileNotFoundError):
+            resources.connection_pool('missing', sqlite3.connect, config_file=str(tmp_path / 'missing.conf')).acquire()
@@ -0,0 +1,50 @@
+import datetime
+import json
+import pytest
+from DataHub import warm
+
+
+NOW = datetime.datetime(2024, 8, 10, 4, 30)
+
+
+class TestWarm:
+    def test_render_params(self):
+        params = warm.render_params('start_date={today-7d}&end_date={today-1d}&at={now+2h:%H}&region=west', NOW)
+        assert params == {'start_date': '2024-08-03', 'end_date': '2024-08-09', 'at': '06', 'region': 'west'}
+
+    def test_next_run(self):
+        job = warm.WarmJob('j', '/a/b', 'q', at='05:30')
+        assert job.path == 'a/b'
+        assert job.next_run(NOW) == datetime.datetime(2024, 8, 10, 5, 30)
+        assert job.next_run(datetime.datetime(2024, 8, 10, 5, 30)) == datetime.datetime(2024, 8, 11, 5, 30)
+        assert warm.WarmJob('j', 'a', 'q').next_run(NOW) is None
+
+    def test_load_config(self, tmp_path):
+        config = tmp_path / 'warm.conf'
+        config.write_text('[DEFAULT]\nconcurrency = 3\n\n[dates]\npath = bl_test/provider\nqid = dates\n'
+                          'params = start_date={today-3d}&end_date={today-2d}\nat = 05:30\nupdate = yes\n')
+        jobs, settings = warm.load_config(str(config))
+        assert settings['concurrency'] == '3'
+        assert [(j.name, j.qid, j.at, j.update) for j in jobs] == [('dates', 'dates', datetime.time(5, 30), True)]
+        with pytest.raises(FileNotFoundError):
+            warm.load_config(str(tmp_path / 'missing.conf'))
+
+    def test_warm_fills_the_cache(self, provider):
+        import bl_test.provider
+        jobs = [warm.WarmJob('dates', 'bl_test/provider', 'dates', 'start_date={today-9d}&end_date={today-8d}'),
+                warm.WarmJob('broken', 'bl_test/provider', 'missing')]
+        results = warm.warm(jobs, nospawn=True, now=NOW)
+        assert [r['status'] for r in results] == ['warmed', 'error']
+        assert results[0]['params'] == {'start_date': '2024-08-01', 'end_date': '2024-08-02'}
+        json.dumps(results)
+
+        # the next warm is a cache hit
+        warm.warm(jobs[:1], nospawn=True, now=NOW)
+        assert bl_test.provider.CALLS == [('2024-08-01', '2024-08-02')]
+
+    def test_update_rewrites_the_entry(self, provider):
+        import bl_test.provider
+        job = warm.WarmJob('dates', 'bl_test/provider', 'dates', 'start_date={today-9d}&end_date={today-8d}',
+                           update=True)
+        assert [r['status'] for r in warm.warm([job, job], concurrency=1, nospawn=True, now=NOW)] == ['warmed', 'warmed']
+        assert bl_test.provider.CALLS == [('2024-08-01', '2024-08-02')] * 2
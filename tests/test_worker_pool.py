@@ -0,0 +1,112 @@
+import importlib
+import os
+import textwrap
+import time
+import pytest
+from DataHub.worker_pool import WorkerPool, WorkerCrashedError, WorkerTimeoutError
+
+
+def _pid():
+    return os.getpid()
+
+
+def _fail():
+    raise ValueError('boom')
+
+
+def _crash():
+    os._exit(3)
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def _segmented_query(module):
+    return len(importlib.import_module(module).query(start_date='2024-08-01', end_date='2024-08-03'))
+
+
+@pytest.fixture
+def pool():
+    p = WorkerPool(max_workers=1, task_timeout=5)
+    yield p
+    p.shutdown()
+
+
+class TestWorkerPool:
+    def test_reuses_worker(self, pool):
+        pid = pool.submit(_pid).result()
+        assert pid != os.getpid()
+        assert pool.submit(_pid).result() == pid
+
+    def test_exception_propagates(self, pool):
+        with pytest.raises(ValueError, match='boom'):
+            pool.submit(_fail).result()
+        # the worker survives a failed task
+        assert pool.submit(_sleep, 0).result() == 0
+
+    def test_crash_is_isolated(self, pool):
+        pid = pool.submit(_pid).result()
+        with pytest.raises(WorkerCrashedError):
+            pool.submit(_crash).result()
+        assert pool.submit(_pid).result() != pid
+        assert pool.stats()['crashes'] == 1
+
+    def test_timeout_kills_worker(self):
+        p = WorkerPool(max_workers=1, task_timeout=0.5)
+        try:
+            pid = p.submit(_pid).result()
+            with pytest.raises(WorkerTimeoutError):
+                p.submit(_sleep, 10).result()
+            assert p.submit(_pid).result() != pid
+        finally:
+            p.shutdown()
+
+    def test_recycle_after_max_tasks(self):
+        p = WorkerPool(max_workers=1, max_tasks_per_worker=2)
+        try:
+            pids = [p.submit(_pid).result() for _ in range(0, 4)]
+            assert pids[0] == pids[1]
+            assert pids[1] != pids[2]
+            assert pids[2] == pids[3]
+        finally:
+            p.shutdown()
+
+    def test_recycle_stops_segment_processes(self, tmp_path, monkeypatch):
+        (tmp_path / 'wp_segmented.py').write_text(textwrap.dedent(f'''
+            import pandas as pd
+            from DataHub.cache import cacheable
+
+            @cacheable(cache_dir={str(tmp_path / 'cache')!r}, filename=__file__, segment_params=('start_date', 'end_date'),
+                       segment_workers=2)
+            def query(start_date, end_date):
+                return pd.DataFrame({{'d': pd.date_range(start_date, end_date)}})
+            '''))
+        monkeypatch.syspath_prepend(str(tmp_path))
+        p = WorkerPool(max_workers=1, max_tasks_per_worker=1)
+        try:
+            assert p.submit(_segmented_query, 'wp_segmented').result() == 3
+            # the recycled worker exits on its own instead of being killed after the stop timeout
+            st = time.monotonic()
+            p.submit(_pid).result()
+            assert time.monotonic() - st < 3
+        finally:
+            p.shutdown()
+
+    def test_roll_replaces_workers(self):
+        p = WorkerPool(max_workers=2)
+        try:
+            before = {p.submit(_pid).result() for _ in range(0, 4)}
+            p.roll()
+            after = {p.submit(_pid).result() for _ in range(0, 4)}
+            assert not before & after
+            assert p.stats()['rolls'] == 1
+        finally:
+            p.shutdown()
+
+    def test_roll_lets_running_task_finish(self, pool):
+        future = pool.submit(_sleep, 0.5)
+        time.sleep(0.1)
+        pool.roll()
+        assert future.result() == 0.5